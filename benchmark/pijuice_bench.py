@@ -0,0 +1,433 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the pijuice service and tools on the simulated PiJuice.
+
+Runs without a board (see pijuice_sim) and reports as JSON:
+    ticks    wall/CPU time, allocations, I2C transactions and bytes of one
+             service loop iteration, for the power check alone and for all
+             checks due together
+    cli      wall time, I2C transactions and bytes of command line tool calls
+    startup  import time and '--help' run time of every script
+    imports  import time and loaded modules of pijuice_ctl commands, fails
+             (exit code 1) when a command loads a module it must not, e.g.
+             config only commands opening the bus
+    latency  time from a button press, fault or power loss on the simulated
+             board until the service dispatches the configured function
+    status   cost of reading the status from the shared memory status page
+             compared to reading it over the bus
+
+The pijuice module itself (PiJuice Software/Source/pijuice.py) must be
+importable, e.g. through --path. Results of an earlier run can be given
+with --compare to print the changes.
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB_DIR = os.path.join(ROOT, 'python3-pijuice', 'files')
+SERVICE_DIR = os.path.join(LIB_DIR, 'src')
+SCRIPTS_DIR = os.path.join(ROOT, 'python3-pijuice_scripts', 'files')
+SCRIPTS = collections.OrderedDict([
+    ('pijuice_sys', SERVICE_DIR),
+    ('pijuice_ctl', SCRIPTS_DIR),
+    ('pijuice_status', SCRIPTS_DIR),
+    ('pijuice_poweroff', SCRIPTS_DIR),
+])
+CLI_COMMANDS = [
+    ['pijuice_status'],
+    ['pijuice_ctl', 'firmware', 'get'],
+    ['pijuice_ctl', 'faults', 'get'],
+    ['pijuice_ctl', 'buttons', 'get'],
+    ['pijuice_ctl', 'led', 'get'],
+    ['pijuice_ctl', 'battery', 'get'],
+    ['pijuice_ctl', 'rtc', 'get'],
+]
+# command line, modules it must not load: the pijuice module, the bus
+# (and the simulator opening the PiJuice here) and what only some commands need
+IMPORT_CHECKS = [
+    (['--help'], ('pijuice', 'pijuice_sim', 'pijuice_bus', 'pijuice_query', 'subprocess', 'datetime')),
+    (['events', 'get'], ('pijuice_sim', 'pijuice_bus', 'subprocess', 'datetime')),
+    (['functions', 'get', '--kind', 'all'], ('pijuice_sim', 'pijuice_bus', 'subprocess', 'datetime')),
+    (['service', 'minCharge', '--threshold', '10'], ('pijuice', 'pijuice_sim', 'pijuice_bus', 'datetime')),
+]
+IMPORT_CHECK_CODE = '''
+import json, sys, time
+t = time.perf_counter()
+import pijuice_ctl
+importTime = time.perf_counter() - t
+pijuice_ctl.ConfigCommand.PiJuiceConfigDataPath = %(config)r
+pijuice_ctl.ConfigCommand.SERVICE_CTL = 'true'
+try:
+    ret = pijuice_ctl.Control().main(%(argv)r)
+except SystemExit as e:
+    ret = e.code
+with open(%(output)r, 'w') as f:
+    json.dump({'import': importTime, 'returncode': ret, 'modules': sorted(sys.modules)}, f)
+'''
+SECTIONS = ('ticks', 'cli', 'startup', 'imports', 'latency', 'status')
+TICK_SETS = collections.OrderedDict([('power', ['power']), ('all', None)])
+SCENARIO = {'latency': 0.0005}  # about a 4 byte transfer at 100 kHz
+SERVICE_CONFIG = {
+    'system_task': {
+        'enabled': True,
+        'watchdog': {'enabled': False},
+        'min_charge': {'enabled': True, 'threshold': 1},
+        'min_bat_voltage': {'enabled': True, 'threshold': 1},
+    },
+    'system_events': {
+        'no_power': {'enabled': True, 'function': 'USER_FUNC1'},
+        'power': {'enabled': True, 'function': 'USER_FUNC1'},
+        'forced_power_off': {'enabled': True, 'function': 'USER_FUNC1'},
+        'low_charge': {'enabled': True, 'function': 'USER_FUNC1'},
+        'low_battery_voltage': {'enabled': True, 'function': 'USER_FUNC1'},
+    },
+    'user_functions': {'USER_FUNC1': '/bin/true'},
+}
+# injected event, dispatched event, event restoring the initial state, its dispatched event
+LATENCY_CASES = collections.OrderedDict([
+    ('button', ({'button': 'SW1', 'event': 'SINGLE_PRESS'}, 'SINGLE_PRESS', None, None)),
+    ('fault', ({'fault': 'forced_power_off'}, 'forced_power_off', None, None)),
+    ('power_loss', ({'power': False}, 'no_power', {'power': True}, 'power')),
+])
+DISPATCH_TIMEOUT = 15  # [s]
+
+
+def Summary(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        'n': len(values),
+        'mean': statistics.mean(values),
+        'min': values[0],
+        'p50': values[len(values) // 2],
+        'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+        'max': values[-1],
+    }
+
+
+class Service:
+    """ pijuice_sys driven in this process, on the simulated board """
+    def __init__(self, workDir):
+        config = os.path.join(workDir, 'pijuice_config.JSON')
+        data = json.loads(json.dumps(SERVICE_CONFIG))
+        data['system_task']['state'] = {'path': os.path.join(workDir, 'state.bin')}
+        data['system_task']['status_page'] = {'path': os.path.join(workDir, 'status.bin')}
+        with open(config, 'w') as f:
+            json.dump(data, f)
+        sys.path[:0] = [LIB_DIR, SERVICE_DIR]
+        import pijuice_sys
+        import pijuice_sim
+        self.sys = pijuice_sys
+        pijuice_sys.configPath = config
+        pijuice_sys.allowAllScripts = True
+        pijuice_sys._LoadConfiguration()
+        pijuice_sys._ConfigureScheduler()
+        pijuice_sys._ConfigureFunctionRunner()
+        pijuice_sys._OpenState()
+        if not pijuice_sys._Connect():
+            raise IOError("failed to open the simulated PiJuice")
+        pijuice_sys._OpenStatusPage()
+        self.device = pijuice_sim.Device()
+        # record dispatches instead of running functions
+        self.dispatched = []
+        pijuice_sys.ExecuteFunc = lambda func, event, param: self.dispatched.append((time.monotonic(), event))
+        events = pijuice_sys.pijuice.config.buttonEvents
+        for button in pijuice_sys.pijuice.config.buttons:
+            pijuice_sys.btConfig[button] = {e: {'function': 'NO_FUNC', 'parameter': 0} for e in events}
+        pijuice_sys.btConfig['SW1']['SINGLE_PRESS']['function'] = 'USER_FUNC1'
+        # the button check only runs while a button has a function
+        pijuice_sys._ConfigureScheduler()
+
+    def Tick(self):
+        # body of the service main loop
+        self.sys.scheduler.RunOnce()
+        self.sys._Checkpoint()
+
+    def ForceDue(self, names):
+        now = time.monotonic()
+        for name, task in self.sys.scheduler._tasks.items():
+            task['due'] = now - task['deadline'] - 1 if names is None or name in names else now + 3600
+
+
+def BenchTicks(service, count):
+    results = collections.OrderedDict()
+    for setName, names in TICK_SETS.items():
+        wall, cpu, transactions, transferred = [], [], [], []
+        for _ in range(count):
+            service.ForceDue(names)
+            before = service.device.Stats()
+            w, c = time.perf_counter(), time.process_time()
+            service.Tick()
+            wall.append(time.perf_counter() - w)
+            cpu.append(time.process_time() - c)
+            after = service.device.Stats()
+            transactions.append(after['transactions'] - before['transactions'])
+            transferred.append(after['bytesRead'] + after['bytesWritten'] - before['bytesRead'] - before['bytesWritten'])
+        # separate pass, tracing slows everything down
+        allocated, blocks = [], []
+        tracemalloc.start()
+        for _ in range(count):
+            service.ForceDue(names)
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+            startBlocks = sys.getallocatedblocks()
+            service.Tick()
+            allocated.append(tracemalloc.get_traced_memory()[1] - start)
+            blocks.append(sys.getallocatedblocks() - startBlocks)
+        tracemalloc.stop()
+        results[setName] = {
+            'wall': Summary(wall),
+            'cpu': Summary(cpu),
+            'transactions': Summary(transactions),
+            'bytes': Summary(transferred),
+            'allocatedBytes': Summary(allocated),
+            'retainedBlocks': Summary(blocks),
+        }
+    return results
+
+
+def BenchLatency(service, trials):
+    results = collections.OrderedDict()
+    done = threading.Event()
+
+    def waitDispatch(event, since):
+        end = time.monotonic() + DISPATCH_TIMEOUT
+        while time.monotonic() < end:
+            for t, e in list(service.dispatched):
+                if e == event and t >= since:
+                    return t
+            time.sleep(0.001)
+        return None
+
+    def inject():
+        try:
+            for name, (event, dispatched, restore, restored) in LATENCY_CASES.items():
+                latencies, missed = [], 0
+                for _ in range(trials):
+                    # random phase against the check periods
+                    time.sleep(random.uniform(0.1, 0.6))
+                    service.device.Inject(event)
+                    at = service.device.log[-1][0]
+                    t = waitDispatch(dispatched, at)
+                    if t is None:
+                        missed += 1
+                    else:
+                        latencies.append(t - at)
+                    if restore:
+                        service.device.Inject(restore)
+                        waitDispatch(restored, service.device.log[-1][0])
+                results[name] = {'latency': Summary(latencies), 'missed': missed}
+        finally:
+            done.set()
+
+    # back to the regular schedule after BenchTicks
+    service.ForceDue(None)
+    threading.Thread(target=inject, daemon=True).start()
+    while not done.is_set():
+        service.Tick()
+    return results
+
+
+def BenchStatus(service, count):
+    from pijuice_snapshot import SnapshotReader
+    from pijuice_statuspage import StatusPageReader
+    service.ForceDue(None)
+    service.Tick()
+    page = StatusPageReader(service.sys.statusPage.path)
+    bus = SnapshotReader(service.sys.pijuice.interface)
+    results = collections.OrderedDict()
+    for name, read in (('page', page.Read), ('bus', lambda: bus.Read(['status', 'chargeLevel', 'batteryVoltage']))):
+        wall = []
+        for _ in range(count):
+            t = time.perf_counter()
+            read()
+            wall.append(time.perf_counter() - t)
+        results[name] = {'wall': Summary(wall)}
+    page.Close()
+    return results
+
+
+def RunScript(name, args, env, stdout=subprocess.DEVNULL):
+    script = os.path.join(SCRIPTS[name], name + '.py')
+    return subprocess.run([sys.executable, script] + args, env=env, stdout=stdout, stderr=subprocess.PIPE)
+
+
+def BenchCli(env, statsPath, repeat):
+    results = collections.OrderedDict()
+    for argv in CLI_COMMANDS:
+        wall = []
+        for _ in range(repeat):
+            if os.path.exists(statsPath):
+                os.remove(statsPath)
+            t = time.perf_counter()
+            proc = RunScript(argv[0], argv[1:], env)
+            wall.append(time.perf_counter() - t)
+        stats = {}
+        if os.path.exists(statsPath):
+            with open(statsPath) as f:
+                stats = json.load(f)
+        results[' '.join(argv)] = {
+            'returncode': proc.returncode,
+            'wall': Summary(wall),
+            'transactions': stats.get('transactions'),
+            'bytesRead': stats.get('bytesRead'),
+            'bytesWritten': stats.get('bytesWritten'),
+            'registers': stats.get('registers'),
+        }
+    return results
+
+
+def BenchStartup(env, repeat):
+    code = ("import sys, time; sys.path.insert(0, %r); t = time.perf_counter(); import %s; "
+            "print(time.perf_counter() - t)")
+    results = collections.OrderedDict()
+    interpreter = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], env=env)
+        interpreter.append(time.perf_counter() - t)
+    results['interpreter'] = {'wall': Summary(interpreter)}
+    for name, directory in SCRIPTS.items():
+        imports, helps = [], []
+        for _ in range(repeat):
+            proc = subprocess.run([sys.executable, '-c', code % (directory, name)], env=env,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if proc.returncode == 0:
+                imports.append(float(proc.stdout.decode().split()[-1]))
+            t = time.perf_counter()
+            RunScript(name, ['--help'], env)
+            helps.append(time.perf_counter() - t)
+        results[name] = {'import': Summary(imports), 'help': Summary(helps)}
+    return results
+
+
+def BenchImports(env, workDir, repeat):
+    """ Returns the results and the list of failed checks """
+    config = os.path.join(workDir, 'ctl_config.JSON')
+    output = os.path.join(workDir, 'imports.JSON')
+    results = collections.OrderedDict()
+    failures = []
+    for argv, forbidden in IMPORT_CHECKS:
+        name = ' '.join(argv)
+        times, loaded = [], set()
+        for _ in range(repeat):
+            # every run starts from the same config file
+            with open(config, 'w') as f:
+                json.dump(SERVICE_CONFIG, f)
+            code = IMPORT_CHECK_CODE % {'config': config, 'argv': argv, 'output': output}
+            subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            with open(output) as f:
+                run = json.load(f)
+            os.remove(output)
+            if run['returncode'] not in (0, None):
+                failures.append("pijuice_ctl %s: exit code %s" % (name, run['returncode']))
+            times.append(run['import'])
+            loaded.update(m for m in forbidden if m in run['modules'])
+        for module in sorted(loaded):
+            failures.append("pijuice_ctl %s: loads %s" % (name, module))
+        results[name] = {'import': Summary(times), 'unexpected': sorted(loaded)}
+    return results, sorted(set(failures))
+
+
+def Compare(old, new, path=''):
+    """ Lines 'path: old -> new (change)' for all numbers in both results """
+    lines = []
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in new:
+            if key in old and key not in ('n', 'meta'):
+                lines += Compare(old[key], new[key], path + '/' + key if path else key)
+    elif isinstance(old, (int, float)) and isinstance(new, (int, float)) and not isinstance(new, bool):
+        change = "%+.1f%%" % ((new - old) * 100.0 / old) if old else "new"
+        lines.append("%s: %.6g -> %.6g (%s)" % (path, old, new, change))
+    return lines
+
+
+def GitRevision():
+    try:
+        return subprocess.check_output(['git', '-C', ROOT, 'describe', '--always', '--dirty'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pijuice benchmarks on the simulated PiJuice")
+    parser.add_argument('--only', default=','.join(SECTIONS), help="comma separated sections: %s" % ", ".join(SECTIONS))
+    parser.add_argument('--ticks', type=int, default=200, help="service loop iterations per tick set")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per command line call")
+    parser.add_argument('--trials', type=int, default=5, help="injected events per latency case")
+    parser.add_argument('--latency', type=float, default=SCENARIO['latency'], help="simulated I2C transaction time [s]")
+    parser.add_argument('--path', action='append', default=[], help="additional module directory, e.g. of pijuice.py")
+    parser.add_argument('--output', help="write the results to this file instead of stdout")
+    parser.add_argument('--compare', help="results of an earlier run to compare with")
+    args = parser.parse_args()
+    sections = [s for s in args.only.split(',') if s]
+    for section in sections:
+        if section not in SECTIONS:
+            parser.error("unknown section %s" % section)
+
+    workDir = tempfile.mkdtemp(prefix='pijuice_bench')
+    scenario = dict(SCENARIO, latency=args.latency)
+    scenarioPath = os.path.join(workDir, 'scenario.JSON')
+    with open(scenarioPath, 'w') as f:
+        json.dump(scenario, f)
+    statsPath = os.path.join(workDir, 'stats.JSON')
+    sys.path[:0] = args.path
+    os.environ['PIJUICE_SIM'] = scenarioPath
+    env = dict(os.environ, PIJUICE_SIM_STATS=statsPath,
+               PYTHONPATH=os.pathsep.join(args.path + [LIB_DIR, SCRIPTS_DIR] + [os.environ.get('PYTHONPATH', '')]))
+
+    results = collections.OrderedDict()
+    results['meta'] = {
+        'time': time.time(),
+        'revision': GitRevision(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'scenario': scenario,
+    }
+    if 'startup' in sections:
+        results['startup'] = BenchStartup(env, args.repeat)
+    if 'cli' in sections:
+        results['cli'] = BenchCli(env, statsPath, args.repeat)
+    failures = []
+    if 'imports' in sections:
+        results['imports'], failures = BenchImports(env, workDir, args.repeat)
+    if 'ticks' in sections or 'latency' in sections or 'status' in sections:
+        service = Service(workDir)
+        if 'ticks' in sections:
+            results['ticks'] = BenchTicks(service, args.ticks)
+        if 'latency' in sections:
+            results['latency'] = BenchLatency(service, args.trials)
+        if 'status' in sections:
+            results['status'] = BenchStatus(service, args.ticks)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        for line in Compare(previous, results):
+            sys.stderr.write(line + '\n')
+    for line in failures:
+        sys.stderr.write("FAILED %s\n" % line)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Serialized access to the PiJuice I2C interface.
+
+PiJuiceInterface keeps the state of a transfer on the instance and is not
+safe to use from several threads, and transfers of different processes
+must not interleave either. BusArbiter grants the bus to one transfer at
+a time: within a process waiting threads are served in the order of their
+priority (lower value first), between processes an flock() on
+BUS_LOCK_PATH is held for the duration of each transfer.
+
+Priorities: power and watchdog traffic go ahead of telemetry, telemetry
+goes ahead of command line tools.
+"""
+import contextlib
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+BUS_LOCK_PATH = '/tmp/pijuice_bus.lock'
+BUS_LOCK_TIMEOUT = 1  # [s] before a transfer gives up waiting for another process
+
+PRIORITY_WATCHDOG = 0
+PRIORITY_POWER = 0
+PRIORITY_TELEMETRY = 10
+PRIORITY_CLI = 20
+PRIORITY_DEFAULT = PRIORITY_TELEMETRY
+PRIORITY_NAMES = {PRIORITY_POWER: 'power', PRIORITY_TELEMETRY: 'telemetry', PRIORITY_CLI: 'cli'}
+
+
+class BusArbiter:
+    def __init__(self, lockPath=None, lockTimeout=BUS_LOCK_TIMEOUT):
+        self.lockPath = lockPath
+        self.lockTimeout = lockTimeout
+        self._lockFd = None
+        self._cond = threading.Condition()
+        self._owner = None
+        self._depth = 0
+        self._waiting = []
+        self._seq = itertools.count()
+        self._local = threading.local()
+        self._stats = {}
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def SetThreadPriority(self, priority):
+        """ Priority of all transfers made by the calling thread """
+        self._local.priority = priority
+
+    @contextlib.contextmanager
+    def Priority(self, priority):
+        """ Temporarily changes the priority of the calling thread """
+        previous = getattr(self._local, 'priority', None)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def Acquire(self, priority=None, timeout=None):
+        """
+        Returns False if another process kept the bus longer than 'timeout'
+        (default lockTimeout, negative waits forever).
+        """
+        if priority is None:
+            priority = getattr(self._local, 'priority', None)
+            if priority is None:
+                priority = PRIORITY_DEFAULT
+        me = threading.get_ident()
+        start = time.monotonic()
+        with self._cond:
+            if self._owner == me:
+                self._depth += 1
+                return True
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            while self._owner is not None or self._waiting[0] != ticket:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._owner = me
+            self._depth = 1
+        try:
+            locked = self._LockProcess(self.lockTimeout if timeout is None else timeout)
+        except OSError as e:
+            # without the lock file transfers are still serialized within this process
+            self.logger.warning("bus lock %s unusable, locking within this process only: %s", self.lockPath, e)
+            self._DropProcessLock()
+            locked = True
+        except BaseException:
+            self._Leave()
+            raise
+        if not locked:
+            self._Record(priority, time.monotonic() - start, timedOut=True)
+            self._Leave()
+            return False
+        self._Record(priority, time.monotonic() - start)
+        return True
+
+    def Release(self):
+        with self._cond:
+            self._depth -= 1
+            if self._depth > 0:
+                return
+        if self._lockFd is not None:
+            fcntl.flock(self._lockFd, fcntl.LOCK_UN)
+        self._Leave()
+
+    def Stats(self):
+        """ Wait times per priority class """
+        stats = {}
+        with self._cond:
+            for priority, s in sorted(self._stats.items()):
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                stats[name] = dict(s, waitMean=s['waitSum'] / s['count'])
+        return stats
+
+    def Attach(self, interface):
+        """ Routes all transfers of 'interface' through the arbiter """
+        for name in ('ReadData', 'WriteData', 'WriteDataVerify'):
+            method = getattr(interface, name, None)
+            if method is not None:
+                setattr(interface, name, self._Wrap(method))
+        return interface
+
+    def _Wrap(self, method):
+        def locked(*args, **kwargs):
+            if not self.Acquire():
+                return {'error': 'BUS_LOCK_TIMEOUT'}
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.Release()
+        return locked
+
+    def _Leave(self):
+        with self._cond:
+            self._owner = None
+            self._depth = 0
+            self._cond.notify_all()
+
+    def _LockProcess(self, timeout):
+        if self.lockPath is None:
+            return True
+        if self._lockFd is None:
+            self._lockFd = os.open(self.lockPath, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                # not limited by the umask: the service runs as root, the tools may not
+                os.fchmod(self._lockFd, 0o666)
+            except OSError:
+                pass  # created by another user, its mode is theirs to set
+        end = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(self._lockFd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if timeout >= 0 and time.monotonic() >= end:
+                return False
+            # transfers are short, a few ms of polling keeps this simple
+            time.sleep(0.002)
+
+    def _DropProcessLock(self):
+        if self._lockFd is not None:
+            try:
+                os.close(self._lockFd)
+            except OSError:
+                pass
+        self._lockFd = None
+        self.lockPath = None
+
+    def _Record(self, priority, wait, timedOut=False):
+        with self._cond:
+            s = self._stats.setdefault(priority, {'count': 0, 'waitSum': 0.0, 'waitMax': 0.0, 'timeouts': 0})
+            s['count'] += 1
+            s['waitSum'] += wait
+            s['waitMax'] = max(s['waitMax'], wait)
+            if timedOut:
+                s['timeouts'] += 1
+
+
+def ShareBus(pijuice, priority=PRIORITY_CLI, lockPath=BUS_LOCK_PATH):
+    """ Coordinates the transfers of a PiJuice instance with the other processes """
+    arbiter = BusArbiter(lockPath)
+    arbiter.SetThreadPriority(priority)
+    arbiter.Attach(pijuice.interface)
+    return arbiter
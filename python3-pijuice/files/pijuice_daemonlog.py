@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Logging setup of the pijuice service.
+
+Messages are rate limited per key (logger, level, message template and
+arguments): at most LOG_BURST identical messages pass within LOG_INTERVAL
+seconds, the rest are counted and reported once as "... [repeated N
+times]". The loggers ask the rate limit before they build a record, a
+suppressed call costs a dictionary lookup, and messages are only
+formatted when a handler actually emits them. Besides the console, the
+last LOG_RING_SIZE records are kept in memory and can be fetched over the
+query socket.
+"""
+import collections
+import logging
+import threading
+import time
+
+LOG_BURST = 3
+LOG_INTERVAL = 60  # [s]
+LOG_RING_SIZE = 500
+LOG_FORMAT = "%(asctime)s %(levelname)-6s: %(message)s"
+
+
+class RateLimit:
+    def __init__(self, burst=LOG_BURST, interval=LOG_INTERVAL):
+        self.burst = burst
+        self.interval = interval
+        self._keys = {}  # key -> [window start, passed, suppressed, logger, level, msg, args]
+        self._lock = threading.Lock()
+
+    def Allow(self, logger, level, msg, args):
+        """
+        Returns whether the call may be logged and the summary record of the
+        previous window of the same message, if it suppressed any
+        """
+        key = (logger.name, level, msg, args)
+        try:
+            hash(key)
+        except TypeError:
+            key = (logger.name, level, msg, repr(args))
+        now = time.time()
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None or now - state[0] >= self.interval:
+                self._keys[key] = [now, 1, 0, logger, level, msg, args]
+                return True, _Summary(state) if state and state[2] else None
+            if state[1] < self.burst:
+                state[1] += 1
+                return True, None
+            state[2] += 1
+            return False, None
+
+    def Flush(self, now=None):
+        """
+        Returns the loggers and summary records of keys whose window ended
+        with suppressed messages and forgets idle keys.
+        """
+        now = time.time() if now is None else now
+        summaries = []
+        with self._lock:
+            for key, state in list(self._keys.items()):
+                if now - state[0] < self.interval:
+                    continue
+                if state[2]:
+                    summaries.append((state[3], _Summary(state)))
+                del self._keys[key]
+        return summaries
+
+
+def _Summary(state):
+    _, _, suppressed, logger, level, msg, args = state
+    record = logger.makeRecord(logger.name, level, "(rate limit)", 0, msg, args, None)
+    record.msg = "%s [repeated %d times]" % (record.getMessage(), suppressed)
+    record.args = None
+    return record
+
+
+class RateLimitedLogger(logging.Logger):
+    """ Drops rate limited calls before a record is built """
+    rateLimit = None  # set by DaemonLogging
+
+    def _log(self, level, msg, args, exc_info=None, extra=None, stack_info=False, stacklevel=1):
+        if self.rateLimit is not None:
+            allow, summary = self.rateLimit.Allow(self, level, msg, args)
+            if summary is not None:
+                self.handle(summary)
+            if not allow:
+                return
+        # one more frame to skip to find the caller
+        super()._log(level, msg, args, exc_info, extra, stack_info, stacklevel + 1)
+
+
+class RateLimitedRootLogger(RateLimitedLogger, logging.RootLogger):
+    pass
+
+
+class RingHandler(logging.Handler):
+    """ Keeps the last records in memory, they are formatted when read """
+    def __init__(self, size=LOG_RING_SIZE):
+        super().__init__()
+        self.records = collections.deque(maxlen=size)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def Lines(self, level=logging.NOTSET, count=None):
+        records = [r for r in self.records if r.levelno >= level]
+        if count:
+            records = records[-count:]
+        return [self.format(r) for r in records]
+
+
+class DaemonLogging:
+    def __init__(self, level=logging.INFO, fmt=LOG_FORMAT, ringSize=LOG_RING_SIZE,
+                 burst=LOG_BURST, interval=LOG_INTERVAL):
+        self.rateLimit = RateLimit(burst, interval)
+        RateLimitedLogger.rateLimit = self.rateLimit
+        # loggers created from now on are rate limited, the root logger and the ones that exist already are converted
+        logging.setLoggerClass(RateLimitedLogger)
+        root = logging.getLogger()
+        root.__class__ = RateLimitedRootLogger
+        for logger in list(logging.Logger.manager.loggerDict.values()):
+            if type(logger) is logging.Logger:
+                logger.__class__ = RateLimitedLogger
+        self.console = logging.StreamHandler()
+        self.console.setLevel(level)
+        self.ring = RingHandler(ringSize)
+        # the ring also keeps debug messages for 'pijuice_ctl log'
+        self.ring.setLevel(logging.DEBUG)
+        formatter = logging.Formatter(fmt)
+        for handler in (self.console, self.ring):
+            handler.setFormatter(formatter)
+            root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+
+    def Flush(self):
+        for logger, record in self.rateLimit.Flush():
+            logger.handle(record)
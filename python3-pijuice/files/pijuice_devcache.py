@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of the button and LED configuration stored on the PiJuice.
+
+Reading the configuration of all buttons costs several multi-byte I2C
+transfers per button. The cache keeps the last read configuration keyed by
+board address, firmware version and board identity in a small JSON file
+shared by pijuice_sys and pijuice_ctl. It lives next to the configuration,
+/tmp does not survive a reboot. Writes through CachedDeviceConfig
+invalidate the affected entry, a different key drops all.
+
+The board identity is the UUID of the HAT ID EEPROM the Pi firmware reads
+at boot. Without one, a swapped board with the same firmware looks the
+same, so the first cached entry a CachedDeviceConfig would answer is read
+back from the device once and a mismatch drops the cache.
+"""
+import json
+import os
+
+DEVICE_CACHE_PATH = '/etc/pijuice/pijuice_device_cache.JSON'
+HAT_UUID_PATH = '/proc/device-tree/hat/uuid'
+
+
+class DeviceConfigCache:
+    def __init__(self, path=DEVICE_CACHE_PATH):
+        self.path = path
+        self._data = None
+        self._stat = None
+
+    def Get(self, kind, name, address, firmware, board=None):
+        data = self._Load()
+        if data.get('address') != address or data.get('firmware') != firmware or data.get('board') != board:
+            return None
+        return data.get(kind, {}).get(name)
+
+    def Put(self, kind, name, address, firmware, config, board=None):
+        data = self._Load()
+        if data.get('address') != address or data.get('firmware') != firmware or data.get('board') != board:
+            data = {'address': address, 'firmware': firmware, 'board': board}
+        data.setdefault(kind, {})[name] = config
+        self._Save(data)
+
+    def Invalidate(self, kind, name):
+        data = self._Load()
+        if name in data.get(kind, {}):
+            del data[kind][name]
+            self._Save(data)
+
+    def Clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self._data = None
+        self._stat = None
+
+    def _Load(self):
+        # re-read only when another process replaced the file
+        try:
+            st = os.stat(self.path)
+            key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            return {}
+        if self._data is None or key != self._stat:
+            try:
+                with open(self.path, 'r') as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError):
+                self._data = {}
+            self._stat = key
+        return self._data
+
+    def _Save(self, data):
+        # like SaveSettings: a synced temporary file renamed over the cache, never a partial file after a power cut
+        import tempfile
+        directory = os.path.dirname(self.path) or '.'
+        try:
+            fd, tmpPath = tempfile.mkstemp(dir=directory, prefix='.pijuice_device_cache.')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.chmod(tmpPath, 0o644)
+                os.replace(tmpPath, self.path)
+            except:
+                os.remove(tmpPath)
+                raise
+            dirFd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dirFd)
+            finally:
+                os.close(dirFd)
+            st = os.stat(self.path)
+            self._stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            self._stat = None
+        self._data = data
+
+
+def BoardIdentity(path=HAT_UUID_PATH):
+    """ UUID of the HAT ID EEPROM, None if the firmware found no HAT EEPROM """
+    try:
+        with open(path, 'rb') as f:
+            return f.read().rstrip(b'\0').decode('ascii') or None
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+class CachedDeviceConfig:
+    """
+    Button and LED configuration accessors of PiJuiceConfig answered from
+    the cache where possible. Without a known firmware version every call
+    goes to the device. 'firmware' is the version string ('1.5') or the
+    packed int used by pijuice_ctl (0x15).
+    """
+    def __init__(self, pijuice, firmware, cache=None, board=None):
+        self._pijuice = pijuice
+        self.address = "0x%x" % pijuice.interface.GetAddress()
+        if isinstance(firmware, int):
+            firmware = "%d.%d" % (firmware >> 4, firmware & 15) if firmware else None
+        self.firmware = firmware
+        self.board = board or BoardIdentity()
+        # without a board identity the cache is checked against the device once
+        self._verified = self.board is not None
+        self.cache = cache or DeviceConfigCache()
+
+    def GetButtonConfiguration(self, button):
+        return self._Get('buttons', button, self._pijuice.config.GetButtonConfiguration)
+
+    def SetButtonConfiguration(self, button, config):
+        self.cache.Invalidate('buttons', button)
+        return self._pijuice.config.SetButtonConfiguration(button, config)
+
+    def GetLedConfiguration(self, led):
+        return self._Get('leds', led, self._pijuice.config.GetLedConfiguration)
+
+    def SetLedConfiguration(self, led, config):
+        self.cache.Invalidate('leds', led)
+        return self._pijuice.config.SetLedConfiguration(led, config)
+
+    def _Get(self, kind, name, read):
+        config = None
+        if self.firmware:
+            config = self.cache.Get(kind, name, self.address, self.firmware, self.board)
+            if config is not None and self._verified:
+                return {'data': config, 'error': 'NO_ERROR'}
+        ret = read(name)
+        if ret['error'] == 'NO_ERROR' and self.firmware:
+            # compared as stored, the device may answer with tuples
+            data = json.loads(json.dumps(ret['data']))
+            if config is not None:
+                self._verified = True
+                if config != data:
+                    # another board with the same firmware, none of the entries apply
+                    self.cache.Clear()
+            if config != data:
+                self.cache.Put(kind, name, self.address, self.firmware, ret['data'], self.board)
+        return ret
@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Fixed size ring buffer of battery telemetry samples.
+
+The buffer is a memory mapped binary file: a small header followed by
+'capacity' fixed size records. pijuice_sys is the only writer, readers
+map the same file read-only. Memory use is constant and appending a
+sample does not allocate.
+
+The header carries a sequence counter: the writer makes it odd, writes the
+record and the new position and makes it even again. Readers copy the
+file between two equal even reads of the counter, so they never see a
+position that does not match the records.
+"""
+import collections
+import mmap
+import os
+import struct
+import time
+
+from pijuice_snapshot import BATTERY_STATUS, POWER_IN_STATUS
+
+HISTORY_PATH = '/tmp/pijuice_history.bin'
+HISTORY_CAPACITY = 8640  # 24h at a 10s period
+HISTORY_MAGIC = b'PJHS'
+HISTORY_VERSION = 2
+READ_RETRIES = 100
+
+# magic, version, record size, capacity
+HEADER = struct.Struct('<4sHHI')
+SEQUENCE = struct.Struct('<I')
+SEQUENCE_OFFSET = HEADER.size
+# next write index, number of records
+POSITION = struct.Struct('<II')
+POSITION_OFFSET = SEQUENCE_OFFSET + SEQUENCE.size
+HEADER_SIZE = POSITION_OFFSET + POSITION.size
+# time, charge level, power status, battery temperature, battery voltage,
+# battery current, io voltage, io current
+RECORD = struct.Struct('<dBBbHhHh')
+
+UNKNOWN_U8 = 0xff
+UNKNOWN_S8 = -0x80
+UNKNOWN_U16 = 0xffff
+UNKNOWN_S16 = -0x8000
+
+Sample = collections.namedtuple('Sample', ['time', 'chargeLevel', 'battery', 'powerInput', 'powerInput5vIo',
+                                           'batteryTemperature', 'batteryVoltage', 'batteryCurrent',
+                                           'ioVoltage', 'ioCurrent'])
+
+
+class HistoryStore:
+    """ Writer side of the ring buffer """
+    def __init__(self, path=HISTORY_PATH, capacity=HISTORY_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        size = HEADER_SIZE + capacity * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        if HEADER.unpack_from(self._map, 0) != (HISTORY_MAGIC, HISTORY_VERSION, RECORD.size, capacity):
+            SEQUENCE.pack_into(self._map, SEQUENCE_OFFSET, 0)
+            POSITION.pack_into(self._map, POSITION_OFFSET, 0, 0)
+            HEADER.pack_into(self._map, 0, HISTORY_MAGIC, HISTORY_VERSION, RECORD.size, capacity)
+        # an odd counter left by a writer that died during an append is made even
+        self._seq = (SEQUENCE.unpack_from(self._map, SEQUENCE_OFFSET)[0] + 1) & ~1 & 0xffffffff
+        SEQUENCE.pack_into(self._map, SEQUENCE_OFFSET, self._seq)
+        self._head, self._count = POSITION.unpack_from(self._map, POSITION_OFFSET)
+
+    def Append(self, snapshot):
+        s = snapshot
+        if s.battery is not None:
+            power = (BATTERY_STATUS.index(s.battery)
+                     | POWER_IN_STATUS.index(s.powerInput) << 2
+                     | POWER_IN_STATUS.index(s.powerInput5vIo) << 4)
+        else:
+            power = UNKNOWN_U8
+        self._seq = (self._seq + 1) & 0xffffffff
+        SEQUENCE.pack_into(self._map, SEQUENCE_OFFSET, self._seq)
+        RECORD.pack_into(self._map, HEADER_SIZE + self._head * RECORD.size, s.time,
+                         _Value(s.chargeLevel, UNKNOWN_U8), power,
+                         _Value(s.batteryTemperature, UNKNOWN_S8),
+                         _Value(s.batteryVoltage, UNKNOWN_U16), _Value(s.batteryCurrent, UNKNOWN_S16),
+                         _Value(s.ioVoltage, UNKNOWN_U16), _Value(s.ioCurrent, UNKNOWN_S16))
+        self._head = (self._head + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+        POSITION.pack_into(self._map, POSITION_OFFSET, self._head, self._count)
+        self._seq = (self._seq + 1) & 0xffffffff
+        SEQUENCE.pack_into(self._map, SEQUENCE_OFFSET, self._seq)
+
+    def Close(self):
+        self._map.close()
+
+
+class HistoryReader:
+    def __init__(self, path=HISTORY_PATH):
+        self.path = path
+
+    def Samples(self, start=None, end=None):
+        """ Samples within [start, end] (epoch seconds), oldest first """
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                magic, version, recordSize, capacity = HEADER.unpack_from(m, 0)
+                if (magic != HISTORY_MAGIC or version != HISTORY_VERSION or recordSize != RECORD.size
+                        or len(m) < HEADER_SIZE + capacity * RECORD.size):
+                    raise ValueError("not a pijuice history file: %s" % self.path)
+                data = _Copy(m)
+        if data is None:
+            raise IOError("pijuice history file is busy: %s" % self.path)
+        head, count = POSITION.unpack_from(data, POSITION_OFFSET)
+        first = (head - count) % capacity
+        samples = []
+        for i in range(count):
+            record = RECORD.unpack_from(data, HEADER_SIZE + ((first + i) % capacity) * RECORD.size)
+            if start is not None and record[0] < start:
+                continue
+            if end is not None and record[0] > end:
+                break
+            samples.append(_Sample(record))
+        return samples
+
+    def Follow(self, start=None, interval=1):
+        """ Yields the stored samples and then new ones as they are appended """
+        last = start
+        while True:
+            for sample in self.Samples(start=last):
+                if last is not None and sample.time <= last:
+                    continue
+                last = sample.time
+                yield sample
+            time.sleep(interval)
+
+
+def Downsample(samples, step):
+    """ Averages samples into buckets of 'step' seconds """
+    bucket = []
+    bucketStart = None
+    for sample in samples:
+        if bucketStart is not None and sample.time - bucketStart >= step:
+            yield _Average(bucket)
+            bucket = []
+        if not bucket:
+            bucketStart = sample.time
+        bucket.append(sample)
+    if bucket:
+        yield _Average(bucket)
+
+
+def _Copy(m):
+    # a consistent copy of the file, None if the writer did not finish an append in time
+    for _ in range(READ_RETRIES):
+        seq = SEQUENCE.unpack_from(m, SEQUENCE_OFFSET)[0]
+        if not seq & 1:
+            data = m[:]
+            if SEQUENCE.unpack_from(m, SEQUENCE_OFFSET)[0] == seq:
+                return data
+        time.sleep(0.001)
+    return None
+
+def _Value(value, unknown):
+    return unknown if value is None else value
+
+def _Known(value, unknown):
+    return None if value == unknown else value
+
+def _Sample(record):
+    t, charge, power, temp, bv, bc, iov, ioc = record
+    if power == UNKNOWN_U8:
+        battery = powerInput = powerInput5vIo = None
+    else:
+        battery = BATTERY_STATUS[power & 0x03]
+        powerInput = POWER_IN_STATUS[(power >> 2) & 0x03]
+        powerInput5vIo = POWER_IN_STATUS[(power >> 4) & 0x03]
+    return Sample(t, _Known(charge, UNKNOWN_U8), battery, powerInput, powerInput5vIo,
+                  _Known(temp, UNKNOWN_S8), _Known(bv, UNKNOWN_U16), _Known(bc, UNKNOWN_S16),
+                  _Known(iov, UNKNOWN_U16), _Known(ioc, UNKNOWN_S16))
+
+def _Average(bucket):
+    # numeric fields are averaged, status fields taken from the last sample
+    values = {}
+    for field in ('chargeLevel', 'batteryTemperature', 'batteryVoltage', 'batteryCurrent', 'ioVoltage', 'ioCurrent'):
+        known = [getattr(s, field) for s in bucket if getattr(s, field) is not None]
+        values[field] = round(sum(known) / len(known)) if known else None
+    last = bucket[-1]
+    return last._replace(time=bucket[0].time, **values)
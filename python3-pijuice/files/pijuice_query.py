@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Local query socket of the pijuice service.
+
+pijuice_sys serves cached status, configuration and firmware version on a
+Unix domain socket so that the command line tools do not have to open the
+I2C bus themselves while the service is running.
+
+Protocol: one request per connection, a single JSON object terminated by a
+newline ({"cmd": "status", "fields": [...]}), answered by a single JSON
+object with the usual 'error'/'data' keys.
+"""
+import json
+import logging
+import os
+import selectors
+import socket
+
+from pijuice_snapshot import StatusSnapshot
+
+SOCKET_PATH = '/tmp/pijuice_sys.sock'
+MAX_REQUEST = 4096
+
+
+class QueryServer:
+    def __init__(self, handler, path=SOCKET_PATH):
+        self.handler = handler
+        self.path = path
+        self._selector = None
+        self._sock = None
+        self._buffers = {}
+
+    def Register(self, selector):
+        if os.path.exists(self.path):
+            os.remove(self.path)  # left over from a previous instance
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(8)
+        self._sock.setblocking(False)
+        self._selector = selector
+        selector.register(self._sock, selectors.EVENT_READ, self._Accept)
+
+    def Close(self):
+        for conn in list(self._buffers):
+            self._CloseConnection(conn)
+        if self._sock:
+            self._selector.unregister(self._sock)
+            self._sock.close()
+            self._sock = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def _Accept(self, sock, mask):
+        try:
+            conn, _ = sock.accept()
+        except OSError:
+            return
+        conn.setblocking(False)
+        self._buffers[conn] = bytearray()
+        self._selector.register(conn, selectors.EVENT_READ, self._Read)
+
+    def _Read(self, conn, mask):
+        try:
+            data = conn.recv(MAX_REQUEST)
+        except OSError:
+            data = b''
+        if not data:
+            self._CloseConnection(conn)
+            return
+        buf = self._buffers[conn]
+        buf += data
+        if b'\n' not in buf and len(buf) < MAX_REQUEST:
+            return  # wait for the rest of the request
+        try:
+            request = json.loads(buf.split(b'\n', 1)[0].decode('utf-8'))
+            response = self.handler(request)
+        except ValueError:
+            response = {'error': 'BAD_REQUEST'}
+        except: # pylint: disable=bare-except
+            logging.exception("query failed")
+            response = {'error': 'INTERNAL_ERROR'}
+        try:
+            # responses are small, a short blocking send keeps the loop simple
+            conn.settimeout(1)
+            conn.sendall(json.dumps(response).encode('utf-8') + b'\n')
+        except OSError:
+            pass
+        self._CloseConnection(conn)
+
+    def _CloseConnection(self, conn):
+        self._buffers.pop(conn, None)
+        try:
+            self._selector.unregister(conn)
+        except (KeyError, ValueError):
+            pass
+        conn.close()
+
+
+class QueryClient:
+    """
+    Client side of the query socket. Raises OSError when the service is not
+    running, callers are expected to fall back to direct I2C access then.
+    """
+    def __init__(self, path=SOCKET_PATH, timeout=2):
+        self.path = path
+        self.timeout = timeout
+
+    def Request(self, cmd, **args):
+        request = dict(args, cmd=cmd)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            buf = bytearray()
+            while b'\n' not in buf:
+                data = sock.recv(MAX_REQUEST)
+                if not data:
+                    break
+                buf += data
+        try:
+            return json.loads(buf.decode('utf-8'))
+        except ValueError:
+            return {'error': 'BAD_RESPONSE'}
+
+    def GetStatus(self, fields=None):
+        ret = self.Request('status', fields=list(fields) if fields else None)
+        if 'data' in ret:
+            ret['data'] = StatusSnapshot.FromDict(ret['data'])
+        return ret
+
+    def GetConfig(self):
+        return self.Request('config')
+
+    def GetFirmwareVersion(self):
+        return self.Request('firmware')
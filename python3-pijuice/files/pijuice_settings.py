@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Shared loader of the pijuice service configuration.
+
+pijuice_config.JSON is parsed once into a Settings object with the
+derived enable flags, thresholds and the event -> function table already
+resolved. Loads are memoized on (inode, mtime, size) of the file, so
+repeated loads within a process only cost a stat(). SaveSettings() replaces
+the file atomically.
+"""
+import json
+import os
+
+CONFIG_PATH = '/etc/pijuice/pijuice_config.JSON'
+DEFAULT_CONFIG = {'system_task': {'enabled': False}}
+I2C_ADDRESS_DEFAULT = 0x14
+I2C_BUS_DEFAULT = 1
+EXT_HALT_POWER_OFF_PERIOD_DEFAULT = 30
+SIM_ENV = 'PIJUICE_SIM'  # selects the simulated board, see pijuice_sim
+
+_cache = {}
+
+
+class Settings:
+    def __init__(self, data, previous=None):
+        self.data = data
+        # top level sections that differ from the previous load
+        if previous is None:
+            self.changed = set(data)
+        else:
+            sections = set(data) | set(previous.data)
+            self.changed = {s for s in sections if data.get(s) != previous.data.get(s)}
+
+        systemTask = data.get('system_task', {})
+        self.serviceEnabled = bool(systemTask.get('enabled'))
+        minCharge = systemTask.get('min_charge', {})
+        self.minChgEn = minCharge.get('enabled', False)
+        self.minChgThreshold = _Float(minCharge.get('threshold'))
+        minBatVoltage = systemTask.get('min_bat_voltage', {})
+        self.minBatVolEn = minBatVoltage.get('enabled', False)
+        self.minBatVolThreshold = _Float(minBatVoltage.get('threshold'))
+        watchdog = systemTask.get('watchdog', {})
+        self.watchdogEn = self.serviceEnabled and watchdog.get('enabled', False)
+        self.watchdogPeriod = _Int(watchdog.get('period'))
+        self.watchdogKickInterval = _Float(watchdog.get('kick_interval'))
+        wakeup = systemTask.get('wakeup_on_charge', {})
+        self.wakeupOnChargeEn = wakeup.get('enabled', False)
+        self.wakeupTriggerLevel = _Float(wakeup.get('trigger_level'))
+        extHalt = systemTask.get('ext_halt_power_off', {})
+        self.extHaltPowerOffEn = extHalt.get('enabled', False)
+        self.extHaltPowerOffPeriod = _Int(extHalt.get('period', EXT_HALT_POWER_OFF_PERIOD_DEFAULT))
+        history = systemTask.get('history', {})
+        self.historyEn = history.get('enabled', False)
+        self.historyPath = history.get('path')
+        self.historyCapacity = _Int(history.get('capacity'))
+        self.schedule = systemTask.get('schedule', {})
+        self.statePath = systemTask.get('state', {}).get('path')
+        self.statusPagePath = systemTask.get('status_page', {}).get('path')
+        shutdown = systemTask.get('shutdown', {})
+        self.shutdownBudget = _Float(shutdown.get('budget'))
+        self.shutdownPowerOffDelay = _Int(shutdown.get('power_off_delay'))
+        self.shutdownHooks = list(shutdown.get('hooks', []))
+        stats = systemTask.get('stats', {})
+        self.statsDumpPath = stats.get('dump_path')
+        self.statsDumpInterval = _Float(stats.get('dump_interval'))
+        bus = systemTask.get('bus', {})
+        self.busRetries = _Int(bus.get('retries'))
+        self.busBackoff = _Float(bus.get('backoff'))
+        self.busBreakerThreshold = _Int(bus.get('breaker_threshold'))
+        self.busBreakerTime = _Float(bus.get('breaker_time'))
+        functions = systemTask.get('functions', {})
+        self.functionWorkers = _Int(functions.get('workers'))
+        self.functionTimeout = _Float(functions.get('timeout'))
+        self.functionTimeouts = {}
+        for name, timeout in functions.get('timeouts', {}).items():
+            if _Float(timeout) is not None:
+                self.functionTimeouts[name] = _Float(timeout)
+
+        # event -> function of all enabled events
+        self.sysEvEn = 'system_events' in data
+        self.eventFunctions = {}
+        for event, conf in data.get('system_events', {}).items():
+            if conf.get('enabled', False) and 'function' in conf:
+                self.eventFunctions[event] = conf['function']
+        self.lowChgEn = 'low_charge' in self.eventFunctions
+        self.lowBatVolEn = 'low_battery_voltage' in self.eventFunctions
+        self.noPowEn = 'no_power' in self.eventFunctions
+        self.PowEn = 'power' in self.eventFunctions
+        self.sysStartEvEn = 'sys_start' in self.eventFunctions
+        self.sysStopEvEn = 'sys_stop' in self.eventFunctions
+        self.userFunctions = data.get('user_functions', {})
+
+        # simulated board, see pijuice_sim
+        simulation = data.get('simulation', {})
+        self.simulation = simulation if simulation.get('enabled', False) else None
+
+        general = data.get('board', {}).get('general', {})
+        self.i2cBus = general.get('i2c_bus', I2C_BUS_DEFAULT)
+        try:
+            self.i2cAddr = int(general['i2c_addr'], 16) if 'i2c_addr' in general else I2C_ADDRESS_DEFAULT
+        except (TypeError, ValueError):
+            self.i2cAddr = I2C_ADDRESS_DEFAULT
+
+
+def LoadSettings(path=CONFIG_PATH):
+    """
+    Returns the Settings of 'path'. The file is only parsed again when its
+    inode, mtime or size changed since the last load. Raises ValueError if
+    the file is not a valid configuration.
+    """
+    st = os.stat(path)
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    cached = _cache.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    data = json.loads(json.dumps(DEFAULT_CONFIG))
+    with open(path, 'r') as configFile:
+        loaded = json.load(configFile)
+    if not isinstance(loaded, dict):
+        raise ValueError("%s: configuration is not a JSON object" % path)
+    data.update(loaded)
+    try:
+        settings = Settings(data, cached[1] if cached else None)
+    except (AttributeError, TypeError) as e:
+        # a section of the wrong type, e.g. a list where an object is expected
+        raise ValueError("%s: invalid configuration: %s" % (path, e))
+    _cache[path] = (key, settings)
+    return settings
+
+def InvalidateSettings(path=CONFIG_PATH):
+    _cache.pop(path, None)
+
+def SimulationSelected(settings=None):
+    """
+    Whether PIJUICE_SIM or the 'simulation' section of 'settings' (default:
+    the configuration file) selects the simulated board. Only then the
+    pijuice_sim module needs to be imported.
+    """
+    value = os.environ.get(SIM_ENV)
+    if value is not None:
+        return value not in ('', '0')
+    if settings is None:
+        try:
+            settings = LoadSettings(CONFIG_PATH)
+        except (OSError, ValueError):
+            return False
+    return settings.simulation is not None
+
+def SaveSettings(data, path=CONFIG_PATH):
+    """
+    Writes the configuration to a temporary file in the same directory,
+    syncs it and renames it over 'path', so readers never see a partial file.
+    """
+    # only needed when writing, pijuice_ctl commands that just read start faster without it
+    import tempfile
+    directory = os.path.dirname(path) or '.'
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except OSError:
+        mode = 0o644
+    fd, tmpPath = tempfile.mkstemp(dir=directory, prefix='.pijuice_config.')
+    try:
+        with os.fdopen(fd, 'w') as outputConfig:
+            json.dump(data, outputConfig, indent=2)
+            outputConfig.flush()
+            os.fsync(outputConfig.fileno())
+        os.chmod(tmpPath, mode)
+        os.rename(tmpPath, path)
+    except:
+        os.remove(tmpPath)
+        raise
+    dirFd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dirFd)
+    finally:
+        os.close(dirFd)
+
+def MergePatch(target, patch):
+    """ Applies a JSON merge patch (RFC 7386), None values remove keys """
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = MergePatch(target.get(key), value)
+    return target
+
+
+def _Float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _Int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
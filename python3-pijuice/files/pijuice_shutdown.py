@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Shutdown coordinator of the pijuice service.
+
+Everything a halt needs is resolved when the configuration is loaded
+(Arm): power off delay, wakeup on charge level, LED pattern and the pre
+halt hooks. Run() then only starts the hooks, writes the prepared
+registers and halts.
+
+The hooks run in parallel and are killed when the time budget is used up.
+The power off delay is written before the hooks start, extended by the
+budget, so the board cuts the power even if the halt never happens. It is
+written again with the plain delay right before the halt, which then gets
+the whole window.
+"""
+import logging
+import math
+import os
+import signal
+import subprocess
+import time
+
+SHUTDOWN_BUDGET = 5  # [s] for the pre halt hooks
+POWER_OFF_DELAY = 60  # [s]
+POWER_OFF_DELAY_MAX = 255  # [s] largest delay of the power off register
+LED_HALT = ('D2', 3, [150, 0, 0], 200, [0, 100, 0], 200)
+HALT_COMMAND = ['sudo', 'halt']
+HOOK_EVENT = 'pre_halt'
+
+
+class ShutdownCoordinator:
+    def __init__(self, haltFile, haltCommand=HALT_COMMAND):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.haltFile = haltFile
+        self.haltCommand = haltCommand
+        self.halting = False
+        self.report = None
+        self.budget = SHUTDOWN_BUDGET
+        self.powerOffDelay = POWER_OFF_DELAY
+        self.wakeupLevel = None
+        self.led = LED_HALT
+        self._hooks = ()
+        self._authorize = None
+
+    def Arm(self, budget=None, powerOffDelay=None, wakeupLevel=None, hooks=(), authorize=None):
+        """
+        'hooks' are user function names, 'authorize' returns the argv of one
+        or None. Resolving them here keeps the script checks cached.
+        """
+        self.budget = SHUTDOWN_BUDGET if budget is None else budget
+        self.powerOffDelay = _Delay(POWER_OFF_DELAY if powerOffDelay is None else powerOffDelay)
+        self.wakeupLevel = wakeupLevel
+        self._hooks = tuple(hooks)
+        self._authorize = authorize
+        for name in self._hooks:
+            if authorize(name) is None:
+                self.logger.error("pre halt hook %s is not executable", name)
+
+    def Run(self, pijuice, reason, powerOff=None, switchOff=False, wakeup=False):
+        """
+        Halts the system. 'powerOff' is the delay [s] after which the board
+        cuts the power (True for the armed delay), 'switchOff' turns the
+        system power switch off, 'wakeup' enables wakeup on charge.
+        Returns the report with the duration of every stage. A failed halt
+        command ends the halt, later requests are handled again.
+        """
+        if self.halting:
+            self.logger.warning("halt for %s ignored, already halting", reason)
+            return None
+        self.halting = True
+        if powerOff is True:
+            powerOff = self.powerOffDelay
+        elif powerOff:
+            powerOff = _Delay(powerOff)
+        start = time.monotonic()
+        stages = []
+        self.report = {'reason': reason, 'time': time.time(), 'stages': stages}
+
+        def stage(name, func, *args):
+            t = time.monotonic()
+            try:
+                ret = func(*args)
+                error = ret.get('error', 'NO_ERROR') if isinstance(ret, dict) else 'NO_ERROR'
+            except Exception as e: # pylint: disable=broad-except
+                error = str(e) or e.__class__.__name__
+            stages.append({'stage': name, 'duration': time.monotonic() - t, 'error': error})
+
+        procs = []
+        stage('hooks_start', self._StartHooks, reason, procs)
+        if pijuice:
+            if powerOff:
+                # cover the hooks too, rearmed with the plain delay once they are done
+                extra = math.ceil(self.budget) if procs else 0
+                stage('power_off', pijuice.power.SetPowerOff, _Delay(powerOff + extra))
+            if switchOff:
+                stage('system_switch', pijuice.power.SetSystemPowerSwitch, 0)
+            if wakeup and self.wakeupLevel is not None:
+                stage('wakeup_on_charge', pijuice.power.SetWakeUpOnCharge, self.wakeupLevel)
+            stage('led', pijuice.status.SetLedBlink, *self.led)
+        # tells 'pijuice_sys.py stop' that the service halted the system
+        stage('halt_file', self._WriteHaltFile)
+        if procs:
+            stage('hooks', self._WaitHooks, procs, start + self.budget)
+            if pijuice and powerOff:
+                stage('power_off_rearm', pijuice.power.SetPowerOff, powerOff)
+        stage('halt', self._Halt)
+        self.report['duration'] = time.monotonic() - start
+        summary = ", ".join("%s %.3fs%s" % (s['stage'], s['duration'],
+                                            "" if s['error'] == 'NO_ERROR' else " (%s)" % s['error'])
+                            for s in stages)
+        if stages[-1]['error'] != 'NO_ERROR':
+            self.logger.error("halt for %s failed: %s", reason, summary)
+            self._RemoveHaltFile()
+            self.halting = False
+        else:
+            self.logger.info("halting for %s: %s", reason, summary)
+        return self.report
+
+    def _StartHooks(self, reason, procs):
+        for name in self._hooks:
+            argv = self._authorize(name)
+            if argv is None:
+                continue
+            try:
+                procs.append((name, subprocess.Popen(argv + [HOOK_EVENT, str(reason)], stdin=subprocess.DEVNULL,
+                                                     start_new_session=True)))
+            except OSError:
+                self.logger.exception("failed to start pre halt hook %s", name)
+
+    def _WaitHooks(self, procs, deadline):
+        for name, proc in procs:
+            try:
+                proc.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                self.logger.warning("pre halt hook %s exceeded the %ss budget", name, self.budget)
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                proc.wait()
+        failed = [name for name, proc in procs if proc.returncode != 0]
+        return {'error': 'HOOK_FAILED'} if failed else {'error': 'NO_ERROR'}
+
+    def _WriteHaltFile(self):
+        with open(self.haltFile, 'w'):
+            pass
+
+    def _RemoveHaltFile(self):
+        try:
+            os.remove(self.haltFile)
+        except OSError:
+            pass
+
+    def _Halt(self):
+        ret = subprocess.call(self.haltCommand)
+        return {'error': 'NO_ERROR'} if ret == 0 else {'error': 'HALT_FAILED_%d' % ret}
+
+
+def _Delay(delay):
+    return max(1, min(int(delay), POWER_OFF_DELAY_MAX))
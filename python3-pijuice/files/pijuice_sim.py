@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Simulated PiJuice for running the service and the tools without a board.
+
+The simulation sits below PiJuiceInterface: SimBus replaces the I2C bus of
+the pijuice module and SimDevice answers like the firmware does (register
+file, checksums, button/fault acknowledge, power inputs, charge level), so
+everything above the bus runs unchanged.
+
+Selection: the PIJUICE_SIM environment variable ("1", or the path of a JSON
+scenario) or the "simulation" section of pijuice_config.JSON with
+"enabled": true. OpenPiJuice() returns a PiJuice on the simulated bus then
+and on the real one otherwise. Every process simulates its own device, with
+PIJUICE_SIM_STATS set its counters are written to that file on exit.
+
+Scenario keys (all optional):
+    latency       [s] added to every transaction
+    jitter        [s] random extra latency
+    error_rate    probability of a transaction failing with an I/O error
+    corrupt_rate  probability of a read with a bad checksum
+    speed         simulated seconds per real second
+    charge        initial charge level [%]
+    discharge     [%/min] while no input is powered
+    charge_rate   [%/min] while charging
+    power         USB input powered at start
+    io_power      5V GPIO input powered at start
+    registers     {"0x6e": [...]} initial register contents
+    events        [{"at": 10, "power": false}, {"at": 20, "button": "SW1", "event": "SINGLE_PRESS"},
+                   {"at": 30, "fault": "forced_power_off"}, {"at": 40, "bus_down": 5}]
+                  'at' is in simulated seconds since the start
+"""
+import atexit
+import errno
+import json
+import os
+import random
+import threading
+import time
+
+from pijuice_settings import LoadSettings, CONFIG_PATH, I2C_BUS_DEFAULT, I2C_ADDRESS_DEFAULT, SIM_ENV
+
+SIM_STATS_ENV = 'PIJUICE_SIM_STATS'
+
+STATUS_CMD = 0x40
+CHARGE_LEVEL_CMD = 0x41
+FAULT_EVENT_CMD = 0x44
+BUTTON_EVENT_CMD = 0x45
+BATTERY_TEMPERATURE_CMD = 0x47
+BATTERY_VOLTAGE_CMD = 0x49
+BATTERY_CURRENT_CMD = 0x4b
+IO_VOLTAGE_CMD = 0x4d
+IO_CURRENT_CMD = 0x4f
+WATCHDOG_ACTIVATION_CMD = 0x61
+POWER_OFF_CMD = 0x62
+FIRMWARE_VERSION_CMD = 0xfd
+
+BUTTONS = ('SW1', 'SW2', 'SW3')
+BUTTON_EVENTS = ['NO_EVENT', 'PRESS', 'RELEASE', 'SINGLE_PRESS', 'DOUBLE_PRESS', 'LONG_PRESS1', 'LONG_PRESS2']
+FAULTS = {'button_power_off': 0x01, 'forced_power_off': 0x02, 'forced_sys_power_off': 0x04,
+          'watchdog_reset': 0x08, 'battery_profile_invalid': 0x20}
+FIRMWARE_VERSION = [0x15, 0x00]
+BATTERY_EMPTY = 3300  # [mV] at 0 %
+BATTERY_FULL = 4200  # [mV] at 100 %
+BATTERY_CURRENT = 500  # [mA] drawn on battery
+POWER_OFF_DISABLED = 0xff
+
+DEFAULT_SCENARIO = {
+    'latency': 0.0,
+    'jitter': 0.0,
+    'error_rate': 0.0,
+    'corrupt_rate': 0.0,
+    'speed': 1.0,
+    'charge': 80.0,
+    'discharge': 1.0,
+    'charge_rate': 2.0,
+    'power': True,
+    'io_power': False,
+    'registers': {},
+    'events': [],
+}
+
+_device = None
+_lock = threading.Lock()
+
+
+class SimDevice:
+    """ Firmware side of the simulation, shared by all SimBus handles of a process """
+    def __init__(self, address=I2C_ADDRESS_DEFAULT, scenario=None):
+        s = dict(DEFAULT_SCENARIO, **(scenario or {}))
+        self.address = address
+        self.scenario = s
+        self.latency = float(s['latency'])
+        self.jitter = float(s['jitter'])
+        self.errorRate = float(s['error_rate'])
+        self.corruptRate = float(s['corrupt_rate'])
+        self.speed = float(s['speed'])
+        self.charge = float(s['charge'])
+        self.power = bool(s['power'])
+        self.ioPower = bool(s['io_power'])
+        self.faults = 0
+        self.buttons = [0, 0]
+        self.registers = {FIRMWARE_VERSION_CMD: list(FIRMWARE_VERSION), POWER_OFF_CMD: [POWER_OFF_DISABLED]}
+        for cmd, data in s['registers'].items():
+            self.registers[int(cmd, 0) if isinstance(cmd, str) else cmd] = list(data)
+        self.events = sorted(s['events'], key=lambda e: e['at'])
+        self.log = []  # (monotonic time, simulated time, what, detail) of state changes
+        self.counters = dict.fromkeys(('transactions', 'reads', 'writes', 'bytesRead', 'bytesWritten',
+                                       'errors', 'corrupted'), 0)
+        self.registerCounts = {}
+        self.powerOffAt = None
+        self.busDownUntil = None
+        self.watchdog = 0  # [min]
+        self.start = time.monotonic()
+        self._lastTransfer = self.start
+        self._simTime = 0.0
+        self._lock = threading.Lock()
+
+    def SimTime(self, now=None):
+        return ((time.monotonic() if now is None else now) - self.start) * self.speed
+
+    def Read(self, address, cmd, length):
+        """ 'length' data bytes plus checksum, like read_i2c_block_data() of the firmware """
+        with self._lock:
+            self._Transaction(address, cmd, length)
+            data = self._Get(cmd, length - 1)
+            self.counters['reads'] += 1
+            self.counters['bytesRead'] += length
+            checksum = _Checksum(data)
+            if self.corruptRate and random.random() < self.corruptRate:
+                self.counters['corrupted'] += 1
+                checksum ^= 0x01
+            return data + [checksum]
+
+    def Write(self, address, cmd, data):
+        with self._lock:
+            self._Transaction(address, cmd, len(data))
+            self.counters['writes'] += 1
+            self.counters['bytesWritten'] += len(data)
+            payload, checksum = list(data[:-1]), data[-1] if data else None
+            if checksum != _Checksum(payload):
+                return  # the firmware drops writes with a bad checksum
+            self._Set(cmd, payload)
+
+    def Stats(self):
+        with self._lock:
+            return dict(self.counters, registers={"0x%02x" % c: n for c, n in sorted(self.registerCounts.items())},
+                        simTime=self.SimTime(), charge=self.charge, power=self.power, ioPower=self.ioPower)
+
+    def Inject(self, event):
+        """ Applies a scenario event now, e.g. {"power": False} """
+        with self._lock:
+            self._Advance(time.monotonic())
+            self._Apply(dict(event, at=self._simTime))
+
+    def _Transaction(self, address, cmd, length):
+        delay = self.latency + (self.jitter * random.random() if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        now = time.monotonic()
+        self._Advance(now)
+        self.counters['transactions'] += 1
+        self.registerCounts[cmd] = self.registerCounts.get(cmd, 0) + 1
+        down = self.busDownUntil is not None and self._simTime < self.busDownUntil
+        if (address != self.address or self.powerOffAt is not None and self._simTime >= self.powerOffAt
+                or down or self.errorRate and random.random() < self.errorRate):
+            self.counters['errors'] += 1
+            raise OSError(errno.EREMOTEIO, os.strerror(errno.EREMOTEIO))
+        # any transfer resets the watchdog
+        self._lastTransfer = now
+
+    def _Advance(self, now):
+        # events happened at their scheduled time, not at the transaction noticing them
+        simTime = self.SimTime(now)
+        while self.events and self.events[0]['at'] <= simTime:
+            event = self.events.pop(0)
+            self._Integrate(max(self._simTime, event['at']))
+            self._Apply(event)
+        self._Integrate(simTime)
+        expires = self.SimTime(self._lastTransfer) + self.watchdog * 60
+        if self.watchdog and simTime > expires:
+            self.faults |= FAULTS['watchdog_reset']
+            self._Log(expires, 'watchdog_reset', None)
+            self._lastTransfer = now
+
+    def _Integrate(self, simTime):
+        minutes = (simTime - self._simTime) / 60
+        if self.power or self.ioPower:
+            self.charge = min(100.0, self.charge + minutes * float(self.scenario['charge_rate']))
+        else:
+            self.charge = max(0.0, self.charge - minutes * float(self.scenario['discharge']))
+        self._simTime = simTime
+
+    def _Apply(self, event):
+        if 'power' in event:
+            self.power = bool(event['power'])
+            self._Log(event['at'], 'power', self.power)
+        if 'io_power' in event:
+            self.ioPower = bool(event['io_power'])
+            self._Log(event['at'], 'io_power', self.ioPower)
+        if 'charge' in event:
+            self.charge = float(event['charge'])
+            self._Log(event['at'], 'charge', self.charge)
+        if 'button' in event:
+            i = BUTTONS.index(event['button'])
+            code = BUTTON_EVENTS.index(event.get('event', 'SINGLE_PRESS'))
+            shift = 4 if i == 1 else 0
+            self.buttons[i // 2] = (self.buttons[i // 2] & ~(0x0f << shift)) | (code << shift)
+            self._Log(event['at'], 'button', event['button'])
+        if 'fault' in event:
+            self.faults |= FAULTS[event['fault']]
+            self._Log(event['at'], 'fault', event['fault'])
+        if 'bus_down' in event:
+            self.busDownUntil = event['at'] + float(event['bus_down'])
+            self._Log(event['at'], 'bus_down', event['bus_down'])
+
+    def _Log(self, simTime, what, detail):
+        self.log.append((self.start + simTime / self.speed, simTime, what, detail))
+
+    def _Get(self, cmd, length):
+        if cmd == STATUS_CMD:
+            data = [self._Status()]
+        elif cmd == CHARGE_LEVEL_CMD:
+            data = [int(round(self.charge))]
+        elif cmd == FAULT_EVENT_CMD:
+            data = [self.faults]
+        elif cmd == BUTTON_EVENT_CMD:
+            data = list(self.buttons)
+        elif cmd == BATTERY_TEMPERATURE_CMD:
+            data = [25, 0]
+        elif cmd == BATTERY_VOLTAGE_CMD:
+            data = _Word(int(BATTERY_EMPTY + (BATTERY_FULL - BATTERY_EMPTY) * self.charge / 100))
+        elif cmd == BATTERY_CURRENT_CMD:
+            if not (self.power or self.ioPower):
+                current = BATTERY_CURRENT
+            elif self.charge < 100:
+                current = -BATTERY_CURRENT
+            else:
+                current = 0
+            data = _Word(current & 0xffff)
+        elif cmd == IO_VOLTAGE_CMD:
+            data = _Word(5000 if self.power or self.ioPower else int(BATTERY_EMPTY + 9 * self.charge))
+        elif cmd == IO_CURRENT_CMD:
+            data = _Word(300)
+        else:
+            data = self.registers.get(cmd, [])
+        return (list(data) + [0] * length)[:length]
+
+    def _Set(self, cmd, payload):
+        if cmd == FAULT_EVENT_CMD:
+            self.faults &= payload[0]
+        elif cmd == BUTTON_EVENT_CMD:
+            self.buttons = [b & m for b, m in zip(self.buttons, payload)]
+        elif cmd == POWER_OFF_CMD:
+            delay = payload[0]
+            self.powerOffAt = None if delay == POWER_OFF_DISABLED else self._simTime + delay
+            self.registers[cmd] = payload
+            self._Log(self._simTime, 'power_off', delay)
+        elif cmd == WATCHDOG_ACTIVATION_CMD:
+            self.watchdog = ((payload[1] & 0x3f) << 8 | payload[0]) if len(payload) > 1 else 0
+            self._lastTransfer = time.monotonic()
+            self.registers[cmd] = payload
+        else:
+            self.registers[cmd] = payload
+            self._Log(self._simTime, 'write', "0x%02x" % cmd)
+
+    def _Status(self):
+        if self.power and self.charge < 100:
+            battery = 1
+        elif self.ioPower and self.charge < 100:
+            battery = 2
+        else:
+            battery = 0
+        return ((1 if self.faults else 0) | (2 if any(self.buttons) else 0) | battery << 2
+                | (3 if self.power else 0) << 4 | (3 if self.ioPower else 0) << 6)
+
+
+class SimBus:
+    """ Stands in for the I2C bus of PiJuiceInterface """
+    def __init__(self, bus=I2C_BUS_DEFAULT, *args, **kwargs):
+        self.bus = bus
+        self.device = _device
+
+    def read_i2c_block_data(self, address, cmd, length):
+        return self.device.Read(address, cmd, length)
+
+    def write_i2c_block_data(self, address, cmd, data):
+        self.device.Write(address, cmd, list(data))
+
+    def close(self):
+        pass
+
+
+def LoadScenario(simulation=None):
+    """
+    Returns the scenario selected by PIJUICE_SIM, 'simulation' (the section
+    of already loaded settings) or the configuration file, None for the
+    real board.
+    """
+    value = os.environ.get(SIM_ENV)
+    if value is not None:
+        if value in ('', '0'):
+            return None
+        if value == '1':
+            return {}
+        with open(value, 'r') as f:
+            return json.load(f)
+    if simulation is None:
+        try:
+            simulation = LoadSettings(CONFIG_PATH).simulation
+        except (OSError, ValueError):
+            return None
+    return simulation
+
+
+def Simulate(address=I2C_ADDRESS_DEFAULT, scenario=None):
+    """ Routes the I2C transfers of the pijuice module to a SimDevice """
+    global _device
+    import pijuice
+    with _lock:
+        if _device is None or _device.address != address:
+            if _device is None and os.environ.get(SIM_STATS_ENV):
+                atexit.register(_DumpStats, os.environ[SIM_STATS_ENV])
+            _device = SimDevice(address, scenario)
+        pijuice.I2CBus = SimBus
+    return _device
+
+
+def Device():
+    """ The simulated device of this process or None """
+    return _device
+
+
+def OpenPiJuice(bus=I2C_BUS_DEFAULT, address=I2C_ADDRESS_DEFAULT, simulation=None):
+    """ PiJuice on the simulated bus if the simulation is selected, else on the real one """
+    from pijuice import PiJuice
+    scenario = LoadScenario(simulation)
+    if scenario is not None:
+        Simulate(address, scenario)
+    return PiJuice(bus, address)
+
+
+def _DumpStats(path):
+    with open(path, 'w') as f:
+        json.dump(_device.Stats(), f)
+
+def _Checksum(data):
+    fcs = 0xff
+    for x in data:
+        fcs ^= x
+    return fcs
+
+def _Word(value):
+    return [value & 0xff, (value >> 8) & 0xff]
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Status snapshot of the PiJuice telemetry registers.
+
+The status, charge, fault and analog registers are read into one buffer
+(every register group at most once per snapshot) and decoded into an
+immutable StatusSnapshot record that can be shared by all consumers.
+"""
+import time
+
+STATUS_BASE_CMD = 0x40
+# field group: (command, length)
+REGISTERS = {
+    'status': (0x40, 1),
+    'chargeLevel': (0x41, 1),
+    'faults': (0x44, 1),
+    'batteryTemperature': (0x47, 2),
+    'batteryVoltage': (0x49, 2),
+    'batteryCurrent': (0x4b, 2),
+    'ioVoltage': (0x4d, 2),
+    'ioCurrent': (0x4f, 2),
+}
+STATUS_WINDOW = 0x51 - STATUS_BASE_CMD
+ALL_FIELDS = tuple(REGISTERS)
+
+BATTERY_STATUS = ['NORMAL', 'CHARGING_FROM_IN', 'CHARGING_FROM_5V_IO', 'NOT_PRESENT']
+POWER_IN_STATUS = ['NOT_PRESENT', 'BAD', 'WEAK', 'PRESENT']
+BATTERY_CHARGING_TEMP = ['NORMAL', 'SUSPEND', 'COOL', 'WARM']
+
+
+class StatusSnapshot:
+    """
+    Immutable record of one status read. Fields of register groups that
+    were not requested or could not be read are None.
+    """
+    __slots__ = ('time', 'error', 'fields', 'isFault', 'isButton', 'battery', 'powerInput', 'powerInput5vIo',
+                 'chargeLevel', 'faults', 'batteryTemperature', 'batteryVoltage', 'batteryCurrent',
+                 'ioVoltage', 'ioCurrent')
+
+    def __init__(self, buf, valid, error, timestamp=None):
+        values = dict.fromkeys(self.__slots__)
+        values['time'] = time.time() if timestamp is None else timestamp
+        values['error'] = error
+        values['fields'] = tuple(valid)
+        if 'status' in valid:
+            d = buf[0x40 - STATUS_BASE_CMD]
+            values['isFault'] = bool(d & 0x01)
+            values['isButton'] = bool(d & 0x02)
+            values['battery'] = BATTERY_STATUS[(d >> 2) & 0x03]
+            values['powerInput'] = POWER_IN_STATUS[(d >> 4) & 0x03]
+            values['powerInput5vIo'] = POWER_IN_STATUS[(d >> 6) & 0x03]
+        if 'chargeLevel' in valid:
+            values['chargeLevel'] = buf[0x41 - STATUS_BASE_CMD]
+        if 'faults' in valid:
+            values['faults'] = _DecodeFaults(buf[0x44 - STATUS_BASE_CMD])
+        if 'batteryTemperature' in valid:
+            values['batteryTemperature'] = _Signed(buf[0x47 - STATUS_BASE_CMD], 8)
+        if 'batteryVoltage' in valid:
+            values['batteryVoltage'] = _Word(buf, 0x49)
+        if 'batteryCurrent' in valid:
+            values['batteryCurrent'] = _Signed(_Word(buf, 0x4b), 16)
+        if 'ioVoltage' in valid:
+            values['ioVoltage'] = _Word(buf, 0x4d)
+        if 'ioCurrent' in valid:
+            values['ioCurrent'] = _Signed(_Word(buf, 0x4f), 16)
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("StatusSnapshot is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("StatusSnapshot is immutable")
+
+    def __repr__(self):
+        return "StatusSnapshot(%s)" % ", ".join("%s=%r" % (n, getattr(self, n)) for n in self.__slots__)
+
+    @classmethod
+    def FromDict(cls, values):
+        snapshot = object.__new__(cls)
+        for name in cls.__slots__:
+            value = values.get(name)
+            if name == 'fields':
+                value = tuple(value or ())
+            object.__setattr__(snapshot, name, value)
+        return snapshot
+
+    def ToDict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def Has(self, fields):
+        return all(f in self.fields for f in fields)
+
+    def StatusDict(self):
+        # Same layout as PiJuiceStatus.GetStatus()['data']
+        if self.battery is None:
+            return None
+        return {
+            'isFault': self.isFault,
+            'isButton': self.isButton,
+            'battery': self.battery,
+            'powerInput': self.powerInput,
+            'powerInput5vIo': self.powerInput5vIo,
+        }
+
+
+class SnapshotReader:
+    """
+    Reads StatusSnapshots through a PiJuiceInterface. Only the register
+    groups of the requested fields are transferred.
+    """
+    def __init__(self, interface):
+        self.interface = interface
+        self._buf = bytearray(STATUS_WINDOW)
+
+    def Read(self, fields=ALL_FIELDS):
+        valid = []
+        error = 'NO_ERROR'
+        for field in fields:
+            cmd, length = REGISTERS[field]
+            result = self.interface.ReadData(cmd, length)
+            if result['error'] != 'NO_ERROR':
+                if error == 'NO_ERROR':
+                    error = result['error']
+                continue
+            offset = cmd - STATUS_BASE_CMD
+            self._buf[offset:offset + length] = bytes(result['data'][:length])
+            valid.append(field)
+        return StatusSnapshot(self._buf, valid, error)
+
+
+def _Word(buf, cmd):
+    offset = cmd - STATUS_BASE_CMD
+    return (buf[offset + 1] << 8) | buf[offset]
+
+def _Signed(value, bits):
+    if value & (1 << (bits - 1)):
+        value -= 1 << bits
+    return value
+
+def _DecodeFaults(d):
+    # Same keys as PiJuiceStatus.GetFaultStatus()['data']
+    fault = {}
+    if d & 0x01:
+        fault['button_power_off'] = True
+    if d & 0x02:
+        fault['forced_power_off'] = True
+    if d & 0x04:
+        fault['forced_sys_power_off'] = True
+    if d & 0x08:
+        fault['watchdog_reset'] = True
+    if d & 0x20:
+        fault['battery_profile_invalid'] = True
+    if (d >> 6) & 0x03:
+        fault['charging_temperature_fault'] = BATTERY_CHARGING_TEMP[(d >> 6) & 0x03]
+    return fault
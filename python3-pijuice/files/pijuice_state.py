@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Compact checkpoint of the pijuice service state.
+
+pijuice_sys saves the power state it has learned, the last charge level,
+the last status snapshot and the user function events that were still
+queued to a small binary file whenever one of them changes. A restarted
+service and the post stop run resume from it instead of probing the board.
+"""
+import os
+import struct
+import time
+
+from pijuice_snapshot import StatusSnapshot, BATTERY_STATUS, POWER_IN_STATUS
+
+STATE_PATH = '/tmp/pijuice_state.bin'
+STATE_MAGIC = b'PJST'
+STATE_VERSION = 1
+
+# magic, version, saved at, flags, charge level, snapshot time, snapshot
+# power status, snapshot charge level, snapshot battery voltage, pending events
+STATE = struct.Struct('<4sHdBBdBBHH')
+FLAG_POWER_PRESENT = 0x01
+FLAG_WATCHDOG_ACTIVE = 0x02
+FLAG_SNAPSHOT = 0x04
+UNKNOWN_U8 = 0xff
+UNKNOWN_U16 = 0xffff
+
+
+class ServiceState:
+    def __init__(self, powerPresent=True, chargeLevel=None, snapshot=None, watchdogActive=False,
+                 pending=(), savedAt=None):
+        self.powerPresent = powerPresent
+        self.chargeLevel = chargeLevel
+        self.snapshot = snapshot
+        self.watchdogActive = watchdogActive
+        # (function, event, parameter) of queued user function calls
+        self.pending = tuple(pending)
+        self.savedAt = savedAt
+
+    def Key(self):
+        """
+        The parts that trigger a new checkpoint when they change: the learned
+        state and the power status bits, not the register groups the snapshot
+        happens to contain
+        """
+        s = self.snapshot
+        snapshotKey = (s.battery, s.powerInput, s.powerInput5vIo) if s and s.battery is not None else None
+        return (self.powerPresent, self.chargeLevel, self.watchdogActive, snapshotKey, self.pending)
+
+    def Pack(self):
+        flags = 0
+        if self.powerPresent:
+            flags |= FLAG_POWER_PRESENT
+        if self.watchdogActive:
+            flags |= FLAG_WATCHDOG_ACTIVE
+        s = self.snapshot
+        if s is not None and s.battery is not None:
+            flags |= FLAG_SNAPSHOT
+            power = (BATTERY_STATUS.index(s.battery)
+                     | POWER_IN_STATUS.index(s.powerInput) << 2
+                     | POWER_IN_STATUS.index(s.powerInput5vIo) << 4)
+            snapshotValues = (s.time, power, _Value(s.chargeLevel, UNKNOWN_U8),
+                              _Value(s.batteryVoltage, UNKNOWN_U16))
+        else:
+            snapshotValues = (0.0, 0, UNKNOWN_U8, UNKNOWN_U16)
+        chargeLevel = UNKNOWN_U8 if self.chargeLevel is None else int(round(self.chargeLevel))
+        data = bytearray(STATE.pack(STATE_MAGIC, STATE_VERSION, time.time(), flags, chargeLevel,
+                                    *snapshotValues, len(self.pending)))
+        for entry in self.pending:
+            for value in entry:
+                encoded = str(value).encode('utf-8')[:255]
+                data.append(len(encoded))
+                data += encoded
+        return bytes(data)
+
+    @classmethod
+    def Unpack(cls, data):
+        (magic, version, savedAt, flags, chargeLevel, snapTime, power, snapCharge, snapVoltage,
+         count) = STATE.unpack_from(data, 0)
+        if magic != STATE_MAGIC or version != STATE_VERSION:
+            raise ValueError("not a pijuice state file")
+        snapshot = None
+        if flags & FLAG_SNAPSHOT:
+            fields = ['status']
+            values = {
+                'time': snapTime,
+                'error': 'NO_ERROR',
+                'battery': BATTERY_STATUS[power & 0x03],
+                'powerInput': POWER_IN_STATUS[(power >> 2) & 0x03],
+                'powerInput5vIo': POWER_IN_STATUS[(power >> 4) & 0x03],
+            }
+            if snapCharge != UNKNOWN_U8:
+                values['chargeLevel'] = snapCharge
+                fields.append('chargeLevel')
+            if snapVoltage != UNKNOWN_U16:
+                values['batteryVoltage'] = snapVoltage
+                fields.append('batteryVoltage')
+            values['fields'] = fields
+            snapshot = StatusSnapshot.FromDict(values)
+        offset = STATE.size
+        pending = []
+        for _ in range(count):
+            entry = []
+            for _ in range(3):
+                length = data[offset]
+                entry.append(data[offset + 1:offset + 1 + length].decode('utf-8'))
+                offset += 1 + length
+            pending.append(tuple(entry))
+        return cls(bool(flags & FLAG_POWER_PRESENT), None if chargeLevel == UNKNOWN_U8 else chargeLevel,
+                   snapshot, bool(flags & FLAG_WATCHDOG_ACTIVE), pending, savedAt)
+
+
+class StateFile:
+    """ Writes a ServiceState only when its Key() changed since the last write """
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        self._key = None
+
+    def Load(self):
+        """ Returns the saved ServiceState or None """
+        try:
+            with open(self.path, 'rb') as f:
+                state = ServiceState.Unpack(f.read())
+        except (OSError, ValueError, IndexError, struct.error):
+            return None
+        self._key = state.Key()
+        return state
+
+    def Save(self, state):
+        key = state.Key()
+        if key == self._key:
+            return False
+        tmpPath = "%s.%d" % (self.path, os.getpid())
+        with open(tmpPath, 'wb') as f:
+            f.write(state.Pack())
+        os.rename(tmpPath, self.path)
+        self._key = key
+        return True
+
+
+def _Value(value, unknown):
+    return unknown if value is None else value
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Always-on operation statistics of the pijuice service.
+
+Every instrumented operation (I2C transfers, PiJuice API calls, function
+dispatches, loop iterations, user functions) counts its calls and errors
+and sorts its duration into a histogram with fixed buckets. Recording a
+sample only increments preallocated counters, so it stays cheap enough to
+leave enabled. The statistics are served on the query socket and can be
+dumped as text.
+"""
+import bisect
+import threading
+import time
+
+# upper bucket bounds [s], the last bucket takes everything above
+BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60)
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'errors', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def Add(self, duration, error=False):
+        self.counts[bisect.bisect_left(BUCKETS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        if error:
+            self.errors += 1
+
+    def Quantile(self, q):
+        """ Upper bound of the bucket holding quantile 'q' (at most the maximum), None if empty """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def ToDict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.Quantile(0.5),
+            'p95': self.Quantile(0.95),
+            'buckets': list(self.counts),
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.since = time.time()
+        self.ops = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def Record(self, name, duration, error=False):
+        with self._lock:
+            histogram = self.ops.get(name)
+            if histogram is None:
+                histogram = self.ops[name] = Histogram()
+            histogram.Add(duration, error)
+
+    def Count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def Wrap(self, name, func):
+        """ 'func' recorded as operation 'name', exceptions and error results count as errors """
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                ret = func(*args, **kwargs)
+            except:
+                self.Record(name, time.perf_counter() - start, True)
+                raise
+            error = isinstance(ret, dict) and ret.get('error', 'NO_ERROR') != 'NO_ERROR'
+            self.Record(name, time.perf_counter() - start, error)
+            return ret
+        return timed
+
+    def Instrument(self, obj, prefix, names=None):
+        """ Records the public methods of 'obj' as '<prefix>.<method>' """
+        if names is None:
+            names = [n for n in dir(type(obj)) if n[:1].isupper() and callable(getattr(obj, n))]
+        for n in names:
+            method = getattr(obj, n, None)
+            if method is not None:
+                setattr(obj, n, self.Wrap("%s.%s" % (prefix, n), method))
+        return obj
+
+    def Snapshot(self):
+        with self._lock:
+            return {
+                'since': self.since,
+                'buckets': list(BUCKETS),
+                'ops': {name: h.ToDict() for name, h in self.ops.items()},
+                'counters': dict(self.counters),
+            }
+
+
+def FormatStats(stats):
+    """ Text table of a Metrics.Snapshot() """
+    lines = ["statistics since %s (%ds)" % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stats['since'])),
+                                             time.time() - stats['since'])]
+    lines.append("%-32s %8s %6s %9s %9s %9s %9s" % ('operation', 'count', 'errors', 'mean', 'p50', 'p95', 'max'))
+    for name, op in sorted(stats['ops'].items()):
+        lines.append("%-32s %8d %6d %9s %9s %9s %9s" % (name, op['count'], op['errors'], _Ms(op['mean']),
+                                                       _Ms(op['p50']), _Ms(op['p95']), _Ms(op['max'])))
+    for name, value in sorted(stats['counters'].items()):
+        lines.append("%-32s %8d" % (name, value))
+    return "\n".join(lines)
+
+
+def _Ms(seconds):
+    if seconds is None:
+        return '-'
+    return "%.2fms" % (seconds * 1000) if seconds < 1 else "%.2fs" % seconds
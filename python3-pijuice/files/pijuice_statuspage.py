@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Shared memory status page of the pijuice service.
+
+pijuice_sys publishes the latest status snapshot into a small memory
+mapped file of fixed layout: a header, a sequence counter and one record.
+Register groups missing from a snapshot keep their last published value
+and the time it was read, so the page holds the status of every tick
+together with the charge level and voltages of the slower checks, and
+readers only get the groups that are recent enough.
+
+The page is a seqlock: the writer makes the counter odd, updates the
+record and makes it even again. Readers map the file once and copy the
+record between two reads of the counter, a torn copy is retried. A read
+needs no system call, no lock and no bus access.
+"""
+import mmap
+import os
+import struct
+import time
+
+from pijuice_snapshot import (StatusSnapshot, ALL_FIELDS, BATTERY_STATUS, POWER_IN_STATUS, BATTERY_CHARGING_TEMP,
+                              _DecodeFaults)
+
+STATUS_PAGE_PATH = '/tmp/pijuice_status.bin'
+STATUS_PAGE_MAGIC = b'PJSP'
+STATUS_PAGE_VERSION = 2
+STATUS_PAGE_MAX_AGE = 2  # [s] older pages are not used in place of a bus read
+READ_RETRIES = 1000  # a write takes a few microseconds
+
+# magic, version, record size
+HEADER = struct.Struct('<4sHH')
+SEQUENCE = struct.Struct('<I')
+SEQUENCE_OFFSET = HEADER.size
+RECORD_OFFSET = SEQUENCE_OFFSET + SEQUENCE.size
+# read time of every register group in ALL_FIELDS order (0 if never read),
+# power status, status flags, charge level, fault flags, battery temperature,
+# battery voltage, battery current, io voltage, io current, error
+RECORD = struct.Struct('<%ddBBBBbHhHh24s' % len(ALL_FIELDS))
+PAGE_SIZE = RECORD_OFFSET + RECORD.size
+GROUP_TIME = {field: i for i, field in enumerate(ALL_FIELDS)}
+VALUES = len(ALL_FIELDS)
+FLAG_FAULT = 0x01
+FLAG_BUTTON = 0x02
+
+
+class StatusPage:
+    """ Writer side, pijuice_sys is the only writer """
+    def __init__(self, path=STATUS_PAGE_PATH):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != PAGE_SIZE:
+                os.ftruncate(fd, PAGE_SIZE)
+            self._map = mmap.mmap(fd, PAGE_SIZE)
+        finally:
+            os.close(fd)
+        # continue the sequence of a previous run, readers still mapping the file see the change
+        self._seq = (SEQUENCE.unpack_from(self._map, SEQUENCE_OFFSET)[0] + 1) & ~1
+        self._record = [0.0] * len(ALL_FIELDS) + [0, 0, 0, 0, 0, 0, 0, 0, 0, b'']
+        HEADER.pack_into(self._map, 0, STATUS_PAGE_MAGIC, STATUS_PAGE_VERSION, RECORD.size)
+        self._Write()
+
+    def Publish(self, snapshot):
+        s = snapshot
+        record = self._record
+        record[VALUES + 9] = s.error.encode('ascii')
+        for field in s.fields:
+            record[GROUP_TIME[field]] = s.time
+        if 'status' in s.fields:
+            record[VALUES] = (BATTERY_STATUS.index(s.battery)
+                              | POWER_IN_STATUS.index(s.powerInput) << 2
+                              | POWER_IN_STATUS.index(s.powerInput5vIo) << 4)
+            record[VALUES + 1] = (FLAG_FAULT if s.isFault else 0) | (FLAG_BUTTON if s.isButton else 0)
+        if 'chargeLevel' in s.fields:
+            record[VALUES + 2] = s.chargeLevel
+        if 'faults' in s.fields:
+            record[VALUES + 3] = _EncodeFaults(s.faults)
+        for field, index in (('batteryTemperature', 4), ('batteryVoltage', 5), ('batteryCurrent', 6),
+                             ('ioVoltage', 7), ('ioCurrent', 8)):
+            if field in s.fields:
+                record[VALUES + index] = getattr(s, field)
+        self._Write()
+
+    def _Write(self):
+        self._seq = (self._seq + 1) & 0xffffffff
+        SEQUENCE.pack_into(self._map, SEQUENCE_OFFSET, self._seq)
+        RECORD.pack_into(self._map, RECORD_OFFSET, *self._record)
+        self._seq = (self._seq + 1) & 0xffffffff
+        SEQUENCE.pack_into(self._map, SEQUENCE_OFFSET, self._seq)
+
+    def Close(self):
+        self._map.close()
+
+
+class StatusPageReader:
+    """ Maps the page once, Read() returns a consistent StatusSnapshot """
+    def __init__(self, path=STATUS_PAGE_PATH):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < PAGE_SIZE or HEADER.unpack_from(self._map, 0) != (STATUS_PAGE_MAGIC, STATUS_PAGE_VERSION,
+                                                                              RECORD.size):
+            self._map.close()
+            raise ValueError("not a pijuice status page: %s" % path)
+
+    def Read(self, maxAge=None):
+        """
+        The published register groups not older than 'maxAge' [s] as a
+        StatusSnapshot timed by its oldest group, None if there are none or
+        the page is busy
+        """
+        m = self._map
+        for _ in range(READ_RETRIES):
+            seq = SEQUENCE.unpack_from(m, SEQUENCE_OFFSET)[0]
+            if seq & 1:
+                continue
+            record = RECORD.unpack_from(m, RECORD_OFFSET)
+            if SEQUENCE.unpack_from(m, SEQUENCE_OFFSET)[0] == seq:
+                break
+        else:
+            return None
+        oldest = 0 if maxAge is None else time.time() - maxAge
+        fields = [field for field in ALL_FIELDS if record[GROUP_TIME[field]] and record[GROUP_TIME[field]] >= oldest]
+        if not fields:
+            return None
+        return _Snapshot(record, fields)
+
+    def Close(self):
+        self._map.close()
+
+
+def ReadStatusPage(maxAge=STATUS_PAGE_MAX_AGE, path=STATUS_PAGE_PATH):
+    """ One shot read for short lived tools, None if the page is missing or stale """
+    try:
+        reader = StatusPageReader(path)
+    except (OSError, ValueError):
+        return None
+    try:
+        return reader.Read(maxAge)
+    finally:
+        reader.Close()
+
+
+def _Snapshot(record, fields):
+    (power, flags, chargeLevel, faults, batteryTemperature, batteryVoltage, batteryCurrent,
+     ioVoltage, ioCurrent, error) = record[VALUES:]
+    values = {'time': min(record[GROUP_TIME[field]] for field in fields),
+              'error': error.rstrip(b'\0').decode('ascii'), 'fields': fields}
+    if 'status' in fields:
+        values['isFault'] = bool(flags & FLAG_FAULT)
+        values['isButton'] = bool(flags & FLAG_BUTTON)
+        values['battery'] = BATTERY_STATUS[power & 0x03]
+        values['powerInput'] = POWER_IN_STATUS[(power >> 2) & 0x03]
+        values['powerInput5vIo'] = POWER_IN_STATUS[(power >> 4) & 0x03]
+    if 'faults' in fields:
+        values['faults'] = _DecodeFaults(faults)
+    for field, value in (('chargeLevel', chargeLevel), ('batteryTemperature', batteryTemperature),
+                         ('batteryVoltage', batteryVoltage), ('batteryCurrent', batteryCurrent),
+                         ('ioVoltage', ioVoltage), ('ioCurrent', ioCurrent)):
+        if field in fields:
+            values[field] = value
+    return StatusSnapshot.FromDict(values)
+
+def _EncodeFaults(fault):
+    # inverse of pijuice_snapshot._DecodeFaults()
+    d = 0
+    for bit, name in ((0x01, 'button_power_off'), (0x02, 'forced_power_off'), (0x04, 'forced_sys_power_off'),
+                      (0x08, 'watchdog_reset'), (0x20, 'battery_profile_invalid')):
+        if fault.get(name):
+            d |= bit
+    if 'charging_temperature_fault' in fault:
+        d |= BATTERY_CHARGING_TEMP.index(fault['charging_temperature_fault']) << 6
+    return d
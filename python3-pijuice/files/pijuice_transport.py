@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Retries, backoff and a circuit breaker for PiJuice I2C transfers.
+
+Transfers failing with a transient bus error are retried with exponential
+backoff and jitter. PiJuiceInterface refuses all transfers for a few
+seconds after a communication error, so the interface is re-opened in
+place (new SMBus handle, error state cleared) before the next attempt.
+A bus that keeps failing is not hammered: after 'breakerThreshold' failed
+transfers in a row the breaker opens and transfers fail fast with
+BUS_UNAVAILABLE. After 'breakerTime' seconds (doubled on every failed probe
+up to BREAKER_TIME_MAX) a single transfer probes the bus again.
+
+The service main loop and the watchdog feeder thread share a transport,
+the breaker state and the counters are only changed under its lock.
+"""
+import logging
+import random
+import threading
+import time
+
+TRANSIENT_ERRORS = ('COMMUNICATION_ERROR', 'DATA_CORRUPTED', 'WRITE_FAILED')
+REOPEN_ERRORS = ('COMMUNICATION_ERROR',)
+RETRIES = 2
+BACKOFF = 0.02  # [s] before the first retry, doubled for every further one
+BACKOFF_JITTER = 0.5  # random part of a backoff delay
+BREAKER_THRESHOLD = 5
+BREAKER_TIME = 2  # [s]
+BREAKER_TIME_MAX = 60  # [s]
+
+
+class ResilientTransport:
+    def __init__(self, interface, bus, address, retries=None, backoff=None,
+                 breakerThreshold=None, breakerTime=None, lock=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.interface = interface
+        self.bus = bus
+        self.address = address
+        self.retries = RETRIES if retries is None else retries
+        self.backoff = BACKOFF if backoff is None else backoff
+        self.breakerThreshold = breakerThreshold or BREAKER_THRESHOLD
+        self.breakerTime = breakerTime or BREAKER_TIME
+        self.lock = lock
+        self.counters = dict.fromkeys(('transfers', 'failures', 'retries', 'reopens', 'reopenFailures',
+                                       'breakerOpened', 'shortCircuited'), 0)
+        self._failures = 0
+        self._openUntil = None
+        self._openTime = self.breakerTime
+        self._probing = False
+        self._state = threading.Lock()
+
+    def Attach(self):
+        """ Routes ReadData/WriteData of the interface through the transport """
+        for name in ('ReadData', 'WriteData'):
+            setattr(self.interface, name, self._Wrap(getattr(self.interface, name)))
+        return self
+
+    def IsOpen(self):
+        return self._openUntil is not None
+
+    def Reopen(self):
+        """ Re-initializes the interface in place, all users keep their reference """
+        self._Count('reopens')
+        if self.lock and not self.lock.Acquire():
+            self._Count('reopenFailures')
+            return False
+        try:
+            try:
+                self.interface.i2cbus.close()
+            except Exception: # pylint: disable=broad-except
+                pass
+            type(self.interface).__init__(self.interface, self.bus, self.address)
+            return True
+        except Exception: # pylint: disable=broad-except
+            self._Count('reopenFailures')
+            self.logger.debug("reopen of I2C bus %s failed", self.bus, exc_info=True)
+            return False
+        finally:
+            if self.lock:
+                self.lock.Release()
+
+    def Stats(self):
+        with self._state:
+            return dict(self.counters, breakerOpen=self.IsOpen(), consecutiveFailures=self._failures)
+
+    def _Wrap(self, method):
+        def resilient(*args, **kwargs):
+            return self._Call(method, args, kwargs)
+        return resilient
+
+    def _Call(self, method, args, kwargs):
+        with self._state:
+            self.counters['transfers'] += 1
+            probe = False
+            if self._openUntil is not None:
+                if self._probing or time.monotonic() < self._openUntil:
+                    self.counters['shortCircuited'] += 1
+                    return {'error': 'BUS_UNAVAILABLE'}
+                # half open: one transfer on a fresh connection decides
+                probe = self._probing = True
+        try:
+            if probe:
+                self.Reopen()
+            attempt = 0
+            while True:
+                ret = method(*args, **kwargs)
+                error = ret['error']
+                if error not in TRANSIENT_ERRORS:
+                    if error == 'NO_ERROR':
+                        self._Succeeded()
+                    return ret
+                if probe or attempt >= self.retries:
+                    break
+                attempt += 1
+                self._Count('retries')
+                delay = self.backoff * (2 ** (attempt - 1))
+                time.sleep(delay * (1 - BACKOFF_JITTER * random.random()))
+                if error in REOPEN_ERRORS:
+                    self.Reopen()
+            self._Failed(error, probe)
+            return ret
+        finally:
+            if probe:
+                with self._state:
+                    self._probing = False
+
+    def _Count(self, name):
+        with self._state:
+            self.counters[name] += 1
+
+    def _Succeeded(self):
+        with self._state:
+            self._failures = 0
+            if self._openUntil is not None:
+                self.logger.info("I2C bus %s recovered", self.bus)
+                self._openUntil = None
+                self._openTime = self.breakerTime
+
+    def _Failed(self, error, probe=False):
+        with self._state:
+            self.counters['failures'] += 1
+            self._failures += 1
+            if probe:
+                # failed probe, stay open longer
+                self._openTime = min(self._openTime * 2, BREAKER_TIME_MAX)
+            elif self._openUntil is not None:
+                return  # started before the breaker opened
+            elif self._failures < self.breakerThreshold:
+                return
+            else:
+                self.counters['breakerOpened'] += 1
+                self.logger.error("I2C bus %s failing (%s), pausing transfers for %ss", self.bus, error, self._openTime)
+            self._openUntil = time.monotonic() + self._openTime
@@ -11,7 +11,7 @@ setup(
     description="Software package for PiJuice",
     url="https://github.com/PiSupply/PiJuice/",
     license='GPL v2',
-    py_modules=['pijuice'],
+    py_modules=['pijuice', 'pijuice_snapshot', 'pijuice_query', 'pijuice_history', 'pijuice_settings', 'pijuice_devcache', 'pijuice_bus', 'pijuice_transport', 'pijuice_daemonlog', 'pijuice_state', 'pijuice_shutdown', 'pijuice_sim', 'pijuice_stats', 'pijuice_statuspage'],
     #data_files=[],
     scripts=['src/pijuice_sys.py', "Utilities/pijuice_util.py", "Test/pijuiceboot.py", "Test/pijuice_log.py"],
     )
@@ -1,7 +1,9 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 import calendar
+import collections
 import datetime
+import fcntl
 import getopt
 import grp
 import json
@@ -15,117 +17,443 @@ import sys
 import time
 import re
 import argparse
+import selectors
+import socket
+import threading
 
 from pijuice import PiJuice
+from pijuice_snapshot import SnapshotReader, ALL_FIELDS
+from pijuice_query import QueryServer
+from pijuice_history import HistoryStore, HISTORY_PATH, HISTORY_CAPACITY
+from pijuice_settings import LoadSettings, Settings, SimulationSelected, DEFAULT_CONFIG
+from pijuice_devcache import CachedDeviceConfig
+from pijuice_transport import ResilientTransport
+from pijuice_daemonlog import DaemonLogging, LOG_INTERVAL
+from pijuice_state import StateFile, ServiceState, STATE_PATH
+from pijuice_shutdown import ShutdownCoordinator
+from pijuice_stats import Metrics, FormatStats
+from pijuice_statuspage import StatusPage, STATUS_PAGE_PATH
+from pijuice_bus import BusArbiter, BUS_LOCK_PATH, PRIORITY_WATCHDOG, PRIORITY_POWER, PRIORITY_TELEMETRY, PRIORITY_CLI
 
 pijuice = None
 btConfig = {}
+deviceConfig = None
 
 configPath = '/etc/pijuice/pijuice_config.JSON'  # os.getcwd() + '/pijuice_config.JSON'
-configData = {'system_task': {'enabled': False}}
+settings = Settings(DEFAULT_CONFIG)
+configData = settings.data
 status = {}
-sysEvEn = False
-minChgEn = False
-minBatVolEn = False
-lowChgEn = False
-lowBatVolEn = False
-watchdogEn = False
 chargeLevel = 50
-noPowEn = False
-PowEn = False
-sysStartEvEn = False
-sysStopEvEn = False
-noPowCnt = 0  # 0 will trigger at boot without power, 3 will not trigger at boot without power
-PowCnt = 3    # 0 will trigger at boot with power, 3 will not trigger at boot with power
+powerPresent = True  # assumed at start: 'no_power' triggers at boot without power, 'power' does not trigger at boot
+powerChangeTime = None  # when the power inputs started to differ from powerPresent
+POWER_DEBOUNCE = 0.4  # [s] a power input change must persist this long before an event triggers
+powerDebounce = POWER_DEBOUNCE
 dopoll = True
 PID_FILE = '/tmp/pijuice_sys.pid'
 HALT_FILE = '/tmp/pijuice_halt.flag'
-I2C_ADDRESS_DEFAULT = 0x14
-I2C_BUS_DEFAULT = 1
 allowAllScripts = False
+snapshot = None
+snapshotReader = None
+querySnapshot = None
+QUERY_MAX_AGE = 1  # [s] snapshots younger than this are served to clients without a bus read
+firmwareVersion = None
+queryServer = None
+history = None
+statusPage = None
+# check: (period on mains [s], period on battery [s], deadline [s])
+# on mains nothing runs low, the service mostly sleeps
+SCHEDULE_DEFAULTS = {
+    'button': (2, 1, 0.2),
+    'faults': (30, 5, 1),
+    'charge': (60, 5, 2),
+    'voltage': (60, 5, 2),
+    'power': (0.2, 0.2, 0.05),
+    'history': (10, 10, 5),
+}
+SCHEDULE_LATE_MARGIN = 0.1  # tolerated wakeup jitter before a check counts as late
+RELOAD_DEBOUNCE = 0.5  # [s] SIGHUPs within this window cause a single reload
+signalSockets = None
+scheduler = None
+FUNCTION_WORKERS = 2  # user functions running at the same time
+FUNCTION_TIMEOUT = 60  # [s] before a user function is killed
+FUNCTION_KILL_GRACE = 2  # [s] between SIGTERM and SIGKILL
+FUNCTION_RESULTS = 32  # finished user functions kept for inspection
+URGENT_EVENTS = ('no_power', 'low_charge', 'low_battery_voltage')
+FAULT_EVENTS = ('button_power_off', 'forced_power_off', 'forced_sys_power_off', 'watchdog_reset',
+                'battery_profile_invalid', 'charging_temperature_fault')
+functionRunner = None
+WATCHDOG_KICK_FRACTION = 0.25  # default kick interval as part of the watchdog period
+WATCHDOG_KICK_CMD = 0x40  # any transfer resets the watchdog, the status register is the cheapest
+busArbiter = BusArbiter(BUS_LOCK_PATH)
+pidFile = None  # kept open and locked while the service runs
+transport = None
+daemonLog = None
+CONNECT_RETRY = 1  # [s] first delay before opening the I2C bus again
+CONNECT_RETRY_MAX = 60  # [s]
+connectRetry = CONNECT_RETRY
+watchdogFeeder = None
+functionAuth = {}  # user function -> ((command, script stat), argv prefix or None)
+stateFile = None
+stateSnapshot = None  # last snapshot with the power status, kept between reads
+STATE_PENDING_MAX_AGE = 60  # [s] queued user functions older than this are not resumed
+watchdogActive = False  # the service armed the watchdog
+shutdownCoordinator = ShutdownCoordinator(HALT_FILE)
+LOW_ENERGY_EVENTS = ('low_charge', 'low_battery_voltage', 'no_power')
+metrics = Metrics()
+I2C_OPERATIONS = ('ReadData', 'WriteData', 'WriteDataVerify')
+LOOP_BUDGET = 0.1  # [s] of work per loop iteration before it counts as an overrun
+STATS_DUMP_INTERVAL = 60  # [s]
 
-def _SystemHalt(event):
-    if (event in ('low_charge', 'low_battery_voltage', 'no_power')
-        and configData.get('system_task', {}).get('wakeup_on_charge', {}).get('enabled', False)
-        and 'trigger_level' in configData['system_task']['wakeup_on_charge']):
+class Scheduler:
+    """
+    Multiplexes the periodic checks on one selectors loop.
 
+    Every task has a period on mains, a (usually shorter) period on battery
+    and a deadline. The loop sleeps until the earliest deadline and then runs
+    all tasks that are due, so checks with overlapping windows share one wakeup.
+    The optional prepare callback gets the names of the due tasks before they run.
+    One-shot timers run on the same loop before the periodic tasks.
+    """
+    def __init__(self, prepare=None):
+        self.selector = selectors.DefaultSelector()
+        self.prepare = prepare
+        self.onBattery = False
+        self.lateCnt = 0
+        self._tasks = {}
+        self._timers = {}
+
+    def AddTask(self, name, func, mainsPeriod, batteryPeriod, deadline):
+        # re-adding an existing task only updates its timing
+        task = self._tasks.setdefault(name, {'due': time.monotonic()})
+        task['func'] = func
+        self.SetPeriods(name, mainsPeriod, batteryPeriod, deadline)
+
+    def RemoveTask(self, name):
+        self._tasks.pop(name, None)
+
+    def Trigger(self, name):
+        """ Makes a registered task due now """
+        task = self._tasks.get(name)
+        if task is not None:
+            task['due'] = min(task['due'], time.monotonic())
+
+    def SetPeriods(self, name, mainsPeriod, batteryPeriod, deadline):
+        task = self._tasks[name]
+        task['mains'] = float(mainsPeriod)
+        task['battery'] = float(batteryPeriod)
+        task['deadline'] = float(deadline)
+        task['due'] = min(task['due'], time.monotonic() + self._Period(task))
+
+    def SetTimer(self, name, delay, func):
+        # setting a pending timer again postpones it, so bursts collapse into one call
+        self._timers[name] = (time.monotonic() + delay, func)
+
+    def CancelTimer(self, name):
+        self._timers.pop(name, None)
+
+    def SetOnBattery(self, onBattery):
+        if onBattery == self.onBattery:
+            return
+        logging.debug("scheduler: switch to %s cadence", 'battery' if onBattery else 'mains')
+        self.onBattery = onBattery
+        now = time.monotonic()
+        for task in self._tasks.values():
+            # tighten pending timers immediately, relaxed ones catch up on their next run
+            task['due'] = min(task['due'], now + self._Period(task))
+
+    def RunOnce(self):
+        timeout = None
+        wakeups = [t['due'] + t['deadline'] for t in self._tasks.values()]
+        wakeups += [due for due, func in self._timers.values()]
+        if wakeups:
+            timeout = max(0, min(wakeups) - time.monotonic())
+        for key, mask in self.selector.select(timeout):
+            key.data(key.fileobj, mask)
+        now = time.monotonic()
+        lateCnt = self.lateCnt
+        for name, (due, func) in list(self._timers.items()):
+            if due <= now:
+                del self._timers[name]
+                func()
+        due = [name for name, task in self._tasks.items() if task['due'] <= now]
+        if due and self.prepare:
+            self.prepare(due)
+        for name in due:
+            task = self._tasks[name]
+            late = now - task['due'] - task['deadline']
+            if late > SCHEDULE_LATE_MARGIN:
+                self.lateCnt += 1
+                logging.debug("scheduler: %s ran %.3fs after its deadline", name, late)
+            task['func']()
+            period = self._Period(task)
+            task['due'] += period
+            if task['due'] <= now:
+                task['due'] = now + period  # skip missed periods instead of bursting
+        # the time spent sleeping in select is not part of the loop
+        duration = time.monotonic() - now
+        metrics.Record('loop', duration)
+        if duration > LOOP_BUDGET:
+            metrics.Count('loop.overrun')
+        if self.lateCnt != lateCnt:
+            metrics.Count('loop.late', self.lateCnt - lateCnt)
+
+    def _Period(self, task):
+        return task['battery'] if self.onBattery else task['mains']
+
+class FunctionRunner:
+    """
+    Runs user functions as child processes without blocking the main loop.
+
+    At most 'workers' functions run at the same time and every function at
+    most once, further calls wait in a queue where a call identical to an
+    already queued one is dropped. Urgent calls go to the front of the queue
+    and start even when all workers are busy. Children are reaped on SIGCHLD,
+    a scheduler timer kills the ones running longer than their timeout.
+    """
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.workers = FUNCTION_WORKERS
+        self.timeout = FUNCTION_TIMEOUT
+        self.timeouts = {}
+        self.results = collections.deque(maxlen=FUNCTION_RESULTS)
+        self._queue = collections.deque()
+        self._running = []
+
+    def Configure(self, workers=None, timeout=None, timeouts=None):
+        self.workers = workers or FUNCTION_WORKERS
+        self.timeout = timeout or FUNCTION_TIMEOUT
+        self.timeouts = timeouts or {}
+
+    def Submit(self, name, args, event, param='', urgent=False):
+        job = {'name': name, 'args': args, 'event': event, 'param': param, 'urgent': urgent}
+        if any(j['name'] == name and j['args'] == args for j in self._queue):
+            logging.debug("function %s for %s already queued", name, event)
+            return
+        if urgent:
+            self._queue.appendleft(job)
+        else:
+            self._queue.append(job)
+        self.Poll()
+
+    def Poll(self):
+        now = time.monotonic()
+        for job in list(self._running):
+            ret = job['proc'].poll()
+            if ret is not None:
+                self._running.remove(job)
+                self._Finish(job, ret, now)
+            elif 'killed' in job:
+                if now - job['killed'] >= FUNCTION_KILL_GRACE:
+                    self._Kill(job, signal.SIGKILL)
+            elif now - job['start'] >= job['timeout']:
+                logging.warning("function %s for %s timed out after %ss", job['name'], job['event'], job['timeout'])
+                self._Kill(job, signal.SIGTERM)
+                job['killed'] = now
+        self._StartQueued(now)
+        self._ArmTimer(now)
+
+    def Pending(self):
+        return len(self._running) + len(self._queue)
+
+    def Queued(self):
+        """ (function, event, parameter) of the calls not started yet """
+        return tuple((j['name'], j['event'], str(j['param'])) for j in self._queue)
+
+    def Drain(self, timeout):
+        # used when exiting, waits for the started and queued functions
+        end = time.monotonic() + timeout
+        while self.Pending() and time.monotonic() < end:
+            self.Poll()
+            time.sleep(0.05)
+
+    def _StartQueued(self, now):
+        for job in list(self._queue):
+            if any(j['name'] == job['name'] for j in self._running):
+                continue
+            if len(self._running) >= self.workers and not job['urgent']:
+                continue
+            self._queue.remove(job)
+            job['start'] = now
+            job['timeout'] = self.timeouts.get(job['name'], self.timeout)
+            try:
+                logging.debug("execute: %s", job['args'])
+                job['proc'] = subprocess.Popen(job['args'], stdin=subprocess.DEVNULL, start_new_session=True)
+            except OSError:
+                logging.exception('Failed to execute user func')
+                self._Finish(job, None, now)
+                continue
+            self._running.append(job)
+
+    def _ArmTimer(self, now):
+        kills = []
+        for job in self._running:
+            if 'killed' in job:
+                kills.append(job['killed'] + FUNCTION_KILL_GRACE)
+            else:
+                kills.append(job['start'] + job['timeout'])
+        if kills:
+            self.scheduler.SetTimer('functions', max(0, min(kills) - now), self.Poll)
+
+    def _Kill(self, job, signum):
         try:
-            tl = float(configData['system_task']['wakeup_on_charge']['trigger_level'])
-            pijuice.power.SetWakeUpOnCharge(tl)
-        except:
-            tl = None
-    pijuice.status.SetLedBlink('D2', 3, [150, 0, 0], 200, [0, 100, 0], 200)
-    # Setting halt flag for 'pijuice_sys.py stop'
-    with open(HALT_FILE, 'w') as f:
-        pass
-    logging.info("halting the system")
-    subprocess.call(["sudo", "halt"])
+            os.killpg(job['proc'].pid, signum)
+        except OSError:
+            pass
+
+    def _Finish(self, job, returncode, now):
+        duration = now - job['start']
+        metrics.Record('function.' + job['name'], duration, returncode != 0)
+        self.results.append({'function': job['name'], 'event': job['event'], 'returncode': returncode,
+                             'duration': duration, 'timedOut': 'killed' in job, 'time': time.time()})
+        if returncode == 0:
+            logging.debug("function %s for %s finished after %.2fs", job['name'], job['event'], duration)
+        else:
+            logging.warning("function %s for %s failed with %s after %.2fs", job['name'], job['event'], returncode, duration)
+
+class WatchdogFeeder(threading.Thread):
+    """
+    Resets the PiJuice watchdog from its own thread, independent of how busy
+    the main loop is. Kicks are one byte status reads with the highest bus
+    priority on a fixed schedule, a late kick does not shift the later ones.
+    Jitter is the delay between the scheduled and the finished kick.
+    """
+    def __init__(self, interface, interval):
+        super().__init__(name='watchdog', daemon=True)
+        self.interface = interface
+        self.interval = interval
+        self.kicks = 0
+        self.failures = 0
+        self.jitterMax = 0.0
+        self.jitterSum = 0.0
+        self.gapMax = 0.0
+        self._lastKick = None
+        self._stopEvent = threading.Event()
+
+    def run(self):
+        busArbiter.SetThreadPriority(PRIORITY_WATCHDOG)
+        due = time.monotonic()
+        while not self._stopEvent.wait(max(0, due - time.monotonic())):
+            ret = self.interface.ReadData(WATCHDOG_KICK_CMD, 1)
+            now = time.monotonic()
+            if ret['error'] == 'NO_ERROR':
+                jitter = now - due
+                self.kicks += 1
+                self.jitterSum += jitter
+                self.jitterMax = max(self.jitterMax, jitter)
+                if self._lastKick is not None:
+                    self.gapMax = max(self.gapMax, now - self._lastKick)
+                self._lastKick = now
+            else:
+                self.failures += 1
+                logging.warning("watchdog kick failed: %s", ret['error'])
+            due += self.interval
+            if due <= now:
+                due = now + self.interval
+
+    def Stop(self):
+        self._stopEvent.set()
+
+    def Stats(self):
+        return {
+            'interval': self.interval,
+            'kicks': self.kicks,
+            'failures': self.failures,
+            'jitterMean': self.jitterSum / self.kicks if self.kicks else None,
+            'jitterMax': self.jitterMax,
+            'gapMax': self.gapMax,
+        }
+
+def _SystemHalt(event, powerOff=None, switchOff=False):
+    # wakeup on charge only makes sense when running out of energy
+    shutdownCoordinator.Run(pijuice, event, powerOff, switchOff, wakeup=event in LOW_ENERGY_EVENTS)
+
+def _ConfigureShutdown():
+    shutdownCoordinator.Arm(settings.shutdownBudget, settings.shutdownPowerOffDelay,
+                            settings.wakeupTriggerLevel if settings.wakeupOnChargeEn else None,
+                            settings.shutdownHooks, _AuthorizeFunction)
 
 def ExecuteFunc(func, event, param):
-    logging.info("event %s executing function: %s" % (event, func))
+    logging.info("event %s executing function: %s", event, func)
+    # system functions power down the board, they go ahead of everything else on the bus
+    start = time.perf_counter()
+    with busArbiter.Priority(PRIORITY_POWER):
+        _ExecuteFunc(func, event, param)
+    metrics.Record('execute', time.perf_counter() - start)
+
+def _ExecuteFunc(func, event, param):
     if func == 'SYS_FUNC_HALT':
         _SystemHalt(event)
     elif func == 'SYS_FUNC_HALT_POW_OFF':
-        pijuice.power.SetSystemPowerSwitch(0)
-        pijuice.power.SetPowerOff(60)
-        _SystemHalt(event)
+        _SystemHalt(event, powerOff=True, switchOff=True)
     elif func == 'SYS_FUNC_SYS_OFF_HALT':
-        pijuice.power.SetSystemPowerSwitch(0)
-        _SystemHalt(event)
+        _SystemHalt(event, switchOff=True)
     elif func == 'SYS_FUNC_REBOOT':
         subprocess.call(["sudo", "reboot"])
-    elif ('USER_FUNC' in func) and ('user_functions' in configData) and (func in configData['user_functions']):
-        function=configData['user_functions'][func]
-        # Check function is defined
-        if function == "":
-            return
-        # Remove possible argumemts
-        cmd = function.split()[0]
+    elif ('USER_FUNC' in func) and (func in settings.userFunctions):
+        argv = _AuthorizeFunction(func)
+        if argv:
+            functionRunner.Submit(func, argv + [str(event), str(param)], event, param, urgent=event in URGENT_EVENTS)
 
-        # Check cmd is an executable file and the file owner belongs
-        # to the pijuice group.
-        # If so, execute the command as the file owner
 
-        try:
-            statinfo = os.stat(cmd)
-        except:
-            # File not found
-            return
-        # Check cmd has executable permission
-        if statinfo.st_mode & stat.S_IXUSR == 0:
-            logging.error(cmd + " is not executable")
-            return
-        # Get owner and ownergroup names
+def _AuthorizeFunction(func):
+    """
+    Returns the argv prefix of user function 'func' or None if it may not be
+    run. The result is kept in functionAuth and only computed again when the
+    command or the stat of the script changed.
+    """
+    function = settings.userFunctions.get(func, "")
+    # Remove possible argumemts
+    cmd = function.split()[0] if function.strip() else None
+    try:
+        statinfo = os.stat(cmd) if cmd else None
+    except OSError:
+        statinfo = None
+    key = (function, statinfo and (statinfo.st_ino, statinfo.st_mtime_ns, statinfo.st_mode,
+                                   statinfo.st_uid, statinfo.st_gid))
+    cached = functionAuth.get(func)
+    if cached and cached[0] == key:
+        return cached[1]
+    argv = _CheckFunction(cmd, statinfo)
+    functionAuth[func] = (key, argv)
+    return argv
+
+def _CheckFunction(cmd, statinfo):
+    # Check cmd is an executable file and the file owner belongs
+    # to the pijuice group.
+    # If so, execute the command as the file owner
+    if statinfo is None:
+        # Not defined or file not found
+        return None
+    # Check cmd has executable permission
+    if statinfo.st_mode & stat.S_IXUSR == 0:
+        logging.error("%s is not executable", cmd)
+        return None
+    # Get owner and ownergroup names
+    try:
         owner = pwd.getpwuid(statinfo.st_uid).pw_name
         ownergroup = grp.getgrgid(statinfo.st_gid).gr_name
-        if not allowAllScripts:
-            # Do not allow programs owned by root
-            if owner == 'root':
-                logging.error("root owned " + cmd + " not allowed")
-                return
-            # Owner of cmd must belong to mygroup ('pijuice')
-            mygroup = grp.getgrgid(os.getegid()).gr_name
-            # Find all groups owner belongs too
-            groups = [g.gr_name for g in grp.getgrall() if owner in g.gr_mem]
-            groups.append(ownergroup) # append primary group
-            # Does owner belong to mygroup?
-            found = 0
-            for g in groups:
-                if g == mygroup:
-                    found = 1
-                    break
-            if found == 0:
-                logging.error(cmd + " owner ('" + owner + "') does not belong to '" + mygroup + "'")
-                return
-        # All checks passed
-        cmd = "sudo -u " + owner + " " + cmd + " {event} {param}".format(
-                                                      event=str(event),
-                                                      param=str(param))
-        try:
-            logging.debug("execute: '%s'" % cmd)
-            os.system(cmd)
-        except:
-            logging.exception('Failed to execute user func')
+    except KeyError:
+        logging.error("%s owner unknown", cmd)
+        return None
+    if not allowAllScripts:
+        # Do not allow programs owned by root
+        if owner == 'root':
+            logging.error("root owned %s not allowed", cmd)
+            return None
+        # Owner of cmd must belong to mygroup ('pijuice'), either as member
+        # or through the group of the file
+        mygroup = grp.getgrgid(os.getegid())
+        if ownergroup != mygroup.gr_name and owner not in mygroup.gr_mem:
+            logging.error("%s owner ('%s') does not belong to '%s'", cmd, owner, mygroup.gr_name)
+            return None
+    # All checks passed
+    return ["sudo", "-u", owner, cmd]
+
+def _AuthorizeFunctions():
+    # resolve all configured functions up front, off the event path
+    functionAuth.clear()
+    for func in settings.userFunctions:
+        _AuthorizeFunction(func)
 
 
 def _EvalButtonEvents():
@@ -148,18 +476,15 @@ def _EvalCharge(status):
       or (status['powerInput'] == 'PRESENT')
       or (status['powerInput5vIo'] == 'PRESENT')):
         return True
-    charge = pijuice.status.GetChargeLevel()
-    if charge['error'] == 'NO_ERROR':
-        level = float(charge['data'])
+    if snapshot.chargeLevel is not None:
+        level = float(snapshot.chargeLevel)
         global chargeLevel
-        if ('threshold' in configData['system_task']['min_charge']):
-            th = float(configData['system_task']['min_charge']['threshold'])
+        th = settings.minChgThreshold
+        if th is not None:
             if level == 0 or ((level < th) and ((chargeLevel-level) >= 0 and (chargeLevel-level) < 3)):
-                global lowChgEn
-                if lowChgEn:
+                if settings.lowChgEn:
                     # energy is low, take action
-                    ExecuteFunc(configData['system_events']['low_charge']['function'],
-                                'low_charge', level)
+                    ExecuteFunc(settings.eventFunctions['low_charge'], 'low_charge', level)
 
         chargeLevel = level
         return True
@@ -172,18 +497,13 @@ def _EvalBatVoltage(status):
       or (status['powerInput'] == 'PRESENT')
       or (status['powerInput5vIo'] == 'PRESENT')):
         return True
-    bv = pijuice.status.GetBatteryVoltage()
-    if bv['error'] == 'NO_ERROR':
-        v = float(bv['data']) / 1000
-        try:
-            th = float(configData['system_task'].get('min_bat_voltage', {}).get('threshold'))
-        except ValueError:
-            th = None
+    if snapshot.batteryVoltage is not None:
+        v = float(snapshot.batteryVoltage) / 1000
+        th = settings.minBatVolThreshold
         if th is not None and v < th:
-            global lowBatVolEn
-            if lowBatVolEn:
+            if settings.lowBatVolEn:
                 # Battery voltage below thresholdw, take action
-                ExecuteFunc(configData['system_events']['low_battery_voltage']['function'], 'low_battery_voltage', v)
+                ExecuteFunc(settings.eventFunctions['low_battery_voltage'], 'low_battery_voltage', v)
 
         return True
     else:
@@ -192,130 +512,525 @@ def _EvalBatVoltage(status):
 NO_POWER_STATUSES = ['NOT_PRESENT', 'BAD']
 def _EvalPowerInputs(status):
     if (status['battery'] == 'NOT_PRESENT'): return
-    global noPowCnt, PowCnt
-    if status['powerInput'] in NO_POWER_STATUSES and status['powerInput5vIo'] in NO_POWER_STATUSES:
-        # power is absent
-        if noPowCnt:
-            PowCnt = 0 # enable checking for return of power
-        noPowCnt = min(noPowCnt + 1, 3)
-        if noPowEn and noPowCnt == 2:
-            # unplugged
-            ExecuteFunc(configData['system_events']['no_power']['function'],
-                                   'no_power', '')
-    else:
-        # power is present
-        if PowCnt:
-            noPowCnt = 0
-        PowCnt = min(PowCnt + 1, 3)
-        if PowEn and PowCnt == 2:
-            ExecuteFunc(configData['system_events']['power']['function'],
-                                   'power', '')
+    global powerPresent, powerChangeTime
+    present = not (status['powerInput'] in NO_POWER_STATUSES and status['powerInput5vIo'] in NO_POWER_STATUSES)
+    if present == powerPresent:
+        powerChangeTime = None
+        return
+    now = time.monotonic()
+    if powerChangeTime is None:
+        powerChangeTime = now
+    if now - powerChangeTime < powerDebounce:
+        return
+    powerPresent = present
+    powerChangeTime = None
+    if not present:
+        # unplugged
+        if settings.noPowEn:
+            ExecuteFunc(settings.eventFunctions['no_power'], 'no_power', '')
+    elif settings.PowEn:
+        ExecuteFunc(settings.eventFunctions['power'], 'power', '')
 
 def _EvalFaultFlags():
     faults = pijuice.status.GetFaultStatus()
     if faults['error'] == 'NO_ERROR':
         faults = faults['data']
         for f in (pijuice.status.faultEvents + pijuice.status.faults):
-            if f in faults:
-                if sysEvEn and (f in configData['system_events']) and ('enabled' in configData['system_events'][f]) and configData['system_events'][f]['enabled']:
-                    if configData['system_events'][f]['function'] != 'USER_EVENT':
-                        pijuice.status.ResetFaultFlags([f])
-                        ExecuteFunc(configData['system_events'][f]['function'],
-                                    f, faults[f])
+            if f in faults and f in settings.eventFunctions:
+                if settings.eventFunctions[f] != 'USER_EVENT':
+                    pijuice.status.ResetFaultFlags([f])
+                    ExecuteFunc(settings.eventFunctions[f], f, faults[f])
         return True
     else:
         return False
 
+def _ReadSnapshot(due):
+    """
+    Reads the registers needed by all checks due in this wakeup in one pass
+    and shares the snapshot between them.
+    """
+    global snapshot, status
+    snapshot = None
+    if not settings.serviceEnabled or snapshotReader is None:
+        return
+    fields = ['status']
+    if 'charge' in due and settings.minChgEn:
+        fields.append('chargeLevel')
+    if 'voltage' in due and settings.minBatVolEn:
+        fields.append('batteryVoltage')
+    if 'history' in due and settings.historyEn:
+        fields = ALL_FIELDS
+    with busArbiter.Priority(PRIORITY_POWER if 'power' in due else PRIORITY_TELEMETRY):
+        snap = snapshotReader.Read(fields)
+    if snap.battery is None:
+        if not transport.IsOpen():  # an open breaker already logged the failing bus
+            logging.error("failed to get status: %s", snap.error)
+        return
+    snapshot = snap
+    status = snap.StatusDict()
+    if statusPage:
+        statusPage.Publish(snap)
+    # every status read shows pending button events and faults, their checks
+    # do not have to wait for their own (long) period
+    if snap.isButton and 'button' not in due:
+        scheduler.Trigger('button')
+    if snap.isFault and 'faults' not in due:
+        scheduler.Trigger('faults')
+    scheduler.SetOnBattery(status['battery'] != 'NOT_PRESENT'
+                           and status['powerInput'] in NO_POWER_STATUSES
+                           and status['powerInput5vIo'] in NO_POWER_STATUSES)
+
+def _TaskButton():
+    if snapshot and snapshot.isButton:
+        _EvalButtonEvents()
+
+def _TaskFaults():
+    if snapshot and snapshot.isFault:
+        _EvalFaultFlags()
+
+def _TaskCharge():
+    if snapshot and settings.minChgEn:
+        _EvalCharge(status)
+
+def _TaskVoltage():
+    if snapshot and settings.minBatVolEn:
+        _EvalBatVoltage(status)
+
+def _TaskPower():
+    if snapshot and (settings.noPowEn or settings.PowEn):
+        _EvalPowerInputs(status)
+
+def _TaskHistory():
+    if snapshot and history:
+        history.Append(snapshot)
+
+SCHEDULE_TASKS = {
+    'button': _TaskButton,
+    'faults': _TaskFaults,
+    'charge': _TaskCharge,
+    'voltage': _TaskVoltage,
+    'power': _TaskPower,
+    'history': _TaskHistory,
+}
+# checks that only run while something acts on their result
+SCHEDULE_NEEDED = {
+    'button': lambda: any(e.get('function', '').startswith(('SYS_FUNC', 'USER_FUNC'))
+                          for events in btConfig.values() for e in events.values()),
+    'faults': lambda: any(settings.eventFunctions.get(f, 'USER_EVENT') != 'USER_EVENT' for f in FAULT_EVENTS),
+    'charge': lambda: settings.minChgEn and settings.lowChgEn,
+    'voltage': lambda: settings.minBatVolEn and settings.lowBatVolEn,
+    'power': lambda: settings.noPowEn or settings.PowEn,
+    'history': lambda: settings.historyEn,
+}
+
+def _ConfigureScheduler():
+    global scheduler
+    global powerDebounce
+    global powerChangeTime
+    if scheduler is None:
+        scheduler = Scheduler(_ReadSnapshot)
+    schedule = settings.schedule
+    for name, func in SCHEDULE_TASKS.items():
+        needed = SCHEDULE_NEEDED.get(name)
+        if needed and not needed():
+            scheduler.RemoveTask(name)
+            if name == 'power':
+                powerChangeTime = None  # a debounce in progress is void
+            continue
+        period, batteryPeriod, deadline = SCHEDULE_DEFAULTS[name]
+        conf = schedule.get(name, {})
+        try:
+            period, batteryPeriod, deadline = (float(conf.get('period', period)),
+                                               float(conf.get('battery_period', batteryPeriod)),
+                                               float(conf.get('deadline', deadline)))
+        except ValueError:
+            logging.error("invalid schedule for %s: %s", name, conf)
+        scheduler.AddTask(name, func, period, batteryPeriod, deadline)
+    try:
+        powerDebounce = float(schedule.get('power', {}).get('debounce', POWER_DEBOUNCE))
+    except ValueError:
+        logging.error("invalid power debounce: %s", schedule['power'])
+
+def _ConfigureFunctionRunner():
+    global functionRunner
+    if functionRunner is None:
+        functionRunner = FunctionRunner(scheduler)
+    functionRunner.Configure(settings.functionWorkers, settings.functionTimeout, settings.functionTimeouts)
+
+def _QuerySnapshot(fields):
+    global querySnapshot
+    now = time.time()
+    for snap in (snapshot, querySnapshot):
+        if snap and now - snap.time < QUERY_MAX_AGE and snap.Has(fields):
+            return snap
+    querySnapshot = snapshotReader.Read(fields)
+    if statusPage and querySnapshot.fields:
+        statusPage.Publish(querySnapshot)
+    return querySnapshot
+
+def _HandleQuery(request):
+    # bus reads on behalf of clients have the lowest priority
+    with busArbiter.Priority(PRIORITY_CLI):
+        return _Query(request)
+
+def _Query(request):
+    global firmwareVersion
+    cmd = request.get('cmd')
+    if cmd in ('status', 'firmware') and pijuice is None:
+        return {'error': 'NOT_CONNECTED'}
+    if cmd == 'status':
+        fields = [f for f in (request.get('fields') or ALL_FIELDS) if f in ALL_FIELDS]
+        snap = _QuerySnapshot(fields)
+        return {'error': snap.error, 'data': snap.ToDict()}
+    elif cmd == 'config':
+        return {'error': 'NO_ERROR', 'data': configData}
+    elif cmd == 'firmware':
+        if firmwareVersion is None:
+            ret = pijuice.config.GetFirmwareVersion()
+            if ret['error'] != 'NO_ERROR':
+                return ret
+            firmwareVersion = ret
+            deviceConfig.firmware = ret['data']['version']
+        return firmwareVersion
+    elif cmd == 'watchdog':
+        if watchdogFeeder is None:
+            return {'error': 'NOT_RUNNING'}
+        return {'error': 'NO_ERROR', 'data': watchdogFeeder.Stats()}
+    elif cmd == 'log':
+        if daemonLog is None:
+            return {'error': 'NOT_RUNNING'}
+        level = logging.getLevelName(request.get('level') or 'DEBUG')
+        if not isinstance(level, int):
+            return {'error': 'BAD_REQUEST'}
+        return {'error': 'NO_ERROR', 'data': daemonLog.ring.Lines(level, request.get('lines'))}
+    elif cmd == 'poweroff':
+        # answer first, the halt runs from the main loop
+        if shutdownCoordinator.halting:
+            return {'error': 'ALREADY_HALTING'}
+        delay = request.get('delay')
+        if delay is not None and not isinstance(delay, int):
+            return {'error': 'BAD_REQUEST'}
+        delay = delay or True
+        wakeup = bool(request.get('wakeup'))
+        scheduler.SetTimer('shutdown', 0, lambda: _PowerOff(delay, wakeup))
+        return {'error': 'NO_ERROR'}
+    elif cmd == 'shutdown':
+        if shutdownCoordinator.report is None:
+            return {'error': 'NOT_RUNNING'}
+        return {'error': 'NO_ERROR', 'data': shutdownCoordinator.report}
+    elif cmd == 'stats':
+        stats = metrics.Snapshot()
+        return {'error': 'NO_ERROR', 'data': FormatStats(stats) if request.get('text') else stats}
+    elif cmd == 'bus':
+        return {'error': 'NO_ERROR', 'data': {'wait': busArbiter.Stats(),
+                                              'transport': transport.Stats() if transport else None}}
+    return {'error': 'UNKNOWN_COMMAND'}
+
+def _PowerOff(delay, wakeup):
+    with busArbiter.Priority(PRIORITY_POWER):
+        shutdownCoordinator.Run(pijuice, 'poweroff', delay, switchOff=True, wakeup=wakeup)
+
+def _ConfigureHistory():
+    global history
+    path = settings.historyPath or HISTORY_PATH
+    capacity = settings.historyCapacity or HISTORY_CAPACITY
+    if history and (not settings.historyEn or history.path != path or history.capacity != capacity):
+        history.Close()
+        history = None
+    if settings.historyEn and not history:
+        try:
+            history = HistoryStore(path, capacity)
+        except (OSError, ValueError):
+            logging.exception("failed to open history %s", path)
+
+def _OpenStatusPage():
+    global statusPage
+    path = settings.statusPagePath or STATUS_PAGE_PATH
+    try:
+        statusPage = StatusPage(path)
+    except OSError:
+        logging.exception("failed to open status page %s", path)
+
+def _StartWatchdogFeeder():
+    global watchdogFeeder
+    _StopWatchdogFeeder()
+    interval = settings.watchdogKickInterval or max(1.0, settings.watchdogPeriod * 60 * WATCHDOG_KICK_FRACTION)
+    logging.debug("watchdog: kick every %.1fs", interval)
+    watchdogFeeder = WatchdogFeeder(pijuice.interface, interval)
+    watchdogFeeder.start()
+
+def _StopWatchdogFeeder():
+    global watchdogFeeder
+    if watchdogFeeder:
+        watchdogFeeder.Stop()
+        watchdogFeeder = None
+
 def _ConfigureWatchdog(state):
+    # failed transfers are retried by the transport
+    global watchdogActive
+    if pijuice is None:
+        return
+    watchdogActive = state == 'ACTIVATE' and bool(settings.watchdogPeriod)
     try:
         if state == 'ACTIVATE':
-            if ('period' in configData['system_task']['watchdog']):
-                p = int(configData['system_task']['watchdog']['period'])
-                ret = pijuice.power.SetWatchdog(p)
+            if settings.watchdogPeriod is not None:
+                ret = pijuice.power.SetWatchdog(settings.watchdogPeriod)
+                # kick even if the reply got lost, the watchdog may be armed anyway
+                if settings.watchdogPeriod > 0:
+                    _StartWatchdogFeeder()
             else:
                 # Disable watchdog
+                _StopWatchdogFeeder()
                 ret = pijuice.power.SetWatchdog(0)
-                if ret['error'] != 'NO_ERROR':
-                    time.sleep(0.05)
-                    pijuice.power.SetWatchdog(0)
         else:
             # Disabling watchdog
+            _StopWatchdogFeeder()
             ret = pijuice.power.SetWatchdog(0)
-            if ret['error'] != 'NO_ERROR':
-                time.sleep(0.05)
-                ret = pijuice.power.SetWatchdog(0)
+        if ret['error'] != 'NO_ERROR':
+            logging.error("failed to configure watchdog: %s", ret['error'])
     except:
         pass
 
 def _LoadConfiguration():
-    global pijuice
+    global settings
     global configData
-    global btConfig
-    global sysEvEn
-    global minChgEn
-    global minBatVolEn
-    global watchdogEn
-    global lowChgEn
-    global lowBatVolEn
-    global noPowEn
-    global PowEn
-    global sysStartEvEn
-    global sysStopEvEn
-
-    with open(configPath, 'r') as outputConfig:
-        config_dict = json.load(outputConfig)
-        configData.update(config_dict)
-
-    sysEvEn = 'system_events' in configData
-    minChgEn = configData.get('system_task', {}).get('min_charge', {}).get('enabled', False)
-    minBatVolEn = configData.get('system_task', {}).get('min_bat_voltage', {}).get('enabled', False)
-    watchdogEn = configData.get('system_task', {}).get('enabled') and configData.get('system_task', {}).get('watchdog', {}).get('enabled', False)
-    lowChgEn = sysEvEn and configData.get('system_events', {}).get('low_charge', {}).get('enabled', False)
-    lowBatVolEn = sysEvEn and configData.get('system_events', {}).get('low_battery_voltage', {}).get('enabled', False)
-    noPowEn = sysEvEn and configData.get('system_events', {}).get('no_power', {}).get('enabled', False)
-    PowEn = sysEvEn and configData.get('system_events', {}).get('power', {}).get('enabled', False)
-    sysStartEvEn = sysEvEn and configData.get('system_events', {}).get('sys_start', {}).get('enabled', False)
-    sysStopEvEn = sysEvEn and configData.get('system_events', {}).get('sys_stop', {}).get('enabled', False)
 
+    settings = LoadSettings(configPath)
+    configData = settings.data
+    _AuthorizeFunctions()
+    _ConfigureShutdown()
+
+def _Connect(probe=True):
+    """
+    Opens the PiJuice. If the I2C bus is not available (yet) the service keeps
+    running without it and tries again with growing delays. Without 'probe'
+    the firmware version and the button configuration are not read.
+    """
+    global pijuice
+    global snapshotReader
+    global querySnapshot
+    global firmwareVersion
+    global deviceConfig
+    global transport
+    global connectRetry
+
+    querySnapshot = None
+    firmwareVersion = None
     try:
-        addr = I2C_ADDRESS_DEFAULT
-        bus = I2C_BUS_DEFAULT
-
-        if 'board' in configData and 'general' in configData['board']:
-            if 'i2c_addr' in configData['board']['general']:
-                addr = int(configData['board']['general']['i2c_addr'], 16)
-            if 'i2c_bus' in configData['board']['general']:
-                bus = configData['board']['general']['i2c_bus']
-        pijuice = PiJuice(bus, addr)
+        if SimulationSelected(settings):
+            from pijuice_sim import OpenPiJuice
+            pijuice = OpenPiJuice(settings.i2cBus, settings.i2cAddr, settings.simulation)
+        else:
+            pijuice = PiJuice(settings.i2cBus, settings.i2cAddr)
     except:
-        sys.exit(0)
+        pijuice = snapshotReader = transport = None
+        logging.error("failed to open I2C bus %s, retry in %ss", settings.i2cBus, connectRetry)
+        scheduler.SetTimer('connect', connectRetry, _Reconnect)
+        connectRetry = min(connectRetry * 2, CONNECT_RETRY_MAX)
+        return False
+    connectRetry = CONNECT_RETRY
+    scheduler.CancelTimer('connect')
+    # the watchdog feeder thread shares the interface with the main loop
+    busArbiter.Attach(pijuice.interface)
+    transport = ResilientTransport(pijuice.interface, settings.i2cBus, settings.i2cAddr,
+                                   settings.busRetries, settings.busBackoff,
+                                   settings.busBreakerThreshold, settings.busBreakerTime, busArbiter).Attach()
+    # outermost, so retries and the wait for the bus are part of the timing
+    metrics.Instrument(pijuice.interface, 'i2c', I2C_OPERATIONS)
+    for name in ('status', 'power', 'config'):
+        metrics.Instrument(getattr(pijuice, name), name)
+    snapshotReader = SnapshotReader(pijuice.interface)
+    if not probe:
+        return True
 
+    # the button configuration cache is only valid for this firmware version
+    ret = pijuice.config.GetFirmwareVersion()
+    if ret['error'] == 'NO_ERROR':
+        firmwareVersion = ret
+    deviceConfig = CachedDeviceConfig(pijuice, firmwareVersion['data']['version'] if firmwareVersion else None)
+    _LoadButtonConfig()
+    return True
+
+def _Reconnect():
+    if _Connect():
+        logging.info("connected to PiJuice on bus %s address 0x%x", settings.i2cBus, settings.i2cAddr)
+        if settings.watchdogEn:
+            _ConfigureWatchdog('ACTIVATE')
+
+def _LoadButtonConfig():
+    global btConfig
+    if pijuice is None:
+        return
     try:
         for b in pijuice.config.buttons:
-            conf = pijuice.config.GetButtonConfiguration(b)
+            conf = deviceConfig.GetButtonConfiguration(b)
             if conf['error'] == 'NO_ERROR':
                 btConfig[b] = conf['data']
     except:
         pass
+    # the button check only runs while a button has a function of the service
+    if scheduler:
+        _ConfigureScheduler()
+
+def _LockPidFile(pid):
+    """
+    Single instance guard: the PID file stays open and locked while the
+    service runs, a second instance fails to lock it.
+    """
+    global pidFile
+    pidFile = open(PID_FILE, 'a+')
+    try:
+        fcntl.flock(pidFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        pidFile.close()
+        pidFile = None
+        return False
+    pidFile.seek(0)
+    pidFile.truncate()
+    pidFile.write(pid)
+    pidFile.flush()
+    return True
+
+def _OpenState():
+    global stateFile
+    stateFile = StateFile(settings.statePath or STATE_PATH)
+    return stateFile.Load()
+
+def _RestoreState(state):
+    """
+    Continues from the checkpoint of a previous run: events already handled
+    for the saved power state and charge level do not trigger again.
+    """
+    global powerPresent
+    global chargeLevel
+    global stateSnapshot
+    if state is None:
+        return
+    stateSnapshot = state.snapshot
+    powerPresent = state.powerPresent
+    if state.chargeLevel is not None:
+        chargeLevel = state.chargeLevel
+    s = state.snapshot
+    if s is not None:
+        scheduler.SetOnBattery(s.battery != 'NOT_PRESENT'
+                               and s.powerInput in NO_POWER_STATUSES
+                               and s.powerInput5vIo in NO_POWER_STATUSES)
+    logging.info("resuming saved state: power %s, charge level %s",
+                 'present' if powerPresent else 'missing', state.chargeLevel)
+    if state.pending and time.time() - state.savedAt < STATE_PENDING_MAX_AGE:
+        for func, event, param in state.pending:
+            ExecuteFunc(func, event, param)
+
+def _Checkpoint():
+    # only written when the power state, charge level, power status or queue changed
+    global stateSnapshot
+    if snapshot and snapshot.battery is not None:
+        stateSnapshot = snapshot
+    state = ServiceState(powerPresent, chargeLevel, stateSnapshot, watchdogActive, functionRunner.Queued())
+    try:
+        stateFile.Save(state)
+    except OSError as e:
+        logging.error("failed to save state to %s: %s", stateFile.path, e)
+
+def _DumpStats():
+    path = settings.statsDumpPath
+    if not path:
+        return
+    tmpPath = "%s.%d" % (path, os.getpid())
+    try:
+        with open(tmpPath, 'w') as f:
+            f.write(FormatStats(metrics.Snapshot()) + "\n")
+        os.rename(tmpPath, path)
+    except OSError as e:
+        logging.error("failed to write statistics to %s: %s", path, e)
+    scheduler.SetTimer('stats', settings.statsDumpInterval or STATS_DUMP_INTERVAL, _DumpStats)
+
+def _ConfigureStatsDump():
+    if settings.statsDumpPath:
+        scheduler.SetTimer('stats', settings.statsDumpInterval or STATS_DUMP_INTERVAL, _DumpStats)
+    else:
+        scheduler.CancelTimer('stats')
+
+def _FlushLog():
+    # report messages suppressed by the rate limit even if they do not come again
+    daemonLog.Flush()
+    scheduler.SetTimer('log', LOG_INTERVAL, _FlushLog)
+
+def _IgnoreSignal(signum, frame):
+    # the signal is handled on the main loop through the wakeup fd
+    pass
+
+def _OnSignal(sock, mask):
+    try:
+        signums = sock.recv(64)
+    except OSError:
+        return
+    if int(signal.SIGHUP) in signums:
+        scheduler.SetTimer('reload', RELOAD_DEBOUNCE, reload_settings)
+    if int(signal.SIGCHLD) in signums:
+        functionRunner.Poll()
+
+def _WatchSignals():
+    global signalSockets
+    # keep both ends referenced, the wakeup fd is only known by number
+    signalSockets = signalRecv, signalSend = socket.socketpair()
+    signalRecv.setblocking(False)
+    signalSend.setblocking(False)
+    signal.set_wakeup_fd(signalSend.fileno())
+    scheduler.selector.register(signalRecv, selectors.EVENT_READ, _OnSignal)
+    signal.signal(signal.SIGHUP, _IgnoreSignal)
+    signal.signal(signal.SIGCHLD, _IgnoreSignal)
 
 def reload_settings(signum=None, frame=None):
-    logging.info("reload configuration")
-    _LoadConfiguration() # Update configuration
-    global watchdogEn
-    if watchdogEn: _ConfigureWatchdog('ACTIVATE') # Update watchdog setting
+    """
+    Applies a changed configuration file. Only the parts affected by the
+    changed sections are rebuilt, the hardware is only accessed when the
+    I2C bus/address, the watchdog settings or a button configuration changed.
+    """
+    global settings
+    global configData
+    old = settings
+    try:
+        new = LoadSettings(configPath)
+    except (OSError, ValueError):
+        logging.exception("failed to reload configuration, keeping the current one")
+        return
+    # pijuice_ctl signals button changes too, unchanged buttons come from the cache
+    _LoadButtonConfig()
+    if new is old:
+        logging.info("reload configuration: unchanged")
+        return
+    logging.info("reload configuration: %s changed", ", ".join(sorted(new.changed)))
+    settings = new
+    configData = new.data
+
+    reconnect = (new.i2cBus, new.i2cAddr) != (old.i2cBus, old.i2cAddr)
+    if reconnect:
+        logging.info("reconnect to PiJuice on bus %s address 0x%x", new.i2cBus, new.i2cAddr)
+        _Connect()
+    if 'user_functions' in new.changed:
+        _AuthorizeFunctions()
+    if new.changed & {'user_functions', 'system_task'}:
+        _ConfigureShutdown()
+    if new.changed & {'system_task', 'system_events'}:
+        _ConfigureScheduler()
+    if 'system_task' in new.changed:
+        _ConfigureFunctionRunner()
+        _ConfigureHistory()
+        _ConfigureStatsDump()
+    if reconnect or (new.watchdogEn, new.watchdogPeriod) != (old.watchdogEn, old.watchdogPeriod):
+        if new.watchdogEn:
+            _ConfigureWatchdog('ACTIVATE')
+        elif old.watchdogEn:
+            _ConfigureWatchdog('DEACTIVATE')
 
 def main():
     global pijuice
     global configData
     global status
-    global minChgEn
-    global minBatVolEn
-    global watchdogEn
-    global noPowEn
-    global PowEn
-    global sysStartEvEn
-    global sysStopEvEn
     global allowAllScripts
+    global queryServer
+    global daemonLog
 
     parser = argparse.ArgumentParser(description="pijuice service")
     parser.add_argument('-v', '--verbose', action="store_true", help="verbose output")
@@ -326,20 +1041,21 @@ def main():
     args = parser.parse_args()
 
     pid = str(os.getpid())
-    with open(PID_FILE, 'w') as pid_f:
-        pid_f.write(pid)
+    if not 'stop' in args and not _LockPidFile(pid):
+        sys.stderr.write("pijuice_sys is already running\n")
+        sys.exit(1)
 
     if args.verbose:
         consoleLevel = logging.DEBUG
     else:
         consoleLevel = logging.INFO
-    logging.basicConfig(level=consoleLevel, format="%(asctime)s %(levelname)-6s: %(message)s")
+    daemonLog = DaemonLogging(consoleLevel)
 
     if not 'stop' in args:
         logging.info("### started ###")
     else:
         logging.debug("### started post stop ###")
-    logging.debug("PID: %s" % pid)
+    logging.debug("PID: %s", pid)
 
     if args.allowAllScripts:
         logging.info("allow execution of all scripts")
@@ -351,40 +1067,58 @@ def main():
             conf_f.write(json.dumps(configData))
 
     _LoadConfiguration()
+    _ConfigureScheduler()
+    _ConfigureFunctionRunner()
+    state = _OpenState()
 
     # Handle SIGHUP signal to reload settings
-    signal.signal(signal.SIGHUP, reload_settings)
+    _WatchSignals()
+    scheduler.SetTimer('log', LOG_INTERVAL, _FlushLog)
 
     if 'stop' in args:
-        if sysStopEvEn:
-            ExecuteFunc(configData['system_events']['sys_stop']['function'], 'sys_stop', configData)
+        if settings.sysStopEvEn:
+            ExecuteFunc(settings.eventFunctions['sys_stop'], 'sys_stop', configData)
 
         isHalting = False
         if os.path.exists(HALT_FILE):   # Created in _SystemHalt() called in main pijuice_sys process
             isHalting = True
             os.remove(HALT_FILE)
 
-        if watchdogEn: _ConfigureWatchdog('DEACTIVATE')
+        # the bus is only opened when something has to be written, the checkpoint
+        # of the service tells whether the watchdog is armed and the board is reachable
+        if settings.watchdogEn and (state is None or state.watchdogActive):
+            _Connect(probe=False)
+            _ConfigureWatchdog('DEACTIVATE')
 
         #sysJobTargets = subprocess.check_output(["sudo", "systemctl", "list-jobs"]).decode('utf-8')
         sysJobTargets = ""
         reboot = True if re.search('reboot.target.*start', sysJobTargets) is not None else False                      # reboot.target exists
         swStop = True if re.search('(?:halt|shutdown).target.*start', sysJobTargets) is not None else False           # shutdown | halt exists
         causePowerOff = True if (swStop and not reboot) else False
-        ret = pijuice.status.GetStatus()
+        if state is not None and state.snapshot is not None:
+            ret = {'error': 'NO_ERROR', 'data': state.snapshot.StatusDict()}
+        else:
+            if pijuice is None:
+                _Connect(probe=False)
+            ret = pijuice.status.GetStatus() if pijuice else {'error': 'NOT_CONNECTED'}
         if ( ret['error'] == 'NO_ERROR'
             and not isHalting
             and causePowerOff                                # proper time to power down (!rebooting)
-            and configData.get('system_task',{}).get('ext_halt_power_off', {}).get('enabled',False)
+            and settings.extHaltPowerOffEn
+            and settings.extHaltPowerOffPeriod is not None
             ):
             # Set duration for when pijuice will cut power (Recommended 30+ sec, for halt to complete)
-            try:
-                powerOffDelay = int(configData['system_task']['ext_halt_power_off'].get('period',30))
-                pijuice.power.SetPowerOff(powerOffDelay)
-            except ValueError:
-                pass
+            if pijuice is None:
+                _Connect(probe=False)
+            if pijuice:
+                pijuice.power.SetPowerOff(settings.extHaltPowerOffPeriod)
+        # the sys_stop function ran in the background, give it its timeout to finish
+        functionRunner.Drain(functionRunner.timeout)
         sys.exit(0)
 
+    _Connect()
+    _RestoreState(state)
+
     # First check if rtc is operational when the rtc_ds1307 module is loaded.
     # If not, then reload the module
     # This can happen when the Pi is off and the PiJuice is in low power mode.
@@ -421,35 +1155,24 @@ def main():
                     else:
                         logging.warn('RTC os-support not available')
 
-    if watchdogEn: _ConfigureWatchdog('ACTIVATE')
+    if settings.watchdogEn: _ConfigureWatchdog('ACTIVATE')
 
-    if sysStartEvEn:
-        ExecuteFunc(configData['system_events']['sys_start']['function'], 'sys_start', configData)
+    if settings.sysStartEvEn:
+        ExecuteFunc(settings.eventFunctions['sys_start'], 'sys_start', configData)
 
-    timeCnt = 2#5
+    _ConfigureHistory()
+    _ConfigureStatsDump()
+    _OpenStatusPage()
+    queryServer = QueryServer(_HandleQuery)
+    try:
+        queryServer.Register(scheduler.selector)
+    except OSError:
+        logging.exception("failed to open query socket")
+        queryServer = None
 
     while dopoll:
-        if configData.get('system_task', {}).get('enabled'):
-            ret = pijuice.status.GetStatus()
-            if ret['error'] == 'NO_ERROR':
-                status = ret['data']
-                if status['isButton']:
-                    _EvalButtonEvents()
-
-                timeCnt -= 1
-                if timeCnt == 0:
-                    timeCnt = 5
-                    if ('isFault' in status) and status['isFault']:
-                        _EvalFaultFlags()
-                    if minChgEn:
-                        _EvalCharge(status)
-                    if minBatVolEn:
-                        _EvalBatVoltage(status)
-                    if noPowEn or PowEn:
-                        _EvalPowerInputs(status)
-            else:
-                logging.error("failed to get status: %s" % ret)
-        time.sleep(1)
+        scheduler.RunOnce()
+        _Checkpoint()
 
 if __name__ == '__main__':
     main()
@@ -3,15 +3,15 @@
 import os
 import sys
 import re
+import signal
 import argparse
 import logging
 import json
 import time
-import datetime
-import subprocess
+import copy
 
-from pijuice import PiJuice, PiJuiceConfig, PiJuiceStatus
-from pijuice import pijuice_hard_functions, pijuice_sys_functions, pijuice_user_functions
+# everything else, including the pijuice module, is imported by the commands using it
+from pijuice_settings import LoadSettings, SaveSettings, MergePatch, Settings, SimulationSelected, CONFIG_PATH
 
 class CommandBase:
     def __init__(self, pijuice):
@@ -23,6 +23,7 @@ class CommandBase:
         return timeStr
 
     def _getFunction(self, function):
+        from pijuice import pijuice_sys_functions, pijuice_user_functions
         if not function:
             return None
         upperFunctions = [name.upper() for name in pijuice_sys_functions]
@@ -36,6 +37,7 @@ class CommandBase:
         return None
 
     def _validateFunction(self, configData, function):
+        from pijuice import pijuice_sys_functions
         if function in pijuice_sys_functions:
             return True
         if not 'user_functions' in configData:
@@ -161,14 +163,24 @@ class FirmwareCommand(CommandBase):
     FIRMWARE_UPDATE_ERRORS = ['NO_ERROR', 'I2C_BUS_ACCESS_ERROR', 'INPUT_FILE_OPEN_ERROR', 'STARTING_BOOTLOADER_ERROR', 'FIRST_PAGE_ERASE_ERROR',
                               'EEPROM_ERASE_ERROR', 'INPUT_FILE_READ_ERROR', 'PAGE_WRITE_ERROR', 'PAGE_READ_ERROR', 'PAGE_VERIFY_ERROR', 'CODE_EXECUTE_ERROR']
 
-    def __init__(self, pijuice, current_fw_version):
+    def __init__(self, pijuice, current_fw_version, bus=None):
         super().__init__(pijuice)
         self.logger = logging.getLogger(self.__class__.__name__)
         self.current_fw_version = current_fw_version
+        self._bus = bus
 
-    def get_current_fw_version(self):
+    def get_current_fw_version(self, cached=False):
         # Returns current version as int (first 4 bits - minor, second 4 bits - major)
-        status = self._pijuice.config.GetFirmwareVersion()
+        # cached: use the version known by the running pijuice service if possible
+        from pijuice_query import QueryClient
+        status = None
+        if cached:
+            try:
+                status = QueryClient().GetFirmwareVersion()
+            except OSError:
+                self.logger.debug("service not reachable, read firmware version from device")
+        if not status or status['error'] != 'NO_ERROR':
+            status = self._pijuice.config.GetFirmwareVersion()
         if status['error'] == 'NO_ERROR':
             major, minor = status['data']['version'].split('.')
         else:
@@ -247,32 +259,43 @@ class FirmwareCommand(CommandBase):
         return True
 
     def _update_firmware(self, firmware_path):
+        import subprocess
+        from pijuice_devcache import DeviceConfigCache
         current_addr = self._pijuice.config.interface.GetAddress()
         if not current_addr:
             error_status = "UNKNOWN_ADDRESS"
+        elif SimulationSelected():
+            raise IOError("firmware update not possible on the simulated PiJuice")
         else:
-            # Start the firmware update in a subprocess
-            error_status = None
-            addr = format(current_addr, 'x')
-            with open('/dev/null','w') as f:    # Suppress pijuiceboot output
-                p = subprocess.Popen(['pijuiceboot', addr, firmware_path], stdout=f, stderr=subprocess.STDOUT)
-            # Show the 'Wait for update' screen  with a rotating spinner
-            finished = False
-            while not finished:
-                try:
-                    finished = True
-                    p.communicate(timeout=0.3)
-                except subprocess.TimeoutExpired:
-                    finished = False
-                if not finished:
-                    i = (i+1)%4
-                    #waittext.set_text("Updating firmware, Wait " + spinner[i])
-                    self.logger.debug("Updating firmware, Wait ...")
-                    #loop.draw_screen()
-            # Check the result
-            result = 256 - p.returncode
-            if result != 256:
-                error_status = self.FIRMWARE_UPDATE_ERRORS[result] if result < 11 else 'UNKNOWN'
+            # keep every other process off the bus while the bootloader runs
+            if self._bus and not self._bus.Acquire(timeout=10):
+                raise IOError("PiJuice bus is busy")
+            try:
+                # Start the firmware update in a subprocess
+                error_status = None
+                addr = format(current_addr, 'x')
+                with open('/dev/null','w') as f:    # Suppress pijuiceboot output
+                    p = subprocess.Popen(['pijuiceboot', addr, firmware_path], stdout=f, stderr=subprocess.STDOUT)
+                # Show the 'Wait for update' screen  with a rotating spinner
+                finished = False
+                while not finished:
+                    try:
+                        finished = True
+                        p.communicate(timeout=0.3)
+                    except subprocess.TimeoutExpired:
+                        finished = False
+                    if not finished:
+                        i = (i+1)%4
+                        #waittext.set_text("Updating firmware, Wait " + spinner[i])
+                        self.logger.debug("Updating firmware, Wait ...")
+                        #loop.draw_screen()
+                # Check the result
+                result = 256 - p.returncode
+                if result != 256:
+                    error_status = self.FIRMWARE_UPDATE_ERRORS[result] if result < 11 else 'UNKNOWN'
+            finally:
+                if self._bus:
+                    self._bus.Release()
 
         if error_status:
             messages = {
@@ -293,6 +316,8 @@ class FirmwareCommand(CommandBase):
             current_version = self.get_current_fw_version()
             time.sleep(0.2)
         current_fw_version = current_version
+        # the update may have reset the button and LED configuration
+        DeviceConfigCache().Clear()
         self.logger.info("Firmware update successful: V%s" % self.version_to_str(current_fw_version))
         return True
 
@@ -339,44 +364,89 @@ class FirmwareCommand(CommandBase):
 
 class ConfigCommand(CommandBase):
     SERVICE_CTL = "/etc/init.d/pijuice"
-    PiJuiceConfigDataPath = '/etc/pijuice/pijuice_config.JSON'
+    PiJuiceConfigDataPath = CONFIG_PATH
+    PID_FILE = '/tmp/pijuice_sys.pid'
+    # config data of an open batch, written once by commitBatch()
+    _batchConfigData = None
 
     def __init__(self, pijuice):
         super().__init__(pijuice)
         self.logger = logging.getLogger(self.__class__.__name__)
 
     def loadPiJuiceConfig(self):
-        with open(self.PiJuiceConfigDataPath, 'r') as outputConfig:
-            pijuiceConfigData = json.load(outputConfig)
-            return pijuiceConfigData
+        if ConfigCommand._batchConfigData is not None:
+            return ConfigCommand._batchConfigData
+        # callers modify and save the returned dict, keep the cached settings untouched
+        return copy.deepcopy(LoadSettings(self.PiJuiceConfigDataPath).data)
+
+    def loadSettings(self):
+        # inside a batch the pending changes count, not the file
+        if ConfigCommand._batchConfigData is not None:
+            return Settings(copy.deepcopy(ConfigCommand._batchConfigData))
+        return LoadSettings(self.PiJuiceConfigDataPath)
 
     def savePiJuiceConfig(self, pijuiceConfigData):
-        with open(self.PiJuiceConfigDataPath, 'w+') as outputConfig:
-            json.dump(pijuiceConfigData, outputConfig, indent=2)
-        #ret = self.notify_service()
-        #if ret != 0:
-        #    self.logger.error("failed to communicate with PiJuice service")
-        #else:
-        #    self.logger.info("settings saved")
+        if ConfigCommand._batchConfigData is not None:
+            ConfigCommand._batchConfigData = pijuiceConfigData
+            return
+        SaveSettings(pijuiceConfigData, self.PiJuiceConfigDataPath)
+        self._notifyAfterSave()
+
+    def beginBatch(self):
+        ConfigCommand._batchConfigData = None
+        ConfigCommand._batchConfigData = self.loadPiJuiceConfig()
+
+    def commitBatch(self):
+        pijuiceConfigData = ConfigCommand._batchConfigData
+        ConfigCommand._batchConfigData = None
+        if pijuiceConfigData is not None and pijuiceConfigData != self.loadSettings().data:
+            SaveSettings(pijuiceConfigData, self.PiJuiceConfigDataPath)
+            self._notifyAfterSave()
+
+    def abortBatch(self):
+        ConfigCommand._batchConfigData = None
+
+    def checkpointBatch(self):
+        """
+        Gives the next command a copy of the batch config data, the returned
+        state is restored by rollbackBatch() if the command fails
+        """
+        saved = ConfigCommand._batchConfigData
+        ConfigCommand._batchConfigData = copy.deepcopy(saved)
+        return saved
+
+    def rollbackBatch(self, saved):
+        ConfigCommand._batchConfigData = saved
 
     def notify_service(self):
         ret = -1
         try:
             with open(self.PID_FILE, 'r') as r:
                 pid = int(r.read())
-                ret = os.system("kill -SIGHUP " + str(pid) + " > /dev/null 2>&1")
-        except:
+            # the pid file outlives the service, do not signal a reused pid
+            with open('/proc/%d/cmdline' % pid, 'rb') as c:
+                if b'pijuice_sys' not in c.read():
+                    return ret
+            os.kill(pid, signal.SIGHUP)
+            ret = 0
+        except (OSError, ValueError):
             pass
         return ret
 
-class ServiceCommand(ConfigCommand):
-    PID_FILE = '/tmp/pijuice_sys.pid'
+    def _notifyAfterSave(self):
+        ret = self.notify_service()
+        if ret != 0:
+            self.logger.debug("PiJuice service not running, not notified")
+        else:
+            self.logger.info("settings saved")
 
+class ServiceCommand(ConfigCommand):
     def __init__(self, pijuice):
         super().__init__(pijuice)
         self.logger = logging.getLogger(self.__class__.__name__)
 
     def getService(self, args):
+        import subprocess
         status = subprocess.run([self.SERVICE_CTL, "enabled"])
         enabled = status.returncode == 0
         self.logger.info("service enabled:               %s" % enabled)
@@ -384,19 +454,13 @@ class ServiceCommand(ConfigCommand):
         running = status.returncode == 0
         self.logger.info("service running:               %s" % running)
     
-        configData = self.loadPiJuiceConfig()
-        serviceEnabled = configData.get('system_task', {}).get('enabled')
-        self.logger.info("service config enabled:        %s" % serviceEnabled)
-            
-        minChargeEnabled = False
-        minChargeThreshold = 0
-        if 'system_task' in configData:
-            if 'min_charge' in configData['system_task']:
-                minChargeEnabled = configData['system_task']['min_charge'].get('enabled', False)
-                minChargeThreshold= configData['system_task']['min_charge'].get('threshold', 0)
-        self.logger.info("min. charge detection enabled: %s (%s%%)" % (minChargeEnabled, minChargeThreshold))
+        settings = self.loadSettings()
+        self.logger.info("service config enabled:        %s" % settings.serviceEnabled)
+        minChargeThreshold = settings.minChgThreshold or 0
+        self.logger.info("min. charge detection enabled: %s (%s%%)" % (settings.minChgEn, minChargeThreshold))
 
     def enableService(self, args, enable):
+        import subprocess
         self.logger.info("enable service:     %s" % enable)
         configData = self.loadPiJuiceConfig()
         configData['system_task']['enabled'] = enable
@@ -438,7 +502,7 @@ class EventCommand(ConfigCommand):
 
     def getEvents(self, args):
         self.logger.info("events:")
-        configData = self.loadPiJuiceConfig()
+        configData = self.loadSettings().data
         for idx, event in enumerate(self.EVENTS):
             enabled, function = self._getEventStatus(configData, event)
             self.logger.info(" - %-20s: %-5s (%s)" % (self.EVTTXT[idx], enabled, function))
@@ -478,7 +542,7 @@ class EventCommand(ConfigCommand):
             raise ValueError("no event given")
         upperEvents = [name.upper() for name in self.EVTTXT]
         if not event.upper() in upperEvents:
-            raise ValueError("unknown event: " % event)
+            raise ValueError("unknown event: %s" % event)
         i = upperEvents.index(event.upper())
         return i
 
@@ -499,6 +563,7 @@ class FunctionsCommand(ConfigCommand):
         self.logger = logging.getLogger(self.__class__.__name__)
 
     def getFunctions(self, args):
+        from pijuice import pijuice_hard_functions, pijuice_sys_functions, pijuice_user_functions
         if args.kind in ['all', 'hard']:
             self.logger.info("hardware functions:")
             for function in pijuice_hard_functions:
@@ -511,13 +576,10 @@ class FunctionsCommand(ConfigCommand):
 
         if args.kind in ['all', 'user']:
             self.logger.info("user functions:")
-            configData = self.loadPiJuiceConfig()
+            userFunctions = self.loadSettings().userFunctions
             for idx, function in enumerate(pijuice_user_functions[1:]):
                 fkey = 'USER_FUNC%s' % (idx + 1)
-                func = ""
-                if 'user_functions' in configData:
-                    if fkey in configData['user_functions']:
-                        func = configData['user_functions'][fkey]
+                func = userFunctions.get(fkey, "")
                 self.logger.info(" - %-11s: %s" % (fkey, func))
 
     def setFunction(self, args):
@@ -542,6 +604,7 @@ class RealTimeClockCommand(CommandBase):
         self.logger = logging.getLogger(self.__class__.__name__)
 
     def getRTC(self, args):
+        import datetime
         st = datetime.datetime.now()
         utcST = st.astimezone(tz=datetime.timezone.utc)
         system_time = self._formateDateTime(st)
@@ -552,10 +615,12 @@ class RealTimeClockCommand(CommandBase):
         self.logger.info("PiJuice UTC Time: %s" % device_time)
 
     def setRTC(self, args):
+        import datetime
         st = datetime.datetime.utcnow()
         self._set_device_time(st)
 
     def _get_device_time(self):
+        import datetime
         device_time = ''
         t = self._pijuice.rtcAlarm.GetTime()
         if t['error'] != 'NO_ERROR':
@@ -604,6 +669,7 @@ class WakeupCommand(ConfigCommand):
         self.logger.info("Alarm:           %s" % alarmStr)
 
     def setAlarm(self, args):
+        import datetime
         if not args.hour:
             raise ValueError("hour missing")
 
@@ -794,6 +860,13 @@ class FaultCommand(CommandBase):
         self._pijuice.status.ResetFaultFlags(flags)
 
     def _getFaultStatus(self):
+        from pijuice_query import QueryClient
+        try:
+            ret = QueryClient().GetStatus(['faults'])
+            if ret['error'] == 'NO_ERROR':
+                return ret['data'].faults
+        except OSError:
+            self.logger.debug("service not reachable, read faults from device")
         ret = self._pijuice.status.GetFaultStatus()
         if ret['error'] != 'NO_ERROR':
             raise IOError("Unable to get faults: %s" % ret['error'])
@@ -801,14 +874,17 @@ class FaultCommand(CommandBase):
         return faultStatus
 
 class ButtonsCommand(ConfigCommand):
-    def __init__(self, pijuice):
+    def __init__(self, pijuice, current_fw_version):
+        from pijuice_devcache import CachedDeviceConfig
         super().__init__(pijuice)
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.deviceConfig = CachedDeviceConfig(pijuice, current_fw_version)
 
     def getButtons(self, args):
+        from pijuice import PiJuiceConfig
         self.logger.info("Buttons:")
         for idx, button in enumerate(PiJuiceConfig.buttons):
-            ret = self._pijuice.config.GetButtonConfiguration(button)
+            ret = self.deviceConfig.GetButtonConfiguration(button)
             if ret['error'] != 'NO_ERROR':
                 raise IOError("Unable to get button config: %s" % ret['error'])
             button_config = ret['data']
@@ -820,6 +896,7 @@ class ButtonsCommand(ConfigCommand):
                 self.logger.info("  - %-12s: %s (%s)" % (event, function, parameter))
 
     def setButton(self, args):
+        from pijuice import PiJuiceConfig
         function = self._getFunction(args.function)
         if not function:
             raise ValueError("no function given")
@@ -829,7 +906,7 @@ class ButtonsCommand(ConfigCommand):
         parameter = args.parameter if args.parameter is not None else 0
 
         button = PiJuiceConfig.buttons[args.nr -1]
-        ret = self._pijuice.config.GetButtonConfiguration(button)
+        ret = self.deviceConfig.GetButtonConfiguration(button)
         if ret['error'] != 'NO_ERROR':
             raise IOError("Unable to get button config: %s" % ret['error'])
             
@@ -837,11 +914,14 @@ class ButtonsCommand(ConfigCommand):
         button_config[args.event]['function'] = function
         button_config[args.event]['parameter'] = parameter
         self.logger.info("set button %s on event %s to: %s (%s)" % (button, args.event, function, parameter))
-        ret = self._pijuice.config.SetButtonConfiguration(button, button_config)
+        ret = self.deviceConfig.SetButtonConfiguration(button, button_config)
         if ret['error'] != 'NO_ERROR':
             raise IOError("Unable to set button config: %s" % ret['error'])
+        # the service keeps the button configuration in memory
+        self.notify_service()
 
     def _getFunction(self, function):
+        from pijuice import pijuice_hard_functions
         func = super()._getFunction(function)
         if func:
             return func
@@ -853,6 +933,7 @@ class ButtonsCommand(ConfigCommand):
         return None
 
     def _validateFunction(self, configData, function):
+        from pijuice import pijuice_hard_functions
         if function in ['NO_FUNC'] + pijuice_hard_functions:
             return True
         if super()._validateFunction(configData, function):
@@ -860,14 +941,16 @@ class ButtonsCommand(ConfigCommand):
         return False
 
 class LedCommand(CommandBase):
-    def __init__(self, pijuice):
+    def __init__(self, pijuice, current_fw_version):
+        from pijuice_devcache import CachedDeviceConfig
         super().__init__(pijuice)
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.deviceConfig = CachedDeviceConfig(pijuice, current_fw_version)
 
     def get(self, args):
         self.logger.info("Led's:")
         for led in self._pijuice.config.leds:
-            ret = self._pijuice.config.GetLedConfiguration(led)
+            ret = self.deviceConfig.GetLedConfiguration(led)
             if ret['error'] != 'NO_ERROR':
                 raise IOError("Unable to get LED config: %s" % ret['error'])
             config = ret['data']
@@ -881,6 +964,7 @@ class LedCommand(CommandBase):
             self.logger.info(" - %s: %s (%s,%s,%s)" % (led, function, color_r, color_g, color_b))
 
     def setFunction(self, args):
+        from pijuice import PiJuiceConfig
         led = PiJuiceConfig.leds[args.nr - 1]
         function = args.kind
         r,g,b = tuple(self._getColor(args.color))
@@ -893,11 +977,12 @@ class LedCommand(CommandBase):
             }
         }
         self.logger.info("set led: %s to %s (%s,%s,%s)" % (led, function, r, b, g))
-        status = self._pijuice.config.SetLedConfiguration(led, config)
+        status = self.deviceConfig.SetLedConfiguration(led, config)
         if status['error'] != 'NO_ERROR':
             raise IOError("Unable to set led config: %s" % status['error'])
 
     def set(self, args):
+        from pijuice import PiJuiceConfig
         led = PiJuiceConfig.leds[args.nr - 1]
         color = self._getColor(args.color)
         self.logger.info("set led: %s to %s" % (led, self._colorToStr(color)))
@@ -906,6 +991,7 @@ class LedCommand(CommandBase):
             raise IOError("Unable to set led state: %s" % ret['error'])
 
     def setBlink(self, args):
+        from pijuice import PiJuiceConfig
         led = PiJuiceConfig.leds[args.nr - 1]
         count = args.count
         color1 = self._getColor(args.color1)
@@ -930,10 +1016,311 @@ class LedCommand(CommandBase):
         rgb = [int(c) for c in colors]
         return rgb
 
+class DeviceConfigCommand(ConfigCommand):
+    """
+    Dumps the configuration stored on the PiJuice to one JSON document and
+    restores it. Restore compares every entry with the device, writes only
+    the differing ones and reads them back to verify.
+    """
+    DUMP_FORMAT = 1
+
+    def __init__(self, pijuice, current_fw_version):
+        from pijuice import PiJuiceConfig
+        from pijuice_devcache import CachedDeviceConfig
+        super().__init__(pijuice)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.current_fw_version = current_fw_version
+        self.deviceConfig = CachedDeviceConfig(pijuice, current_fw_version)
+        # name: items or None for a single value, read(item), write(item, value), minimum firmware version
+        self.sections = [
+            ('battery_profile', None, self._readBatteryProfile, self._writeBatteryProfile, 0),
+            ('temp_sense', None, self._readTempSense, self._writeTempSense, 0),
+            ('buttons', PiJuiceConfig.buttons, self._readButton, self._writeButton, 0),
+            ('leds', PiJuiceConfig.leds, self._readLed, self._writeLed, 0),
+            ('wakeup_on_charge', None, self._readWakeupOnCharge, self._writeWakeupOnCharge, 0x15),
+            ('watchdog', None, self._readWatchdog, self._writeWatchdog, 0),
+            # last, the board may answer on the new address afterwards
+            ('i2c_address', ['1', '2'], self._readAddress, self._writeAddress, 0),
+        ]
+
+    def dump(self, args):
+        sections = {}
+        for name, items, read, write, version in self.sections:
+            if self.current_fw_version < version:
+                continue
+            sections[name] = read(None) if items is None else {item: read(item) for item in items}
+        document = {
+            'format': self.DUMP_FORMAT,
+            'firmware': "%d.%d" % (self.current_fw_version >> 4, self.current_fw_version & 15),
+            'sections': sections,
+        }
+        text = json.dumps(document, indent=2) + "\n"
+        if args.output == '-':
+            sys.stdout.write(text)
+        else:
+            with open(args.output, 'w') as f:
+                f.write(text)
+            self.logger.info("configuration dumped to %s" % args.output)
+
+    def restore(self, args):
+        if args.input == '-':
+            document = json.load(sys.stdin)
+        else:
+            with open(args.input, 'r') as f:
+                document = json.load(f)
+        if not isinstance(document, dict) or document.get('format') != self.DUMP_FORMAT:
+            raise ValueError("not a pijuice configuration dump")
+        wanted = document.get('sections', {})
+        unknown = set(wanted) - set(name for name, items, read, write, version in self.sections)
+        if unknown:
+            raise ValueError("unknown sections: %s" % ", ".join(sorted(unknown)))
+        written = unchanged = 0
+        changed = set()
+        for name, items, read, write, version in self.sections:
+            if name not in wanted:
+                continue
+            if self.current_fw_version < version:
+                self.logger.warning("%s not supported by firmware version, skipped" % name)
+                continue
+            if items is None:
+                entries = [(None, wanted[name])]
+            else:
+                entries = [(item, wanted[name][item]) for item in items if item in wanted[name]]
+            for item, value in entries:
+                label = name if item is None else "%s %s" % (name, item)
+                if self._equal(read(item), value):
+                    self.logger.debug("%s unchanged" % label)
+                    unchanged += 1
+                    continue
+                if args.dry_run:
+                    self.logger.info("%s differs" % label)
+                    written += 1
+                    continue
+                write(item, value)
+                if not self._equal(read(item), value):
+                    raise IOError("Verification of %s failed" % label)
+                self.logger.info("%s written" % label)
+                written += 1
+                changed.add(name)
+        self.logger.info("%d entries %s, %d unchanged" % (written, "differ" if args.dry_run else "written", unchanged))
+        if 'buttons' in changed:
+            # the service keeps the button configuration in memory
+            self.notify_service()
+
+    def _equal(self, live, value):
+        # tuples read from the device equal the lists of the JSON document
+        return json.dumps(live, sort_keys=True) == json.dumps(value, sort_keys=True)
+
+    def _data(self, ret, action):
+        if ret['error'] != 'NO_ERROR':
+            raise IOError("Unable to %s: %s" % (action, ret['error']))
+        return ret.get('data')
+
+    def _readBatteryProfile(self, item):
+        status = self._data(self._pijuice.config.GetBatteryProfileStatus(), "read battery status")
+        if status['validity'] == 'VALID' and status['origin'] == 'PREDEFINED':
+            return {'profile': status['profile']}
+        profile = {'custom': self._data(self._pijuice.config.GetBatteryProfile(), "read battery data")}
+        if self.current_fw_version >= 0x13:
+            profile['ext'] = self._data(self._pijuice.config.GetBatteryExtProfile(), "read battery data")
+        return profile
+
+    def _writeBatteryProfile(self, item, value):
+        if 'profile' in value:
+            self._data(self._pijuice.config.SetBatteryProfile(value['profile']), "set battery profile")
+            return
+        if value['custom'] == 'INVALID':
+            raise ValueError("invalid battery profile in dump")
+        self._data(self._pijuice.config.SetCustomBatteryProfile(value['custom']), "set battery profile")
+        if 'ext' in value and self.current_fw_version >= 0x13:
+            self._data(self._pijuice.config.SetCustomBatteryExtProfile(value['ext']), "set battery profile")
+
+    def _readTempSense(self, item):
+        return self._data(self._pijuice.config.GetBatteryTempSenseConfig(), "read battery temp sense")
+
+    def _writeTempSense(self, item, value):
+        self._data(self._pijuice.config.SetBatteryTempSenseConfig(value), "set battery temp sense")
+
+    def _readButton(self, button):
+        # from the device, the cache may be older than the dump
+        return self._data(self._pijuice.config.GetButtonConfiguration(button), "get button config")
+
+    def _writeButton(self, button, value):
+        self._data(self.deviceConfig.SetButtonConfiguration(button, value), "set button config")
+
+    def _readLed(self, led):
+        return self._data(self._pijuice.config.GetLedConfiguration(led), "get LED config")
+
+    def _writeLed(self, led, value):
+        self._data(self.deviceConfig.SetLedConfiguration(led, value), "set led config")
+
+    def _readWakeupOnCharge(self, item):
+        ret = self._pijuice.power.GetWakeUpOnCharge()
+        self._data(ret, "get wakeup on charge status")
+        # only the non volatile setting belongs to the board configuration
+        if not ret.get('non_volatile') or ret['data'] == 'DISABLED':
+            return {'enabled': False}
+        return {'enabled': True, 'trigger_level': ret['data']}
+
+    def _writeWakeupOnCharge(self, item, value):
+        level = value['trigger_level'] if value['enabled'] else 'DISABLED'
+        self._data(self._pijuice.power.SetWakeUpOnCharge(level, True), "set wakeup on charge status")
+
+    def _readWatchdog(self, item):
+        ret = self._pijuice.power.GetWatchdog()
+        self._data(ret, "get watchdog")
+        # a period armed by the service is not part of the board configuration
+        return {'period': ret['data'] if ret.get('non_volatile') else 0}
+
+    def _writeWatchdog(self, item, value):
+        self._data(self._pijuice.power.SetWatchdog(value['period'], True), "set watchdog")
+
+    def _readAddress(self, slave):
+        return self._data(self._pijuice.config.GetAddress(int(slave)), "get I2C address")
+
+    def _writeAddress(self, slave, value):
+        self._data(self._pijuice.config.SetAddress(int(slave), value), "set I2C address")
+
+class HistoryCommand(ConfigCommand):
+    def __init__(self, pijuice):
+        super().__init__(pijuice)
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def show(self, args):
+        from pijuice_history import HistoryReader, Downsample
+        reader = HistoryReader(self._getPath(args))
+        start = time.time() - args.last if args.last else None
+        if args.follow:
+            samples = reader.Follow(start)
+        else:
+            samples = reader.Samples(start)
+        if args.step:
+            samples = Downsample(samples, args.step)
+        self.logger.info("%-19s %4s %7s %7s %5s %7s %7s %-19s %s" % ("time", "chg", "bat[V]", "bat[A]", "[C]", "io[V]", "io[A]", "battery", "power input"))
+        for sample in samples:
+            self.logger.info(self._formatSample(sample))
+
+    def _getPath(self, args):
+        from pijuice_history import HISTORY_PATH
+        if args.path:
+            return args.path
+        return self.loadSettings().historyPath or HISTORY_PATH
+
+    def _formatSample(self, s):
+        import datetime
+        def value(v, fmt, scale=1):
+            return "-" if v is None else fmt % (v / scale)
+        timeStr = datetime.datetime.fromtimestamp(s.time).strftime("%Y-%m-%d %H:%M:%S")
+        return "%-19s %4s %7s %7s %5s %7s %7s %-19s %s" % (timeStr, value(s.chargeLevel, "%d%%"),
+            value(s.batteryVoltage, "%.3f", 1000), value(s.batteryCurrent, "%.3f", 1000),
+            value(s.batteryTemperature, "%d"), value(s.ioVoltage, "%.3f", 1000), value(s.ioCurrent, "%.3f", 1000),
+            s.battery or "-", s.powerInput or "-")
+
+class LogCommand(CommandBase):
+    def __init__(self, pijuice):
+        super().__init__(pijuice)
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def show(self, args):
+        from pijuice_query import QueryClient
+        try:
+            ret = QueryClient().Request('log', level=args.level, lines=args.lines)
+        except OSError:
+            raise IOError("PiJuice service not running")
+        if ret['error'] != 'NO_ERROR':
+            raise IOError("Unable to get service log: %s" % ret['error'])
+        for line in ret['data']:
+            self.logger.info(line)
+
+class StatsCommand(CommandBase):
+    def __init__(self, pijuice):
+        super().__init__(pijuice)
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def show(self, args):
+        from pijuice_query import QueryClient
+        try:
+            ret = QueryClient().Request('stats', text=not args.json)
+        except OSError:
+            raise IOError("PiJuice service not running")
+        if ret['error'] != 'NO_ERROR':
+            raise IOError("Unable to get service statistics: %s" % ret['error'])
+        self.logger.info(json.dumps(ret['data'], indent=2) if args.json else ret['data'])
+
+class _Capture(logging.Handler):
+    """ Collects the messages of one batch command """
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(record.getMessage())
+
+class _LazyPiJuice:
+    """ Stands in for the PiJuice and opens it on first use """
+    def __init__(self, open):
+        self._open = open
+        self._pijuice = None
+
+    def Open(self):
+        if self._pijuice is None:
+            self._pijuice = self._open()
+        return self._pijuice
+
+    def __getattr__(self, name):
+        return getattr(self.Open(), name)
+
 class Control:
+    # command groups: name, handler, help, builder of the group parser
+    # only the group selected on the command line gets its parser built
+    COMMANDS = (
+        ('battery', 'battery', 'battery configuration', '_addBatteryParser'),
+        ('service', 'service', 'pijuice service configuration', '_addServiceParser'),
+        ('events', 'events', 'event configuration', '_addEventsParser'),
+        ('functions', 'function', 'function configuration', '_addFunctionsParser'),
+        ('rtc', 'rtc', 'real time clock configuration', '_addRtcParser'),
+        ('wakeup', 'wakeup', 'wakeup configuration', '_addWakeupParser'),
+        ('firmware', 'firmware', 'firmware configuration', '_addFirmwareParser'),
+        ('faults', 'faults', 'faults status', '_addFaultsParser'),
+        ('buttons', 'buttons', 'buttons status', '_addButtonsParser'),
+        ('led', 'led', 'led status', '_addLedParser'),
+        ('config', 'config', 'dump and restore the whole device configuration', '_addConfigParser'),
+        ('history', 'history', 'recorded battery telemetry', '_addHistoryParser'),
+        ('log', 'log', 'recent messages of the pijuice service', '_addLogParser'),
+        ('stats', 'stats', 'operation counts and latencies of the pijuice service', '_addStatsParser'),
+        ('apply', 'apply', 'apply several config changes with a single write', '_addApplyParser'),
+    )
+
     def __init__(self):
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.current_fw_version = None
+        self.parser = None
+        self._fwVersion = None
+        self._bus = None
+        self._pijuice = _LazyPiJuice(self._open)
+
+    @property
+    def current_fw_version(self):
+        # probed on first use, commands working on the config file only never need it
+        if self._fwVersion is None:
+            fc = FirmwareCommand(self._pijuice, None)
+            self._fwVersion = fc.get_current_fw_version(cached=True)
+        return self._fwVersion
+
+    @property
+    def bus(self):
+        self._pijuice.Open()
+        return self._bus
+
+    def _open(self):
+        from pijuice_bus import ShareBus
+        if SimulationSelected():
+            from pijuice_sim import OpenPiJuice
+            pijuice = OpenPiJuice(1, 0x14)
+        else:
+            from pijuice import PiJuice
+            pijuice = PiJuice(1, 0x14)
+        self._bus = ShareBus(pijuice)
+        return pijuice
 
     def battery(self, args, pijuice):
         self.logger.debug(args.subparser_name)
@@ -1005,7 +1392,7 @@ class Control:
 
     def firmware(self, args, pijuice):
         self.logger.debug(args.subparser_name)
-        command = FirmwareCommand(pijuice, self.current_fw_version)
+        command = FirmwareCommand(pijuice, self.current_fw_version, self.bus)
         if args.subparser_name == "get":
             command.getFirmware(args)
         elif args.subparser_name == "list":
@@ -1021,7 +1408,7 @@ class Control:
 
     def buttons(self, args, pijuice):
         self.logger.debug(args.subparser_name)
-        command = ButtonsCommand(pijuice)
+        command = ButtonsCommand(pijuice, self.current_fw_version)
         if args.subparser_name == "get":
             command.getButtons(args)
         if args.subparser_name == "setButton":
@@ -1029,7 +1416,7 @@ class Control:
 
     def led(self, args, pijuice):
         self.logger.debug(args.subparser_name)
-        command = LedCommand(pijuice)
+        command = LedCommand(pijuice, self.current_fw_version)
         if args.subparser_name == "get":
             command.get(args)
         elif args.subparser_name == "setFunction":
@@ -1039,21 +1426,141 @@ class Control:
         elif args.subparser_name == "blink":
             command.blink(args)
 
-    def main(self):
+    def config(self, args, pijuice):
+        self.logger.debug(args.subparser_name)
+        command = DeviceConfigCommand(pijuice, self.current_fw_version)
+        if args.subparser_name == "dump":
+            command.dump(args)
+        elif args.subparser_name == "restore":
+            command.restore(args)
+
+    def history(self, args, pijuice):
+        self.logger.debug(args.subparser_name)
+        command = HistoryCommand(pijuice)
+        if args.subparser_name == "show":
+            command.show(args)
+
+    def log(self, args, pijuice):
+        command = LogCommand(pijuice)
+        command.show(args)
+
+    def stats(self, args, pijuice):
+        command = StatsCommand(pijuice)
+        command.show(args)
+
+    def apply(self, args, pijuice):
+        """
+        Runs the commands of a script, one per line, on the already opened
+        PiJuice. Config changes of all commands are collected and written
+        once at the end, not at all if a command failed without --keep-going.
+        With --json every command reports a result line on stdout.
+        """
+        # script lines may use any command group
+        self.parser = self._createParser()
+        command = ConfigCommand(pijuice)
+        command.beginBatch()
+        failed = 0
+        try:
+            if args.patch:
+                patch = json.loads(self._readInput(args.patch))
+                configData = command.loadPiJuiceConfig()
+                command.savePiJuiceConfig(MergePatch(configData, patch))
+            if args.script:
+                for nr, line in self._readLines(args.script):
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    self.logger.debug("line %d: %s" % (nr, line))
+                    result = self._runLine(nr, line, pijuice, args.json)
+                    if result['error'] is not None:
+                        failed += 1
+                        if not args.keep_going:
+                            raise ValueError("line %d: %s" % (nr, result['error']))
+        except:
+            command.abortBatch()
+            if args.json:
+                self._emit({'committed': False, 'failed': failed + 1})
+            raise
+        command.commitBatch()
+        if args.json:
+            self._emit({'committed': True, 'failed': failed})
+        return 1 if failed else None
+
+    def _runLine(self, nr, line, pijuice, report):
+        import shlex
+        result = {'line': nr, 'command': line, 'error': None}
+        capture = _Capture() if report else None
+        batch = ConfigCommand(pijuice)
+        # the config changes of a failing command are dropped
+        saved = batch.checkpointBatch()
+        start = time.monotonic()
+        try:
+            try:
+                commandArgs = self.parser.parse_args(shlex.split(line))
+            except SystemExit:
+                raise ValueError("invalid command: %s" % line)
+            if not 'func' in commandArgs or commandArgs.func == self.apply:
+                raise ValueError("unsupported command: %s" % line)
+            if capture:
+                logging.getLogger().addHandler(capture)
+            commandArgs.func(commandArgs, pijuice)
+        except (IOError, ValueError) as e:
+            result['error'] = str(e)
+            if not report:
+                self.logger.error("line %d: %s", nr, e)
+        except Exception as e: # pylint: disable=broad-except
+            result['error'] = "%s: %s" % (e.__class__.__name__, e)
+            if not report:
+                self.logger.exception("line %d:", nr)
+        finally:
+            if capture:
+                logging.getLogger().removeHandler(capture)
+        if result['error'] is not None:
+            batch.rollbackBatch(saved)
+        if report:
+            result['duration'] = round(time.monotonic() - start, 4)
+            result['output'] = capture.lines
+            self._emit(result)
+        return result
+
+    def _emit(self, result):
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+
+    def _readInput(self, name):
+        if name == '-':
+            return sys.stdin.read()
+        with open(name, 'r') as f:
+            return f.read()
+
+    def _readLines(self, name):
+        # commands from stdin run as they arrive
+        if name == '-':
+            yield from enumerate(sys.stdin, 1)
+            return
+        with open(name, 'r') as f:
+            yield from enumerate(f, 1)
+
+    def _createParser(self, groups=None):
+        """ Builds the subcommands of the named command groups only, of all groups if None """
         parser = argparse.ArgumentParser(description="pijuice control utility", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
         parser.add_argument('-v', '--verbose', action="store_true", help="verbose output")
         subparsers = parser.add_subparsers(dest='subparser_name', title='commands')
-
-        parser_bat = subparsers.add_parser('battery', help='battery configuration')
-        parser_bat.set_defaults(func=self.battery)
+        for name, handler, helpText, builder in self.COMMANDS:
+            groupParser = subparsers.add_parser(name, help=helpText)
+            groupParser.set_defaults(func=getattr(self, handler))
+            if groups is None or name in groups:
+                getattr(self, builder)(groupParser)
+        return parser
+
+    def _addBatteryParser(self, parser_bat):
         subparsers_bat = parser_bat.add_subparsers(dest='subparser_name', title='battery commands')
         subparsers_bat.add_parser('list', help='list available battery profiles')
         subparsers_bat.add_parser('get', help='get current battery config')
         parser_bat_set = subparsers_bat.add_parser('set', help='set battery profile')
         parser_bat_set.add_argument('--profile', required=True, help="new  battery profile")
 
-        parser_service = subparsers.add_parser('service', help='pijuice service configuration')
-        parser_service.set_defaults(func=self.service)
+    def _addServiceParser(self, parser_service):
         subparsers_service = parser_service.add_subparsers(dest='subparser_name', title='service commands')
         subparsers_service.add_parser('get', help='get service status')
         subparsers_service.add_parser('enable', help='enable the service')
@@ -1061,8 +1568,7 @@ class Control:
         parser_service_mincharge = subparsers_service.add_parser('minCharge', help='min charge handling')
         parser_service_mincharge.add_argument('--threshold', required=True, type=int, choices=range(0, 101), metavar="{0..100}", help="charge threshold %% (0 disables)")
 
-        parser_events = subparsers.add_parser('events', help='event configuration')
-        parser_events.set_defaults(func=self.events)
+    def _addEventsParser(self, parser_events):
         subparsers_events = parser_events.add_subparsers(dest='subparser_name', title='events commands')
         subparsers_events.add_parser('get', help='get event status')
         parser_events_enable = subparsers_events.add_parser('enable', help="enable event")
@@ -1071,8 +1577,8 @@ class Control:
         parser_events_disable = subparsers_events.add_parser('disable', help="disable event")
         parser_events_disable.add_argument('--event', required=True, help="event name")
 
-        parser_functions = subparsers.add_parser('functions', help='function configuration')
-        parser_functions.set_defaults(func=self.function)
+    def _addFunctionsParser(self, parser_functions):
+        from pijuice import pijuice_user_functions
         subparsers_functions = parser_functions.add_subparsers(dest='subparser_name', title='functions commands')
         parser_functions_get = subparsers_functions.add_parser('get', help='get functions')
         parser_functions_get.add_argument('--kind', required=True, choices=['all', 'sys', 'user', 'hard'], help="function kind")
@@ -1080,14 +1586,12 @@ class Control:
         parser_functions_set.add_argument('--nr', required=True, type=int, choices=range(1, len(pijuice_user_functions)), metavar="{1..15}", help="function nr.")
         parser_functions_set.add_argument('--script', required=True, help="user script")
 
-        parser_rtc = subparsers.add_parser('rtc', help='real time clock configuration')
-        parser_rtc.set_defaults(func=self.rtc)
+    def _addRtcParser(self, parser_rtc):
         subparsers_rtc = parser_rtc.add_subparsers(dest='subparser_name', title='rtc commands')
         subparsers_rtc.add_parser('get', help='get current RTC')
         subparsers_rtc.add_parser('set', help='set PiJuice RTC to system time')
 
-        parser_wakeup = subparsers.add_parser('wakeup', help='wakeup configuration')
-        parser_wakeup.set_defaults(func=self.wakeup)
+    def _addWakeupParser(self, parser_wakeup):
         subparsers_wakeup = parser_wakeup.add_subparsers(dest='subparser_name', title='wakeup commands')
         subparsers_wakeup.add_parser('get', help='get wakeup status')
         subparsers_wakeup.add_parser('getAlarm', help="get alarm state")
@@ -1102,20 +1606,18 @@ class Control:
         parser_wakeup_enableCharge.add_argument('--chargeLevel', type=int, choices=range(10, 101), metavar="{10..100}", help="charge level in %%")
         subparsers_wakeup.add_parser('disableCharge', help="disable wakeup on charge")
 
-        parser_firmware = subparsers.add_parser('firmware', help='firmware configuration')
-        parser_firmware.set_defaults(func=self.firmware)
+    def _addFirmwareParser(self, parser_firmware):
         subparsers_firmware = parser_firmware.add_subparsers(dest='subparser_name', title='firmware commands')
         subparsers_firmware.add_parser('get', help='get current firmware')
         subparsers_firmware.add_parser('list', help='list available firmware files')
 
-        parser_faults = subparsers.add_parser('faults', help='faults status')
-        parser_faults.set_defaults(func=self.faults)
+    def _addFaultsParser(self, parser_faults):
         subparsers_faults = parser_faults.add_subparsers(dest='subparser_name', title='faults commands')
         subparsers_faults.add_parser('get', help='get faults status')
         subparsers_faults.add_parser('clear', help='clear faults')
 
-        parser_buttons = subparsers.add_parser('buttons', help='buttons status')
-        parser_buttons.set_defaults(func=self.buttons)
+    def _addButtonsParser(self, parser_buttons):
+        from pijuice import PiJuiceConfig
         subparsers_buttons = parser_buttons.add_subparsers(dest='subparser_name', title='buttons commands')
         subparsers_buttons.add_parser('get', help='get button status')
         parser_buttons_setButton = subparsers_buttons.add_parser('setButton', help="set button config")
@@ -1124,8 +1626,8 @@ class Control:
         parser_buttons_setButton.add_argument('--function', required=True, help="function name")
         parser_buttons_setButton.add_argument('--parameter', type=int, choices=range(0, 10000), metavar="{0..10000}", help="function parameter in ms")
 
-        parser_led = subparsers.add_parser('led', help='led status')
-        parser_led.set_defaults(func=self.led)
+    def _addLedParser(self, parser_led):
+        from pijuice import PiJuiceConfig
         subparsers_led = parser_led.add_subparsers(dest='subparser_name', title='led commands')
         subparsers_led.add_parser('get', help='get led function status')
         parser_led_setFunction = subparsers_led.add_parser('setFunction', help='set led function')
@@ -1143,7 +1645,42 @@ class Control:
         parser_led_blink.add_argument('--period2', type=int, choices=range(10, 2550), metavar="{10..2550}", help="duration of second blink period")
         parser_led_blink.add_argument('--color2', help="second blink color as r,g,b")
 
-        args = parser.parse_args()
+    def _addConfigParser(self, parser_config):
+        subparsers_config = parser_config.add_subparsers(dest='subparser_name', title='config commands')
+        parser_config_dump = subparsers_config.add_parser('dump', help='read the device configuration into a JSON document')
+        parser_config_dump.add_argument('--output', default='-', help="file to write, - for stdout")
+        parser_config_restore = subparsers_config.add_parser('restore', help='write the changed entries of a dump to the device')
+        parser_config_restore.add_argument('--input', default='-', help="dump to restore, - for stdin")
+        parser_config_restore.add_argument('--dry-run', action="store_true", help="only list the entries that differ")
+
+    def _addHistoryParser(self, parser_history):
+        subparsers_history = parser_history.add_subparsers(dest='subparser_name', title='history commands')
+        parser_history_show = subparsers_history.add_parser('show', help='show recorded samples')
+        parser_history_show.add_argument('--last', type=int, default=3600, help="show the last seconds, 0 for all")
+        parser_history_show.add_argument('--step', type=int, default=0, help="average samples over seconds, 0 for raw samples")
+        parser_history_show.add_argument('--follow', action="store_true", help="keep streaming new samples")
+        parser_history_show.add_argument('--path', help="history file, default from service config")
+
+    def _addLogParser(self, parser_log):
+        parser_log.add_argument('--level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='DEBUG', help="minimum level")
+        parser_log.add_argument('--lines', type=int, default=0, help="show only the last lines, 0 for all")
+
+    def _addStatsParser(self, parser_stats):
+        parser_stats.add_argument('--json', action="store_true", help="raw statistics as JSON")
+
+    def _addApplyParser(self, parser_apply):
+        parser_apply.add_argument('--script', help="file with one pijuice_ctl command per line, - for stdin")
+        parser_apply.add_argument('--patch', help="JSON merge patch for the config file, - for stdin")
+        parser_apply.add_argument('--keep-going', action="store_true", help="run the remaining commands after a failed one")
+        parser_apply.add_argument('--json', action="store_true", help="report the result of every command as a JSON line")
+
+    def main(self, argv=None):
+        argv = sys.argv[1:] if argv is None else argv
+        # the first word that is not an option selects the command group
+        selected = next((a for a in argv if not a.startswith('-')), None)
+        parser = self._createParser([selected] if selected else [])
+        self.parser = parser
+        args = parser.parse_args(argv)
         if not 'func' in args:
             parser.error(message="no command")
 
@@ -1155,10 +1692,8 @@ class Control:
 
         try:
             self.logger.debug("### started ###")
-            pijuice = PiJuice(1, 0x14)
-            fc = FirmwareCommand(pijuice, None)
-            self.current_fw_version = fc.get_current_fw_version()
-            args.func(args, pijuice)
+            # the bus is opened and the firmware version probed by the first command needing them
+            return args.func(args, self._pijuice)
         except KeyboardInterrupt:
             self.logger.warn("aborted")
             return 2
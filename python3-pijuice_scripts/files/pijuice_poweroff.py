@@ -4,12 +4,14 @@ import sys
 import logging
 import subprocess
 import argparse
-import json
 
 from pijuice import PiJuice
+from pijuice_settings import LoadSettings, SimulationSelected, CONFIG_PATH
+from pijuice_bus import ShareBus, PRIORITY_POWER
+from pijuice_query import QueryClient
 
 HALT_FILE = '/tmp/pijuice_poweroff.flag'
-PiJuiceConfigDataPath = '/etc/pijuice/pijuice_config.JSON'
+PiJuiceConfigDataPath = CONFIG_PATH
 
 def systemHalt(pijuice):
     pijuice.status.SetLedBlink('D2', 3, [150, 0, 0], 200, [0, 100, 0], 200)
@@ -27,24 +29,36 @@ def triggerPowerOff(pijuice, delay):
         raise IOError("Unable to set poweroff %s" % ret['error'])
 
 def loadPiJuiceConfig():
-    with open(PiJuiceConfigDataPath, 'r') as outputConfig:
-        pijuiceConfigData = json.load(outputConfig)
-        return pijuiceConfigData
+    return LoadSettings(PiJuiceConfigDataPath)
 
 def enableWakeup(pijuice):
-    configData = loadPiJuiceConfig()
-    wakeupConfig = configData.get('system_task', {}).get('wakeup_on_charge', {})
-    enabled = wakeupConfig.get('enabled', False)
-    if not enabled:
+    settings = loadPiJuiceConfig()
+    if not settings.wakeupOnChargeEn:
         logging.debug("wakeup not enabled")
 
-    trigger_level = wakeupConfig.get('trigger_level', 0)
+    trigger_level = settings.wakeupTriggerLevel or 0
     if not trigger_level:
         logging.debug("wakeup has no trigger level set")
 
     logging.info("signal wakeup on charge at %s%%" % trigger_level)
     pijuice.power.SetWakeUpOnCharge(trigger_level)
 
+def requestPowerOff(delay, wakeup):
+    """
+    Hands the halt to the running service, it has everything prepared.
+    Returns False if the service is not running.
+    """
+    try:
+        ret = QueryClient().Request('poweroff', delay=delay, wakeup=wakeup)
+    except OSError:
+        return False
+    if ret['error'] == 'ALREADY_HALTING':
+        logging.warn("halt already triggered by the service -> ignore")
+    elif ret['error'] != 'NO_ERROR':
+        logging.warn("service refused power off: %s" % ret['error'])
+        return False
+    return True
+
 def main():
     parser = argparse.ArgumentParser(description="halts and powers off", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-v', '--verbose', action="store_true", help="verbose output")
@@ -64,11 +78,22 @@ def main():
             logging.warn("halt already triggered -> ignore")
             return 0
 
-        pijuice = PiJuice(1, 0x14)
+        delay = args.delay
+        if requestPowerOff(delay, not args.noWakupEnable):
+            logging.info("service halts and completely powers off after %ss" % delay)
+            with open(HALT_FILE, 'w') as f:
+                pass
+            return 0
+
+        if SimulationSelected():
+            from pijuice_sim import OpenPiJuice
+            pijuice = OpenPiJuice(1, 0x14)
+        else:
+            pijuice = PiJuice(1, 0x14)
+        ShareBus(pijuice, PRIORITY_POWER)
         if not args.noWakupEnable:
             enableWakeup(pijuice)
 
-        delay = args.delay
         logging.info("halt and completely power of after %ss" % delay)
         triggerPowerOff(pijuice, delay)
     except: # pylint: disable=bare-except
@@ -1,8 +1,36 @@
 #!/usr/bin/python3 -OO
 
+import argparse
+import csv
+import json
+import math
+import sys
+import time
 from datetime import datetime
 
 from pijuice import PiJuice
+from pijuice_snapshot import SnapshotReader, ALL_FIELDS
+from pijuice_settings import SimulationSelected
+from pijuice_statuspage import ReadStatusPage, StatusPageReader, STATUS_PAGE_MAX_AGE
+from pijuice_query import QueryClient
+from pijuice_bus import ShareBus
+
+# record field: register group it is read from, None for the Pi temperature
+FIELDS = {
+    'battery': 'status',
+    'powerInput': 'status',
+    'powerInput5vIo': 'status',
+    'isFault': 'status',
+    'isButton': 'status',
+    'chargeLevel': 'chargeLevel',
+    'faults': 'faults',
+    'batteryTemperature': 'batteryTemperature',
+    'batteryVoltage': 'batteryVoltage',
+    'batteryCurrent': 'batteryCurrent',
+    'ioVoltage': 'ioVoltage',
+    'ioCurrent': 'ioCurrent',
+    'piTemperature': None,
+}
 
 def getPiTemp():
     with open('/sys/class/thermal/thermal_zone0/temp', 'r') as f:
@@ -10,24 +38,167 @@ def getPiTemp():
         rawTemp = int(raw)
         return rawTemp / 1000
 
+def readSnapshot():
+    # The status page of the running pijuice service costs no bus access at all,
+    # ask the service next, it already polls the bus
+    snapshot = ReadStatusPage()
+    if snapshot is not None and snapshot.Has(ALL_FIELDS):
+        return snapshot
+    try:
+        ret = QueryClient().GetStatus()
+        if ret['error'] == 'NO_ERROR':
+            return ret['data']
+    except OSError:
+        pass
+    pijuice = openPiJuice()
+    ShareBus(pijuice)
+    return SnapshotReader(pijuice.interface).Read()
+
+def openPiJuice():
+    if SimulationSelected():
+        from pijuice_sim import OpenPiJuice
+        return OpenPiJuice(1, 0x14)
+    return PiJuice(1, 0x14)
+
+class Sampler:
+    """
+    Reads the selected fields over one connection: from the status page
+    of the running pijuice service while it is current, through its query
+    socket if it answers, else from the bus opened once.
+    """
+    def __init__(self, fields):
+        self.fields = fields
+        self.groups = list(dict.fromkeys(FIELDS[f] for f in fields if FIELDS[f]))
+        self.reader = None
+        try:
+            self.page = StatusPageReader()
+        except (OSError, ValueError):
+            self.page = None
+        if self.groups and self._FromPage() is None:
+            try:
+                ret = QueryClient().GetStatus(self.groups)
+                if ret['error'] != 'NO_ERROR':
+                    self._Open()
+            except OSError:
+                self._Open()
+
+    def Read(self):
+        record = {'time': time.time()}
+        snapshot = self._Snapshot() if self.groups else None
+        for field in self.fields:
+            if field == 'piTemperature':
+                try:
+                    record[field] = getPiTemp()
+                except (OSError, ValueError):
+                    record[field] = None
+            else:
+                record[field] = getattr(snapshot, field)
+        if snapshot is not None and snapshot.error != 'NO_ERROR':
+            record['error'] = snapshot.error
+        return record
+
+    def _Open(self):
+        pijuice = openPiJuice()
+        ShareBus(pijuice)
+        self.reader = SnapshotReader(pijuice.interface)
+
+    def _FromPage(self):
+        if self.page:
+            snapshot = self.page.Read(STATUS_PAGE_MAX_AGE)
+            if snapshot is not None and snapshot.Has(self.groups):
+                return snapshot
+        return None
+
+    def _Snapshot(self):
+        snapshot = self._FromPage()
+        if snapshot is not None:
+            return snapshot
+        if self.reader:
+            return self.reader.Read(self.groups)
+        try:
+            ret = QueryClient().GetStatus(self.groups)
+            if ret['error'] == 'NO_ERROR':
+                return ret['data']
+        except OSError:
+            pass
+        # the service went away, continue on the bus
+        self._Open()
+        return self.reader.Read(self.groups)
+
+def _CsvValue(value):
+    if isinstance(value, dict):
+        return " ".join(k if v is True else "%s=%s" % (k, v) for k, v in sorted(value.items()))
+    return '' if value is None else value
+
+def watch(sampler, interval, count, fmt):
+    """
+    Emits one record per 'interval' seconds on a fixed monotonic schedule,
+    a late sample does not shift the later ones, missed ones are skipped.
+    """
+    writer = None
+    if fmt == 'csv':
+        writer = csv.writer(sys.stdout, lineterminator='\n')
+        writer.writerow(['time'] + sampler.fields + ['error'])
+    start = time.monotonic()
+    slot = 0
+    emitted = 0
+    while True:
+        record = sampler.Read()
+        if writer:
+            writer.writerow([_CsvValue(record.get(f)) for f in ['time'] + sampler.fields + ['error']])
+        else:
+            sys.stdout.write(json.dumps(record) + "\n")
+        sys.stdout.flush()
+        emitted += 1
+        if emitted == count:
+            break
+        slot += 1
+        due = start + slot * interval
+        now = time.monotonic()
+        if due <= now:
+            slot = math.floor((now - start) / interval) + 1
+            due = start + slot * interval
+        time.sleep(due - now)
+
 def main():
-    pijuice = PiJuice(1, 0x14)
-    status = pijuice.status.GetStatus()
-    #print("status: %s" % status)
-    #print(json.dumps(status, sort_keys=True, indent=4))
-    batteryStatus = status['data']['battery']
-    powerInput = status['data']['powerInput']
-
-    faultStatus = pijuice.status.GetFaultStatus()['data']
-    #print("status: %s" % faultStatus)
-
-    chargeLevel = pijuice.status.GetChargeLevel()['data']
-    batteryTemp = pijuice.status.GetBatteryTemperature()['data']
-    batteryVoltage = pijuice.status.GetBatteryVoltage()['data']
-    batteryCurrent = pijuice.status.GetBatteryCurrent()['data']
-    
-    ioVoltage= pijuice.status.GetIoVoltage()['data']
-    ioCurrent = pijuice.status.GetIoCurrent()['data']
+    parser = argparse.ArgumentParser(description="pijuice status")
+    parser.add_argument('--watch', type=float, metavar='INTERVAL', help="sample every INTERVAL seconds")
+    parser.add_argument('--count', type=int, help="stop after this many samples")
+    parser.add_argument('--format', choices=['json', 'csv'], help="newline delimited JSON or CSV records, default json with --watch")
+    parser.add_argument('--fields', help="comma separated record fields: %s" % ", ".join(FIELDS))
+    args = parser.parse_args()
+    if args.watch is not None and args.watch <= 0:
+        parser.error("INTERVAL must be positive")
+    if args.count is not None and args.count < 1:
+        parser.error("--count must be at least 1")
+    if args.count is not None and args.watch is None:
+        parser.error("--count requires --watch")
+    fields = list(FIELDS)
+    if args.fields:
+        fields = [f.strip() for f in args.fields.split(',') if f.strip()]
+        unknown = [f for f in fields if f not in FIELDS]
+        if unknown:
+            parser.error("unknown fields: %s" % ", ".join(unknown))
+    if args.watch is not None or args.format:
+        try:
+            watch(Sampler(fields), args.watch or 0, args.count if args.watch else 1, args.format or 'json')
+        except (KeyboardInterrupt, BrokenPipeError):
+            pass
+        return
+
+    snapshot = readSnapshot()
+    #print("status: %s" % snapshot)
+    batteryStatus = snapshot.battery
+    powerInput = snapshot.powerInput
+    faultStatus = snapshot.faults
+
+    chargeLevel = snapshot.chargeLevel
+    batteryTemp = snapshot.batteryTemperature
+    batteryVoltage = snapshot.batteryVoltage
+    batteryCurrent = snapshot.batteryCurrent
+
+    ioVoltage = snapshot.ioVoltage
+    ioCurrent = snapshot.ioCurrent
 
     now = datetime.now()
     piTemp = getPiTemp()
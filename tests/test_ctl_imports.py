@@ -0,0 +1,48 @@
+"""
+pijuice_ctl loads the command groups and the PiJuice on demand: commands
+working on the configuration file only must not import the bus, the
+simulator or the modules of the other command groups.
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PATHS = [os.path.join(ROOT, 'python3-pijuice', 'files'), os.path.join(ROOT, 'python3-pijuice_scripts', 'files')]
+# modules of the other command groups and the device access
+ON_DEMAND = ('pijuice', 'pijuice_sim', 'pijuice_bus', 'pijuice_transport', 'pijuice_query', 'pijuice_history',
+             'pijuice_devcache', 'pijuice_snapshot', 'subprocess', 'datetime')
+CODE = '''
+import json, sys
+import pijuice_ctl
+pijuice_ctl.ConfigCommand.PiJuiceConfigDataPath = %(config)r
+pijuice_ctl.ConfigCommand.SERVICE_CTL = 'true'
+try:
+    ret = pijuice_ctl.Control().main(%(argv)r)
+except SystemExit as e:
+    ret = e.code
+print(json.dumps({'returncode': ret, 'modules': sorted(sys.modules)}))
+'''
+
+
+def _Run(argv, tmp_path):
+    config = str(tmp_path / 'pijuice_config.JSON')
+    with open(config, 'w') as f:
+        json.dump({}, f)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(PATHS))
+    # the real board must not be needed, a simulator import would show up in the modules
+    env.pop('PIJUICE_SIM', None)
+    out = subprocess.run([sys.executable, '-c', CODE % {'config': config, 'argv': argv}], env=env,
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=str(tmp_path), check=True)
+    return json.loads(out.stdout.decode().splitlines()[-1])
+
+
+@pytest.mark.parametrize('argv', [['events', 'get'], ['--help']])
+def test_config_commands_load_nothing_else(argv, tmp_path):
+    run = _Run(argv, tmp_path)
+    assert run['returncode'] in (0, None)
+    loaded = [m for m in ON_DEMAND if m in run['modules']]
+    assert loaded == []